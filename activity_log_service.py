@@ -0,0 +1,296 @@
+"""
+Servicio de registro de actividad en segundo plano.
+
+utils.log_activity ya no inserta ni confirma nada en la sesión de la petición:
+deja el registro en una cola en memoria y un hilo lo guarda más tarde. El hilo
+agrupa los registros y los inserta de una vez (cada BATCH_SIZE registros o cada
+FLUSH_INTERVAL_MS milisegundos, lo que llegue antes) en una transacción propia,
+con su propia conexión del pool, así que la petición no espera a la base de datos
+ni confirma a medias el estado de la vista.
+
+La cola tiene un tamaño máximo: si la base de datos no da abasto, los registros
+nuevos se descartan y se cuentan (ver get_service_status) en lugar de acumularse
+en memoria. Al terminar el proceso se guardan los registros pendientes.
+
+El servicio se inicia en cada proceso con el primer registro, como la cola de
+impresión.
+"""
+import atexit
+import logging
+import queue
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy.exc import SQLAlchemyError
+
+from app import db
+from models import ActivityLog
+
+logger = logging.getLogger(__name__)
+
+# Registros por inserción
+BATCH_SIZE = 200
+
+# Tiempo máximo que un registro espera en la cola antes de guardarse (en milisegundos)
+FLUSH_INTERVAL_MS = 500
+
+# Registros máximos en memoria (los que lleguen con la cola llena se descartan)
+MAX_QUEUE_SIZE = 10000
+
+# Tiempo máximo para guardar los registros pendientes al detener el servicio (en segundos)
+SHUTDOWN_TIMEOUT = 5
+
+# Longitud de las columnas de texto (los valores más largos se recortan)
+ACTION_LENGTH = ActivityLog.__table__.c.action.type.length
+IP_ADDRESS_LENGTH = ActivityLog.__table__.c.ip_address.type.length
+
+# Variables globales para controlar el estado del servicio
+service_engine = None
+service_running = False
+writer_thread = None
+service_lock = threading.Lock()
+activity_queue = queue.Queue(maxsize=MAX_QUEUE_SIZE)
+
+stats = {'queued': 0, 'written': 0, 'dropped': 0, 'failed': 0, 'batches': 0}
+stats_lock = threading.Lock()
+last_flush_time = None
+dropping = False
+
+
+class _FlushRequest:
+    """Marca en la cola: el hilo guarda lo que tiene y avisa (o termina si stop)."""
+
+    def __init__(self, stop=False):
+        self.stop = stop
+        self.done = threading.Event()
+
+
+def _count(name, amount=1):
+    with stats_lock:
+        stats[name] += amount
+
+
+def record_activity(action, user_id=None, ip_address=None, timestamp=None):
+    """
+    Encola un registro de actividad sin esperar a la base de datos.
+
+    Args:
+        action: Acción realizada
+        user_id: ID del usuario (opcional)
+        ip_address: Dirección IP de la petición (opcional)
+        timestamp: Momento de la acción (por defecto, ahora)
+
+    Returns:
+        bool: True si se encoló, False si se descartó por tener la cola llena
+    """
+    global dropping
+
+    # Sin hilo en este proceso (primer registro, o proceso hijo tras un fork)
+    if writer_thread is None or not writer_thread.is_alive():
+        from flask import current_app
+        start_activity_log_service(current_app._get_current_object())
+
+    row = {
+        'action': str(action)[:ACTION_LENGTH],
+        'user_id': user_id,
+        'ip_address': ip_address[:IP_ADDRESS_LENGTH] if ip_address else None,
+        'timestamp': timestamp or datetime.utcnow()
+    }
+    try:
+        activity_queue.put_nowait(row)
+    except queue.Full:
+        _count('dropped')
+        if not dropping:
+            # Solo se avisa una vez hasta que el hilo vuelva a guardar registros
+            dropping = True
+            logger.warning(f"Cola de actividad llena ({MAX_QUEUE_SIZE} registros): se descartan los nuevos")
+        return False
+
+    _count('queued')
+    return True
+
+
+def write_activity_batch(rows):
+    """
+    Inserta un lote de registros en una transacción con su propia conexión.
+
+    Si el lote falla (p. ej. un usuario eliminado entretanto), se reintenta registro
+    a registro para no perder el resto.
+
+    Returns:
+        int: Registros guardados
+    """
+    table = ActivityLog.__table__
+    try:
+        with service_engine.begin() as connection:
+            connection.execute(table.insert(), rows)
+        return len(rows)
+    except SQLAlchemyError as e:
+        if len(rows) == 1:
+            logger.error(f"Error al guardar el registro de actividad: {str(e)}")
+            return 0
+        logger.warning(f"Error al guardar {len(rows)} registros de actividad, reintentando uno a uno: {str(e)}")
+
+    written = 0
+    for row in rows:
+        written += write_activity_batch([row])
+    return written
+
+
+def _flush(rows):
+    global last_flush_time, dropping
+
+    if not rows:
+        return
+    try:
+        written = write_activity_batch(rows)
+    except Exception as e:
+        logger.error(f"Error en el hilo de registro de actividad: {str(e)}")
+        written = 0
+    with stats_lock:
+        stats['written'] += written
+        stats['failed'] += len(rows) - written
+        stats['batches'] += 1
+    last_flush_time = datetime.now()
+    dropping = False
+
+
+def activity_log_writer():
+    """Hilo que guarda los registros de la cola por lotes."""
+    logger.info("Iniciado el hilo de registro de actividad")
+    rows = []
+    deadline = None
+
+    while True:
+        timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+        try:
+            item = activity_queue.get(timeout=timeout)
+        except queue.Empty:
+            item = None
+
+        if isinstance(item, _FlushRequest):
+            # Lo que quede en la cola se encoló antes de la petición de vaciado
+            while True:
+                try:
+                    pending = activity_queue.get_nowait()
+                except queue.Empty:
+                    break
+                if isinstance(pending, _FlushRequest):
+                    pending.done.set()
+                else:
+                    rows.append(pending)
+            _flush(rows)
+            rows, deadline = [], None
+            item.done.set()
+            if item.stop:
+                break
+            continue
+
+        if item is not None:
+            rows.append(item)
+            if deadline is None:
+                deadline = time.monotonic() + FLUSH_INTERVAL_MS / 1000.0
+
+        if rows and (len(rows) >= BATCH_SIZE or time.monotonic() >= deadline):
+            _flush(rows)
+            rows, deadline = [], None
+
+    logger.info("Detenido el hilo de registro de actividad")
+
+
+def flush_activity_log(timeout=SHUTDOWN_TIMEOUT):
+    """
+    Espera a que se guarden los registros encolados hasta ahora.
+
+    Returns:
+        bool: True si se guardaron antes del tiempo máximo
+    """
+    if writer_thread is None or not writer_thread.is_alive():
+        return False
+    flush_request = _FlushRequest()
+    try:
+        activity_queue.put(flush_request, timeout=timeout)
+    except queue.Full:
+        return False
+    return flush_request.done.wait(timeout)
+
+
+def start_activity_log_service(app=None):
+    """
+    Inicia el hilo de registro de actividad de este proceso.
+
+    Args:
+        app: Aplicación Flask (por defecto, la del contexto actual)
+
+    Returns:
+        bool: True si el servicio se inició, False si ya estaba en ejecución.
+    """
+    global service_engine, service_running, writer_thread
+
+    with service_lock:
+        if writer_thread is not None and writer_thread.is_alive():
+            return False
+
+        if app is None:
+            from flask import current_app
+            app = current_app._get_current_object()
+
+        with app.app_context():
+            service_engine = db.engine
+        service_running = True
+        writer_thread = threading.Thread(target=activity_log_writer, daemon=True,
+                                         name="activity-log-writer")
+        writer_thread.start()
+    return True
+
+
+def stop_activity_log_service(timeout=SHUTDOWN_TIMEOUT):
+    """
+    Guarda los registros pendientes y detiene el hilo.
+
+    Returns:
+        bool: True si el servicio se detuvo correctamente, False en caso contrario.
+    """
+    global service_running
+
+    with service_lock:
+        service_running = False
+        if writer_thread is None or not writer_thread.is_alive():
+            return False
+
+        stop_request = _FlushRequest(stop=True)
+        try:
+            activity_queue.put(stop_request, timeout=timeout)
+        except queue.Full:
+            logger.error("No se pudo detener el registro de actividad: cola llena")
+            return False
+        writer_thread.join(timeout)
+        pending = activity_queue.qsize()
+        if pending:
+            logger.warning(f"{pending} registros de actividad sin guardar al detener el servicio")
+        return not writer_thread.is_alive()
+
+
+def get_service_status():
+    """
+    Obtiene el estado actual del servicio de registro de actividad.
+
+    Returns:
+        dict: Diccionario con información sobre el estado del servicio.
+    """
+    with stats_lock:
+        counters = dict(stats)
+
+    return {
+        'active': writer_thread is not None and writer_thread.is_alive(),
+        'running': service_running,
+        'pending': activity_queue.qsize(),
+        'max_queue_size': MAX_QUEUE_SIZE,
+        'last_flush': last_flush_time.strftime('%Y-%m-%d %H:%M:%S') if last_flush_time else None,
+        **counters
+    }
+
+
+# Guardar los registros pendientes al terminar el proceso (los hilos daemon no esperan)
+atexit.register(stop_activity_log_service)
@@ -63,12 +63,15 @@ def create_app(config_class='config.Config'):
         # Import task models
         from models_tasks import (Location, LocalUser, Task, TaskSchedule, TaskCompletion, 
                                 TaskPriority, TaskFrequency, TaskStatus, WeekDay, TaskGroup,
-                                Product, ProductConservation, ProductLabel, ConservationType)
+                                Product, ProductConservation, ProductLabel, ConservationType, PrintJob)
                                 
         # Import checkpoint models
         from models_checkpoints import (CheckPoint, CheckPointRecord, CheckPointIncident, 
                                       EmployeeContractHours, CheckPointStatus, CheckPointIncidentType)
         
+        # Import upload storage models
+        from models_storage import StoredFile
+        
         # Create admin user if it doesn't exist
         from utils import create_admin_user
         create_admin_user()
@@ -220,6 +223,7 @@ def create_app(config_class='config.Config'):
                 # Solo registrar acciones interesantes (no GETs a páginas comunes)
                 if request.method != 'GET' or not request.path.startswith(('/dashboard', '/employees')):
                     # Usar la función de utils.py para registrar en lugar de hacerlo directamente aquí
+                    # (solo encola el registro: lo guarda en segundo plano activity_log_service)
                     from utils import log_activity as log_activity_util
                     log_activity_util(f"{request.method} {request.path}")
             except Exception as e:
@@ -364,3 +368,6 @@ def manifest():
 from utils_jinja import month_name_filter, format_currency_filter
 app.jinja_env.filters['month_name'] = month_name_filter
 app.jinja_env.filters['currency'] = format_currency_filter
+
+from utils_storage import storage_version
+app.jinja_env.filters['storage_version'] = storage_version
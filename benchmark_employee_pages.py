@@ -0,0 +1,93 @@
+"""
+Script para medir el tiempo de carga de las páginas del listado de empleados.
+
+Crea empleados sintéticos en la base de datos configurada (DATABASE_URL), dentro
+de una transacción que se deshace al terminar, y compara para páginas cada vez
+más profundas la paginación por OFFSET anterior (con la carga perezosa de la
+empresa de cada empleado) con la paginación por clave de utils.get_employees_page,
+que debe tardar lo mismo en cualquier página. La base de datos debe tener los
+índices de la migración add_employee_listing_indexes.
+
+Uso:
+    python benchmark_employee_pages.py [empleados] [empresas]
+"""
+import statistics
+import sys
+import time
+
+from app import create_app, db
+from models import Company, Employee
+from utils import encode_page_cursor, get_employees_page
+
+REPETITIONS = 10
+PER_PAGE = 20
+
+
+def populate(count, companies):
+    """Inserta los datos sintéticos sin confirmar la transacción."""
+    company_rows = [Company(name=f'Benchmark {number}', tax_id=f'BENCH{number:05d}') for number in range(companies)]
+    db.session.add_all(company_rows)
+    db.session.flush()
+    company_ids = [company.id for company in company_rows]
+
+    batch = []
+    for number in range(count):
+        batch.append({'first_name': f'Nombre {number % 997}', 'last_name': f'Apellido {number % 4999:05d}',
+                      'dni': f'BENCH{number:08d}', 'company_id': company_ids[number % companies],
+                      'is_active': True})
+        if len(batch) == 5000:
+            db.session.execute(db.insert(Employee), batch)
+            batch = []
+    if batch:
+        db.session.execute(db.insert(Employee), batch)
+
+
+def measure(fetch):
+    latencies = []
+    for _ in range(REPETITIONS):
+        # Sin objetos en la sesión: cada repetición carga también las empresas
+        db.session.expunge_all()
+        start = time.perf_counter()
+        employees = fetch()
+        # Como la plantilla: nombre de la empresa de cada empleado
+        [employee.company.name for employee in employees]
+        latencies.append((time.perf_counter() - start) * 1000)
+    return statistics.median(latencies)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    companies = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    app = create_app()
+    with app.app_context():
+        try:
+            start = time.perf_counter()
+            populate(count, companies)
+            print(f"{count:,} empleados en {companies} empresas creados en {time.perf_counter() - start:.1f} s")
+
+            # Cursor de cada página medida: clave del último empleado de la página anterior
+            pages = db.session.query(db.func.count(Employee.id)).scalar() // PER_PAGE
+            depths = sorted({1, 10, 100, pages // 2, pages} - {0})
+            cursors = {}
+            for depth in depths:
+                previous = db.session.execute(
+                    db.select(Employee.last_name, Employee.first_name, Employee.id)
+                    .order_by(Employee.last_name, Employee.first_name, Employee.id)
+                    .offset((depth - 1) * PER_PAGE - 1).limit(1)
+                ).first() if depth > 1 else None
+                cursors[depth] = encode_page_cursor(list(previous)) if previous else None
+
+            print(f"{'Página':>8} {'OFFSET':>12} {'Por clave':>12}")
+            for depth in depths:
+                offset = measure(lambda: Employee.query.order_by(Employee.last_name, Employee.first_name)
+                                 .offset((depth - 1) * PER_PAGE).limit(PER_PAGE).all())
+                keyset = measure(lambda: get_employees_page(after=cursors[depth], per_page=PER_PAGE).items)
+                print(f"{depth:>8} {offset:>9.2f} ms {keyset:>9.2f} ms")
+        finally:
+            db.session.rollback()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,109 @@
+"""
+Script para medir la latencia de la búsqueda global de empleados.
+
+Construye el índice en memoria que usa la búsqueda global cuando la base de datos
+no es PostgreSQL (utils_search_index.NgramSearchIndex) con empleados sintéticos
+(nombre, apellidos con y sin acentos y DNI, repartidos entre empresas) y mide
+búsquedas habituales sin acentos ("jose", "garcia"), por prefijo, por DNI y con
+erratas, tanto para un administrador (todas las empresas) como para un gerente
+(algunas empresas). El objetivo es un p95 por debajo de 20 ms con 100.000 empleados.
+
+Con --db mide la misma búsqueda contra la base de datos configurada
+(DATABASE_URL), con los índices de trigramas de PostgreSQL si están disponibles.
+
+Uso:
+    python benchmark_global_search.py [empleados] [empresas]
+    python benchmark_global_search.py --db
+"""
+import random
+import statistics
+import sys
+import time
+
+from utils_search_index import NgramSearchIndex
+
+REPETITIONS = 20
+LIMIT = 20
+
+FIRST_NAMES = ['José', 'María', 'Jesús', 'Ángel', 'Lucía', 'Sofía', 'Martín', 'Raúl', 'Inés', 'Óscar',
+               'Ana', 'Carmen', 'David', 'Laura', 'Pablo', 'Marta', 'Iván', 'Noelia', 'Adrián', 'Begoña']
+LAST_NAMES = ['García', 'Fernández', 'González', 'Rodríguez', 'López', 'Martínez', 'Sánchez', 'Pérez',
+              'Gómez', 'Martín', 'Jiménez', 'Ruiz', 'Hernández', 'Díaz', 'Moreno', 'Muñoz', 'Álvarez',
+              'Romero', 'Alonso', 'Gutiérrez', 'Navarro', 'Torres', 'Domínguez', 'Vázquez', 'Ramos',
+              'Gil', 'Ramírez', 'Serrano', 'Blanco', 'Molina', 'Morales', 'Suárez', 'Ortega', 'Delgado',
+              'Castro', 'Ortiz', 'Rubio', 'Marín', 'Sanz', 'Núñez', 'Iglesias', 'Medina', 'Garrido',
+              'Cortés', 'Castillo', 'Santos', 'Lozano', 'Guerrero', 'Cano', 'Prieto', 'Méndez', 'Cruz',
+              'Calvo', 'Gallego', 'Vidal', 'León', 'Márquez', 'Herrera', 'Peña', 'Flores', 'Cabrera']
+
+QUERIES = ['jose', 'Jose Garcia', 'garcia', 'maria lopez', 'mun', 'fernandez', 'angel ibañez',
+           'gonzalez martin', 'perez', 'gutierrez', 'ruiz sofia', 'nuñez', 'dominguez', 'gonzales',
+           'hernandes', 'sanchez perez', 'oscar', 'lu', 'vazquez ra', 'iglesias']
+
+
+def synthetic_employees(count, companies, seed=42):
+    rng = random.Random(seed)
+    for employee_id in range(1, count + 1):
+        text = (f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)} {rng.choice(LAST_NAMES)} "
+                f"{rng.randrange(10 ** 7, 10 ** 8)}{rng.choice('TRWAGMYFPDXBNJZSQVHLCKE')}")
+        yield employee_id, text, rng.randrange(1, companies + 1)
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure(name, search):
+    latencies = []
+    results = 0
+    for _ in range(REPETITIONS):
+        for query in QUERIES:
+            start = time.perf_counter()
+            results += len(search(query))
+            latencies.append((time.perf_counter() - start) * 1000)
+    print(f"{name:<32} p50 {statistics.median(latencies):6.2f} ms  p95 {percentile(latencies, 0.95):6.2f} ms  "
+          f"máx {max(latencies):7.2f} ms  ({results // REPETITIONS} resultados por pasada)")
+    return percentile(latencies, 0.95)
+
+
+def benchmark_index(count, companies):
+    start = time.perf_counter()
+    index = NgramSearchIndex(synthetic_employees(count, companies))
+    print(f"Índice de {count:,} empleados en {companies} empresas construido en "
+          f"{time.perf_counter() - start:.2f} s")
+
+    manager_companies = set(range(1, max(2, companies // 10) + 1))
+    p95 = max(
+        measure("Administrador (todas)", lambda query: index.search(query, LIMIT)),
+        measure(f"Gerente ({len(manager_companies)} empresas)",
+                lambda query: index.search(query, LIMIT, groups=manager_companies)),
+    )
+    print(f"p95 {'por debajo' if p95 < 20 else 'por encima'} del objetivo de 20 ms")
+    return 0
+
+
+def benchmark_database():
+    from app import create_app
+    from utils_global_search import database_search_available, global_search
+
+    app = create_app()
+    with app.app_context():
+        mode = "pg_trgm + unaccent" if database_search_available() else "índice en memoria"
+        print(f"Búsqueda contra la base de datos configurada ({mode})")
+        measure("Administrador (empleados)",
+                lambda query: global_search(query, types=['employees'], limit=LIMIT)['employees'])
+        measure("Administrador (todos los tipos)",
+                lambda query: sum(global_search(query, limit=LIMIT).values(), []))
+    return 0
+
+
+def main():
+    if '--db' in sys.argv[1:]:
+        return benchmark_database()
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    companies = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+    return benchmark_index(count, companies)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,83 @@
+"""
+Script para medir el tamaño y la latencia del envío de lotes de etiquetas a una impresora.
+
+Compara el envío actual (una petición JSON con un PNG RGB en base64 por etiqueta) con
+las cargas de 1 bit de varias páginas (PNG de 1 bit y raster Brother) contra una
+impresora simulada local (stub_printer_server).
+
+Uso:
+    python benchmark_label_payload.py [etiquetas_por_lote] [retardo_impresora_ms]
+"""
+import json
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import requests
+
+from stub_printer_server import StubPrinterServer
+from utils_labels import (LABEL_WIDTH, LABEL_HEIGHT, LABEL_FORMAT_PNG_1BIT, LABEL_FORMAT_BROTHER_RASTER,
+                          build_label_payload, label_image_to_base64, post_label_payload,
+                          render_product_label)
+
+REPETITIONS = 5
+
+
+def render_batch():
+    now = datetime(2025, 6, 2, 8, 0)
+    product = SimpleNamespace(name='Salsa de tomate', shelf_life_days=3)
+    user = SimpleNamespace(name='Ana', last_name='García', username='ana')
+    return render_product_label(product, user, SimpleNamespace(value='refrigeracion'),
+                                now, now + timedelta(hours=72))
+
+
+def send_legacy(url, count):
+    """Envío actual: una petición por etiqueta con el PNG RGB en base64."""
+    total = 0
+    for _ in range(count):
+        image = render_batch()
+        body = json.dumps({'content': label_image_to_base64(image)}).encode('utf-8')
+        requests.post(url, data=body, headers={'Content-Type': 'application/json'}, timeout=10)
+        total += len(body)
+    return total, count
+
+
+def send_batch(url, count, label_format):
+    """Envío por lotes: una sola carga de varias páginas en formato de 1 bit."""
+    payload = build_label_payload([(render_batch(), count)], label_format)
+    sent, message = post_label_payload(url, payload)
+    if not sent:
+        raise RuntimeError(message)
+    return len(payload.body), 1
+
+
+def measure(name, send, url, count):
+    latencies = []
+    for _ in range(REPETITIONS):
+        start = time.perf_counter()
+        size, requests_made = send(url, count)
+        latencies.append((time.perf_counter() - start) * 1000)
+    print(f"{name:<30} {size:>10,} bytes  {requests_made:>3} petición(es)  "
+          f"{statistics.median(latencies):8.1f} ms (mediana extremo a extremo)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    delay_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+
+    print(f"Lote de {count} etiquetas {LABEL_WIDTH}x{LABEL_HEIGHT}, "
+          f"impresora simulada con {delay_ms:.0f} ms por petición")
+    print(f"{'RGB sin comprimir (referencia)':<30} {count * LABEL_WIDTH * LABEL_HEIGHT * 3:>10,} bytes")
+
+    with StubPrinterServer(delay=delay_ms / 1000.0) as printer:
+        url = printer.url('/print')
+        measure("PNG RGB base64 (actual)", send_legacy, url, count)
+        measure("PNG 1 bit multipágina", lambda u, c: send_batch(u, c, LABEL_FORMAT_PNG_1BIT), url, count)
+        measure("Raster Brother multipágina", lambda u, c: send_batch(u, c, LABEL_FORMAT_BROTHER_RASTER), url, count)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,108 @@
+"""
+Script para medir el rendimiento del renderizado de etiquetas (etiquetas/segundo).
+
+Compara el renderizado anterior de generate_labels (carga de fuentes y maquetación en
+cada petición) con el motor de utils_labels (fuentes en caché y diseño precompilado),
+y comprueba que ambos producen exactamente la misma imagen.
+
+Uso:
+    python benchmark_label_rendering.py [numero_de_etiquetas]
+"""
+import sys
+import time
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+from utils_labels import (LABEL_FONT_PATH, LABEL_WIDTH, LABEL_HEIGHT, CompiledLabelLayout,
+                          build_label_fields, label_image_to_base64)
+
+PRODUCTS = [
+    SimpleNamespace(name='Salsa de tomate', shelf_life_days=3),
+    SimpleNamespace(name='Pollo asado', shelf_life_days=0),
+    SimpleNamespace(name='Croquetas de jamón ibérico', shelf_life_days=5),
+    SimpleNamespace(name='Caldo', shelf_life_days=2),
+]
+USERS = [
+    SimpleNamespace(name='Ana', last_name='García', username='ana'),
+    SimpleNamespace(name='Luis', last_name='', username='luis'),
+]
+CONSERVATION_TYPES = [SimpleNamespace(value=v) for v in ('descongelacion', 'refrigeracion', 'gastro')]
+
+
+def render_label_legacy(fields):
+    """Renderizado tal y como lo hacía generate_labels antes del motor precompilado."""
+    image = Image.new('RGB', (LABEL_WIDTH, LABEL_HEIGHT), 'white')
+    draw = ImageDraw.Draw(image)
+    font_title = ImageFont.truetype(LABEL_FONT_PATH, 42)
+    font_type = ImageFont.truetype(LABEL_FONT_PATH, 28)
+    font_date = ImageFont.truetype(LABEL_FONT_PATH, 34)
+    font_elab = ImageFont.truetype(LABEL_FONT_PATH, 24)
+    font_vida = ImageFont.truetype(LABEL_FONT_PATH, 26)
+    font_user = ImageFont.truetype(LABEL_FONT_PATH, 32)
+
+    def centered(text, font, y_pos):
+        bbox = draw.textbbox((0, 0), text, font=font)
+        draw.text(((LABEL_WIDTH - (bbox[2] - bbox[0])) // 2, y_pos), text, fill='black', font=font)
+
+    y_pos = 8
+    centered(fields['product_name'], font_type if len(fields['product_name']) > 14 else font_title, y_pos)
+    y_pos += 58
+    centered(fields['conservation'], font_type, y_pos)
+    y_pos += 55
+    centered(fields['expiry'], font_date, y_pos)
+    y_pos += 90
+    centered(fields['elaboration'], font_elab, y_pos)
+    y_pos += 42
+    if fields.get('shelf_life'):
+        centered(fields['shelf_life'], font_vida, y_pos)
+        y_pos += 42
+    centered(fields['user'], font_user, y_pos)
+    return image
+
+
+def sample_fields(count):
+    """Genera los campos de `count` etiquetas con una mezcla realista de productos y horas."""
+    start = datetime(2025, 6, 2, 8, 0)
+    samples = []
+    for i in range(count):
+        now = start + timedelta(minutes=i // 10)
+        product = PRODUCTS[i % len(PRODUCTS)]
+        samples.append(build_label_fields(product, USERS[i % len(USERS)],
+                                          CONSERVATION_TYPES[i % len(CONSERVATION_TYPES)],
+                                          now, now + timedelta(hours=72)))
+    return samples
+
+
+def measure(name, render, samples, encode=False):
+    start = time.perf_counter()
+    for fields in samples:
+        image = render(fields)
+        if encode:
+            label_image_to_base64(image)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<38} {len(samples) / elapsed:10.1f} etiquetas/s ({elapsed * 1000 / len(samples):.2f} ms/etiqueta)")
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    samples = sample_fields(count)
+    layout = CompiledLabelLayout()
+
+    # Verificar que el motor produce exactamente la misma imagen que el renderizado anterior
+    for fields in samples[:20]:
+        if ImageChops.difference(render_label_legacy(fields), layout.render(fields)).getbbox():
+            print(f"❌ La etiqueta difiere del renderizado anterior: {fields}")
+            return 1
+    print("✅ Las imágenes coinciden con el renderizado anterior")
+
+    measure("Renderizado anterior", render_label_legacy, samples)
+    measure("Diseño precompilado", layout.render, samples)
+    measure("Renderizado anterior + PNG base64", render_label_legacy, samples, encode=True)
+    measure("Diseño precompilado + PNG base64", layout.render, samples, encode=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
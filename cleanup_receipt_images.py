@@ -2,18 +2,27 @@
 """
 Script para limpiar imágenes de recibos antiguas.
 
-Este script elimina las imágenes de recibos de gastos que tienen más de 10 días
-de antigüedad. Debe ejecutarse periódicamente mediante un cron job o similar.
+Este script elimina las imágenes de recibos de gastos subidas hace más de
+RECEIPT_IMAGES_RETENTION_DAYS días (10 por defecto) y anula la referencia en el
+gasto. Los recibos caducados se seleccionan en la base de datos por la fecha de
+subida (indexada), sin recorrer la carpeta de recibos. Debe ejecutarse
+periódicamente mediante un cron job o similar.
+
+Con --huerfanos, en lugar de aplicar la retención, compara una vez la carpeta de
+recibos con la base de datos: elimina los archivos que ningún gasto referencia y
+anula las referencias a archivos que ya no existen. También elimina los archivos
+del almacén por contenido que no tienen referencias.
+
+Uso:
+  python cleanup_receipt_images.py
+  python cleanup_receipt_images.py --huerfanos [--dry-run]
 """
 
-import os
-import time
-import datetime
+import argparse
 import logging
-import re
-from config import Config
-from app import create_app, db
-from models_monthly_expenses import MonthlyExpense
+from app import create_app
+from utils_receipt_images import expire_receipts, reconcile_receipt_files, ORPHAN_GRACE_SECONDS
+from utils_storage import remove_unreferenced_files
 
 # Configurar logging
 logging.basicConfig(
@@ -27,136 +36,51 @@ logger = logging.getLogger('receipt_cleaner')
 # pero definimos un valor por defecto aquí por si acaso
 DAYS_TO_KEEP = 10
 
-def get_file_upload_date(filename):
-    """
-    Extrae la fecha de un nombre de archivo con formato timestamp.
-    Los archivos se guardan con un prefijo de timestamp (YYYYMMDDHHMMSS_).
-    
-    Args:
-        filename: Nombre del archivo.
-        
-    Returns:
-        Un objeto datetime con la fecha de subida o None si no se puede extraer.
-    """
-    try:
-        # Buscar un patrón de timestamp al inicio del nombre de archivo
-        match = re.match(r'^(\d{14})_', filename)
-        if match:
-            timestamp = match.group(1)
-            # Convertir el timestamp a fecha
-            return datetime.datetime.strptime(timestamp, '%Y%m%d%H%M%S')
-    except Exception as e:
-        logger.error(f"Error al extraer fecha del archivo {filename}: {str(e)}")
-    
-    return None
-
-def is_file_old(file_path, days=DAYS_TO_KEEP):
-    """
-    Determina si un archivo tiene más de X días de antigüedad.
-    
-    Args:
-        file_path: Ruta completa al archivo.
-        days: Número de días antes de considerar un archivo antiguo.
-        
-    Returns:
-        bool: True si el archivo es antiguo, False en caso contrario.
-    """
-    try:
-        # Primero intentar extraer la fecha del nombre del archivo
-        filename = os.path.basename(file_path)
-        upload_date = get_file_upload_date(filename)
-        
-        if upload_date:
-            # Calcular si la fecha extraída del nombre es antigua
-            now = datetime.datetime.now()
-            file_age_days = (now - upload_date).days
-            return file_age_days > days
-        
-        # Si no se puede extraer del nombre, usar la fecha de modificación del sistema
-        file_stat = os.stat(file_path)
-        file_mtime = file_stat.st_mtime
-        current_time = time.time()
-        file_age_days = (current_time - file_mtime) / (24 * 3600)  # Convertir segundos a días
-        
-        return file_age_days > days
-    except Exception as e:
-        logger.error(f"Error al verificar antigüedad del archivo {file_path}: {str(e)}")
-        # En caso de error, mejor no eliminar el archivo
-        return False
-
-def is_file_referenced(relative_path):
+
+def cleanup_receipt_images():
     """
-    Verifica si un archivo está referenciado en la base de datos.
-    
-    Args:
-        relative_path: Ruta relativa al archivo en la tabla de gastos.
-        
-    Returns:
-        bool: True si el archivo está en uso, False en caso contrario.
+    Elimina las imágenes de recibos caducadas y anula sus referencias.
     """
-    try:
-        # Contar cuántos registros usan esta imagen
-        count = MonthlyExpense.query.filter_by(receipt_image=relative_path).count()
-        return count > 0
-    except Exception as e:
-        logger.error(f"Error al verificar si el archivo está en uso: {str(e)}")
-        # En caso de duda, mejor no eliminar
-        return True
+    app = create_app()
+    with app.app_context():
+        days = app.config.get('RECEIPT_IMAGES_RETENTION_DAYS', DAYS_TO_KEEP)
+        logger.info(f"Iniciando limpieza de imágenes de recibos antiguas (> {days} días)")
 
-def cleanup_receipt_images():
+        stats = expire_receipts(app.config['UPLOAD_FOLDER'], days)
+
+        logger.info(f"Limpieza completada. Gastos actualizados: {stats['expenses']}, "
+                    f"archivos eliminados: {stats['files']}, errores: {stats['errors']}")
+
+
+def reconcile_orphans(dry_run=False):
     """
-    Elimina imágenes de recibos antiguas que ya no están en uso.
+    Elimina los archivos de recibos sin referencia y las referencias sin archivo.
     """
     app = create_app()
     with app.app_context():
-        # Obtener la configuración de días de retención
-        global DAYS_TO_KEEP
-        DAYS_TO_KEEP = Config.RECEIPT_IMAGES_RETENTION_DAYS
-        
-        uploads_dir = Config.UPLOAD_FOLDER
-        receipts_dir = os.path.join(uploads_dir, 'expense_receipts')
-        
-        if not os.path.exists(receipts_dir):
-            logger.info("El directorio de recibos no existe. Nada que limpiar.")
-            return
-        
-        # Registrar información inicial
-        logger.info(f"Iniciando limpieza de imágenes de recibos antiguas (> {DAYS_TO_KEEP} días)")
-        
-        files_checked = 0
-        files_deleted = 0
-        errors = 0
-        
-        # Recorrer directorios de empresas
-        for company_dir in os.listdir(receipts_dir):
-            company_path = os.path.join(receipts_dir, company_dir)
-            if not os.path.isdir(company_path):
-                continue
-            
-            # Procesar todos los archivos en el directorio de la empresa
-            for filename in os.listdir(company_path):
-                file_path = os.path.join(company_path, filename)
-                if not os.path.isfile(file_path):
-                    continue
-                
-                files_checked += 1
-                
-                # Comprobar si el archivo es antiguo
-                if is_file_old(file_path):
-                    # Comprobar si el archivo está en uso en la base de datos
-                    relative_path = os.path.join('expense_receipts', company_dir, filename)
-                    if not is_file_referenced(relative_path):
-                        try:
-                            # Eliminar el archivo
-                            os.remove(file_path)
-                            files_deleted += 1
-                            logger.info(f"Eliminado archivo antiguo: {file_path}")
-                        except Exception as e:
-                            logger.error(f"Error al eliminar archivo {file_path}: {str(e)}")
-                            errors += 1
-        
-        # Registrar resumen
-        logger.info(f"Limpieza completada. Archivos revisados: {files_checked}, eliminados: {files_deleted}, errores: {errors}")
+        logger.info("Comparando la carpeta de recibos con la base de datos" + (" (simulación)" if dry_run else ""))
+
+        stats = reconcile_receipt_files(app.config['UPLOAD_FOLDER'], dry_run=dry_run)
+
+        action = "a eliminar" if dry_run else "eliminados"
+        logger.info(f"Conciliación completada. Archivos revisados: {stats['files']}, "
+                    f"huérfanos {action}: {stats['orphans']}, referencias sin archivo: {stats['missing']}, "
+                    f"errores: {stats['errors']}")
+
+        stats = remove_unreferenced_files(app.config['UPLOAD_FOLDER'], ORPHAN_GRACE_SECONDS, dry_run=dry_run)
+        logger.info(f"Almacén revisado. Archivos: {stats['files']}, sin referencias {action}: {stats['removed']}, "
+                    f"errores: {stats['errors']}")
+
 
 if __name__ == "__main__":
-    cleanup_receipt_images()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Limpieza de imágenes de recibos")
+    parser.add_argument('--huerfanos', action='store_true',
+                        help="Conciliar la carpeta de recibos con la base de datos")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Con --huerfanos, solo mostrar lo que se eliminaría")
+    args = parser.parse_args()
+
+    if args.huerfanos:
+        reconcile_orphans(dry_run=args.dry_run)
+    else:
+        cleanup_receipt_images()
@@ -40,6 +40,9 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload size
     ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'jpg', 'jpeg', 'png'}
     
+    # Guardar también en disco (uploads/label_previews) las vistas previas de etiquetas
+    LABEL_PREVIEW_DISK_CACHE = True
+    
     # Configuración para limpieza de imágenes
     RECEIPT_IMAGES_RETENTION_DAYS = 10  # Días antes de eliminar las imágenes de recibos
     
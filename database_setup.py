@@ -756,7 +756,11 @@ CREATE TABLE IF NOT EXISTS product_labels (
     expiry_date DATE NOT NULL,
     product_id INTEGER REFERENCES products(id) NOT NULL,
     local_user_id INTEGER REFERENCES local_users(id) NOT NULL,
-    conservation_type VARCHAR(50) NOT NULL
+    conservation_type VARCHAR(50) NOT NULL,
+    quantity INTEGER NOT NULL DEFAULT 1,
+    first_sequence INTEGER,
+    last_sequence INTEGER,
+    template_id INTEGER REFERENCES label_templates(id) ON DELETE SET NULL
 );
 
 -- Índices para mejora de rendimiento
@@ -772,6 +776,7 @@ CREATE INDEX IF NOT EXISTS idx_task_instances_status ON task_instances(status);
 CREATE INDEX IF NOT EXISTS idx_tasks_location ON tasks(location_id);
 CREATE INDEX IF NOT EXISTS idx_tasks_group ON tasks(group_id);
 CREATE INDEX IF NOT EXISTS idx_products_location ON products(location_id);
+CREATE INDEX IF NOT EXISTS idx_product_labels_product_expiry ON product_labels(product_id, expiry_date);
 """
         
         # Ejecutar el script SQL para crear las tablas
@@ -919,8 +924,8 @@ def import_data_from_backup(config):
             "task_instances",
             "task_completions",
             "product_conservations",
-            "product_labels",
             "label_templates",
+            "product_labels",
             "activity_logs"
         ]
         
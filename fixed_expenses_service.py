@@ -0,0 +1,300 @@
+"""Servicio de gastos fijos mensuales como proceso independiente.
+
+Este módulo proporciona funciones para iniciar un hilo (thread) que añade al
+mes actual los gastos fijos activos de todas las empresas (ver
+utils_monthly_expenses.materialize_fixed_expenses): al iniciarse el servicio y
+después el día 1 de cada mes a las 03:00 AM. Crear los gastos es idempotente,
+así que un reinicio no duplica nada y un mes que no se completó (servicio
+detenido el día 1, error de base de datos...) se completa en cuanto se pueda.
+"""
+import threading
+import time
+import logging
+import os
+import fcntl
+import socket
+from datetime import datetime, timedelta
+from app import db
+from utils_monthly_expenses import materialize_fixed_expenses
+
+# Configuración de logging
+logging.basicConfig(level=logging.INFO, 
+                   format='[%(asctime)s] [%(levelname)s] %(message)s',
+                   datefmt='%Y-%m-%d %H:%M:%S')
+logger = logging.getLogger(__name__)
+
+# Archivo de bloqueo para evitar múltiples instancias
+LOCK_FILE = "/tmp/fixed_expenses_service.lock"
+
+# Hora del día 1 de cada mes para crear los gastos fijos (formato 24h)
+RUN_HOUR = 3  # 03:00 AM
+RUN_MINUTE = 0
+
+# Tiempo entre reintentos si no se pudieron crear los gastos del mes (en segundos)
+RETRY_INTERVAL = 60 * 60
+
+# Variables globales para controlar el estado del servicio
+service_thread = None
+service_running = False
+last_run_time = None
+service_active = False
+last_materialized_month = None
+lock_file_handle = None
+
+
+def materialize_current_month():
+    """
+    Añade al mes actual los gastos fijos activos que aún no tiene.
+    
+    Returns:
+        int: Número de gastos mensuales creados
+    """
+    global last_materialized_month
+    
+    today = datetime.now().date()
+    try:
+        created = materialize_fixed_expenses((today.year, today.month))
+        db.session.commit()
+        last_materialized_month = (today.year, today.month)
+        return created
+    except Exception as e:
+        logger.error(f"Error al crear los gastos fijos del mes: {str(e)}")
+        db.session.rollback()
+        return 0
+
+
+def should_run_materialization():
+    """
+    Determina si es momento de crear los gastos fijos del mes.
+    Se ejecuta mientras el mes actual no se haya completado en este proceso,
+    sea el día que sea (también al iniciar el servicio).
+    
+    Returns:
+        bool: True si se deben crear los gastos fijos, False en caso contrario.
+    """
+    now = datetime.now()
+    return last_materialized_month != (now.year, now.month)
+
+
+def get_next_run_time(now=None):
+    """Fecha y hora de la próxima ejecución (día 1 a las RUN_HOUR:RUN_MINUTE)."""
+    now = now or datetime.now()
+    target_time = now.replace(day=1, hour=RUN_HOUR, minute=RUN_MINUTE, second=0, microsecond=0)
+    if now >= target_time:
+        # Día 1 del mes siguiente
+        target_time = (target_time + timedelta(days=32)).replace(day=1)
+    return target_time
+
+
+def calculate_sleep_time():
+    """
+    Calcula el tiempo que debe dormir el servicio hasta la próxima ejecución.
+    
+    Returns:
+        float: Tiempo en segundos hasta el día 1 del próximo mes a las 03:00 AM,
+        o hasta el próximo reintento si el mes actual no se pudo completar
+    """
+    sleep_time = (get_next_run_time() - datetime.now()).total_seconds()
+    if should_run_materialization():
+        sleep_time = min(sleep_time, RETRY_INTERVAL)
+    return max(1.0, sleep_time)
+
+
+def fixed_expenses_worker():
+    """
+    Función que crea los gastos fijos al inicio de cada mes.
+    """
+    global service_running, last_run_time, service_active, lock_file_handle
+    
+    # Importar la aplicación Flask
+    from app import create_app
+    app = create_app()
+    
+    logger.info("Iniciando servicio de gastos fijos mensuales")
+    service_active = True
+    
+    try:
+        while service_running:
+            try:
+                if should_run_materialization():
+                    logger.info("Creando los gastos fijos pendientes del mes")
+                    
+                    # Usar el contexto de la aplicación para operaciones de base de datos
+                    with app.app_context():
+                        created = materialize_current_month()
+                        logger.info(f"Gastos fijos creados para el mes: {created}")
+                else:
+                    logger.debug("No es momento de crear los gastos fijos del mes")
+                
+                # Actualizar el tiempo de la última ejecución
+                last_run_time = datetime.now()
+                
+                # Dormir hasta el próximo inicio de mes (o hasta reintentar)
+                sleep_time = calculate_sleep_time()
+                next_check_time = datetime.now() + timedelta(seconds=sleep_time)
+                logger.info(f"Próxima verificación en {sleep_time/3600:.1f} horas ({next_check_time.strftime('%Y-%m-%d %H:%M:%S')})")
+                time.sleep(sleep_time)
+                
+            except Exception as e:
+                logger.error(f"Error durante la ejecución del servicio de gastos fijos: {str(e)}")
+                # Dormir 1 hora en caso de error
+                time.sleep(60 * 60)
+    
+    except Exception as e:
+        logger.error(f"Error fatal en el servicio de gastos fijos: {str(e)}")
+    finally:
+        service_active = False
+        
+        # Liberar el archivo de bloqueo al finalizar
+        if lock_file_handle:
+            try:
+                logger.info("Liberando archivo de bloqueo al finalizar worker")
+                fcntl.lockf(lock_file_handle, fcntl.LOCK_UN)
+                lock_file_handle.close()
+                lock_file_handle = None
+            except Exception as e:
+                logger.error(f"Error al liberar bloqueo en worker: {str(e)}")
+                
+        logger.info("Servicio de gastos fijos mensuales detenido")
+
+
+def start_fixed_expenses_service():
+    """
+    Inicia el servicio de gastos fijos mensuales en un hilo separado.
+    Utiliza un archivo de bloqueo para evitar múltiples ejecuciones con varios workers.
+    
+    Returns:
+        bool: True si el servicio se inició correctamente, False en caso contrario.
+    """
+    global service_thread, service_running, service_active, lock_file_handle
+    
+    # Verificar si ya hay una instancia en ejecución (incluso en otro worker)
+    try:
+        # Intentar obtener un bloqueo exclusivo (no bloqueante)
+        lock_file_handle = open(LOCK_FILE, 'w')
+        fcntl.lockf(lock_file_handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        
+        # Escribir información en el archivo de bloqueo
+        pid = os.getpid()
+        host = socket.gethostname()
+        lock_info = f"{pid}@{host} {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}"
+        lock_file_handle.write(lock_info)
+        lock_file_handle.flush()
+        
+        logger.info(f"Adquirido bloqueo exclusivo para el servicio (PID: {pid})")
+    except IOError:
+        # No se pudo obtener el bloqueo, otro proceso ya lo tiene
+        logger.info("Otra instancia del servicio ya está en ejecución")
+        return False
+        
+    if service_thread is not None and service_thread.is_alive():
+        logger.info("El servicio de gastos fijos ya está en ejecución en este worker")
+        return False
+    
+    # Si el hilo anterior existe pero está muerto, limpiar la referencia
+    if service_thread is not None and not service_thread.is_alive():
+        service_thread = None
+        logger.warning("Se detectó un hilo anterior muerto - Limpiando referencia")
+    
+    # Iniciar el servicio
+    service_running = True
+    service_thread = threading.Thread(target=fixed_expenses_worker, daemon=True)
+    service_thread.start()
+    
+    # Esperar a que el servicio se inicie completamente
+    timeout = 5  # 5 segundos máximo de espera
+    start_time = time.time()
+    while not service_active and time.time() - start_time < timeout:
+        time.sleep(0.1)
+    
+    if service_active:
+        logger.info("Servicio de gastos fijos mensuales iniciado correctamente")
+        return True
+    else:
+        logger.error("No se pudo iniciar el servicio de gastos fijos mensuales")
+        # Liberar el bloqueo
+        if lock_file_handle:
+            fcntl.lockf(lock_file_handle, fcntl.LOCK_UN)
+            lock_file_handle.close()
+            lock_file_handle = None
+        return False
+
+
+def stop_fixed_expenses_service():
+    """
+    Detiene el servicio de gastos fijos mensuales.
+    Libera el archivo de bloqueo si está en uso.
+    
+    Returns:
+        bool: True si el servicio se detuvo correctamente, False en caso contrario.
+    """
+    global service_thread, service_running, service_active, lock_file_handle
+    
+    if service_thread is None or not service_thread.is_alive():
+        logger.info("El servicio de gastos fijos no está en ejecución")
+        service_running = False
+        service_active = False
+        
+        # Liberar el bloqueo si está activo
+        if lock_file_handle:
+            try:
+                logger.info("Liberando archivo de bloqueo")
+                fcntl.lockf(lock_file_handle, fcntl.LOCK_UN)
+                lock_file_handle.close()
+                lock_file_handle = None
+            except Exception as e:
+                logger.error(f"Error al liberar bloqueo: {str(e)}")
+        return False
+    
+    # Detener el hilo
+    service_running = False
+    
+    # Esperar a que el hilo termine
+    timeout = 5  # 5 segundos máximo de espera
+    start_time = time.time()
+    while service_active and time.time() - start_time < timeout:
+        time.sleep(0.1)
+    
+    # Liberar el bloqueo si está activo
+    if lock_file_handle:
+        try:
+            logger.info("Liberando archivo de bloqueo")
+            fcntl.lockf(lock_file_handle, fcntl.LOCK_UN)
+            lock_file_handle.close()
+            lock_file_handle = None
+        except Exception as e:
+            logger.error(f"Error al liberar bloqueo: {str(e)}")
+            
+    if not service_active:
+        logger.info("Servicio de gastos fijos detenido correctamente")
+        return True
+    else:
+        logger.warning("No se pudo detener el servicio correctamente")
+        return False
+
+
+def get_service_status():
+    """
+    Obtiene el estado actual del servicio de gastos fijos mensuales.
+    
+    Returns:
+        dict: Diccionario con información sobre el estado del servicio.
+    """
+    global service_thread, service_running, last_run_time, service_active, last_materialized_month
+    
+    is_alive = service_thread is not None and service_thread.is_alive()
+    
+    # Formatear los tiempos para mostrarlos de forma amigable
+    formatted_last_run = "No ejecutado aún" if last_run_time is None else last_run_time.strftime('%Y-%m-%d %H:%M:%S')
+    formatted_last_month = ("Ninguno aún" if last_materialized_month is None
+                            else f"{last_materialized_month[1]:02d}/{last_materialized_month[0]}")
+    
+    return {
+        'active': is_alive and service_active,
+        'running': service_running,
+        'last_run': formatted_last_run,
+        'next_run': get_next_run_time().strftime('%Y-%m-%d %H:%M:%S'),
+        'last_materialized_month': formatted_last_month,
+        'thread_alive': is_alive,
+        'run_time': f"día 1 {RUN_HOUR:02d}:{RUN_MINUTE:02d}"
+    }
@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Script para pasar los archivos subidos al almacén por contenido.
+
+Recorre los documentos de empleados, los recibos de gastos (imagen y
+miniatura) y las fotos de los usuarios locales que aún apuntan a su ruta
+anterior, guarda cada archivo en uploads/store/ por su hash SHA-256 (leyéndolo
+por bloques), suma su referencia y actualiza la ruta del registro. Los registros
+se procesan por lotes y cada lote se confirma por separado, así que el script
+puede interrumpirse y volver a ejecutarse. Los archivos anteriores se eliminan
+al terminar, una vez confirmados todos los lotes.
+
+Los archivos repetidos (p. ej. el mismo documento subido a dos empleados) quedan
+guardados una sola vez.
+
+Uso:
+  python migrate_uploads_to_storage.py [--dry-run] [--conservar]
+"""
+
+import argparse
+import logging
+import os
+
+from app import create_app, db
+from models import EmployeeDocument
+from models_monthly_expenses import MonthlyExpense
+from models_tasks import LocalUser
+from utils_storage import STORAGE_FOLDER, resolve_upload_path, storage_relative_path, store_local_file
+
+# Configurar logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger('uploads_migration')
+
+# Registros por lote (se confirma cada lote)
+BATCH_SIZE = 200
+
+# Columnas con rutas de archivos subidos: (modelo, columna de la ruta, columna del tipo de contenido)
+UPLOAD_COLUMNS = (
+    (EmployeeDocument, 'file_path', 'file_type'),
+    (MonthlyExpense, 'receipt_image', None),
+    (MonthlyExpense, 'receipt_thumbnail', None),
+    (LocalUser, 'photo_path', None),
+)
+
+
+def migrate_column(model, path_column, type_column, upload_folder, dry_run=False):
+    """
+    Pasa al almacén los archivos de una columna.
+
+    Returns:
+        tuple: (estadísticas, rutas absolutas de los archivos anteriores ya migrados)
+    """
+    path_attr = getattr(model, path_column)
+    columns = [model.id, path_attr]
+    if type_column:
+        columns.append(getattr(model, type_column))
+
+    stats = {'rows': 0, 'migrated': 0, 'missing': 0, 'bytes': 0}
+    legacy_paths = set()
+    last_id = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select(*columns)
+            .where(path_attr.isnot(None), path_attr != '',
+                   ~path_attr.like(f"{STORAGE_FOLDER}/%"), model.id > last_id)
+            .order_by(model.id)
+            .limit(BATCH_SIZE)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        stats['rows'] += len(rows)
+
+        updates = []
+        for row in rows:
+            full_path = resolve_upload_path(row[1], upload_folder)
+            if not os.path.isfile(full_path):
+                logger.warning(f"{model.__tablename__}.{path_column} {row[0]}: no existe {row[1]}")
+                stats['missing'] += 1
+                continue
+            stats['bytes'] += os.path.getsize(full_path)
+            if dry_run:
+                stats['migrated'] += 1
+                continue
+
+            content_type = row[2] if type_column else None
+            stored = store_local_file(full_path, content_type, upload_folder=upload_folder)
+            updates.append({'id': row[0], path_column: storage_relative_path(stored.sha256)})
+            legacy_paths.add(full_path)
+
+        if updates:
+            db.session.execute(db.update(model), updates)
+            db.session.commit()
+            stats['migrated'] += len(updates)
+
+    return stats, legacy_paths
+
+
+def migrate_uploads(dry_run=False, keep_files=False):
+    """
+    Pasa al almacén por contenido todos los archivos subidos con rutas anteriores.
+    """
+    app = create_app()
+    with app.app_context():
+        upload_folder = app.config['UPLOAD_FOLDER']
+        logger.info("Iniciando migración de archivos subidos al almacén" + (" (simulación)" if dry_run else ""))
+
+        legacy_paths = set()
+        for model, path_column, type_column in UPLOAD_COLUMNS:
+            try:
+                stats, paths = migrate_column(model, path_column, type_column, upload_folder, dry_run=dry_run)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error al migrar {model.__tablename__}.{path_column}: {str(e)}")
+                raise
+            legacy_paths |= paths
+            logger.info(f"{model.__tablename__}.{path_column}: {stats['migrated']} de {stats['rows']} migrados, "
+                        f"{stats['missing']} sin archivo, {stats['bytes']} bytes")
+
+        if dry_run or keep_files:
+            return
+
+        # Un mismo archivo anterior puede estar referenciado varias veces: se elimina al final
+        removed = 0
+        for path in legacy_paths:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError as e:
+                logger.error(f"Error al eliminar el archivo {path}: {str(e)}")
+        logger.info(f"Migración completada. Archivos anteriores eliminados: {removed}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Migración de archivos subidos al almacén por contenido")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Solo mostrar lo que se migraría")
+    parser.add_argument('--conservar', action='store_true',
+                        help="No eliminar los archivos anteriores después de migrarlos")
+    args = parser.parse_args()
+
+    migrate_uploads(dry_run=args.dry_run, keep_files=args.conservar)
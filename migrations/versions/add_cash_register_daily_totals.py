@@ -0,0 +1,84 @@
+"""add cash register daily totals
+
+Revision ID: e8a2c4f6b1d3
+Revises: d3f7b9c1e2a4
+Create Date: 2025-06-13 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e8a2c4f6b1d3'
+down_revision = 'd3f7b9c1e2a4'
+branch_labels = None
+depends_on = None
+
+AMOUNT_COLUMNS = (
+    'total_amount', 'cash_amount', 'card_amount', 'delivery_cash_amount',
+    'delivery_online_amount', 'check_amount', 'expenses_amount', 'vat_amount', 'net_amount'
+)
+
+# Filas que se insertan en cada bloque al rellenar la tabla
+CHUNK_SIZE = 5000
+
+
+def _fill_daily_totals(bind, daily_totals):
+    """Agrupa los arqueos existentes por empresa y día."""
+    registers = sa.table('cash_registers',
+                         sa.column('id', sa.Integer),
+                         sa.column('company_id', sa.Integer),
+                         sa.column('date', sa.Date),
+                         *[sa.column(column, sa.Float) for column in AMOUNT_COLUMNS])
+
+    result = bind.execute(
+        sa.select(registers.c.company_id, registers.c.date, sa.func.count(registers.c.id),
+                  *[sa.func.coalesce(sa.func.sum(registers.c[column]), 0.0) for column in AMOUNT_COLUMNS])
+        .group_by(registers.c.company_id, registers.c.date)
+    )
+
+    chunk = []
+    for row in result:
+        company_id, day, registers_count = row[0], row[1], row[2]
+        iso_year, week_number, _ = day.isocalendar()
+        values = {'company_id': company_id, 'date': day, 'year': day.year, 'month': day.month,
+                  'iso_year': iso_year, 'week_number': week_number, 'registers_count': registers_count}
+        values.update(zip(AMOUNT_COLUMNS, (float(amount or 0) for amount in row[3:])))
+        chunk.append(values)
+        if len(chunk) >= CHUNK_SIZE:
+            op.bulk_insert(daily_totals, chunk)
+            chunk = []
+    if chunk:
+        op.bulk_insert(daily_totals, chunk)
+
+
+def upgrade():
+    # Totales diarios por empresa: fuente de resúmenes, informes y series
+    daily_totals = op.create_table('cash_register_daily_totals',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=False),
+        sa.Column('date', sa.Date(), nullable=False),
+        sa.Column('year', sa.Integer(), nullable=False),
+        sa.Column('month', sa.Integer(), nullable=False),
+        sa.Column('iso_year', sa.Integer(), nullable=False),
+        sa.Column('week_number', sa.Integer(), nullable=False),
+        sa.Column('registers_count', sa.Integer(), nullable=False, server_default='0'),
+        *[sa.Column(column, sa.Float(), nullable=False, server_default='0') for column in AMOUNT_COLUMNS],
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('company_id', 'date', name='uq_cash_register_daily_total')
+    )
+    op.create_index('ix_cash_register_daily_totals_month', 'cash_register_daily_totals',
+                    ['company_id', 'year', 'month'], unique=False)
+    op.create_index('ix_cash_register_daily_totals_week', 'cash_register_daily_totals',
+                    ['company_id', 'iso_year', 'week_number'], unique=False)
+
+    _fill_daily_totals(op.get_bind(), daily_totals)
+
+
+def downgrade():
+    op.drop_index('ix_cash_register_daily_totals_week', table_name='cash_register_daily_totals')
+    op.drop_index('ix_cash_register_daily_totals_month', table_name='cash_register_daily_totals')
+    op.drop_table('cash_register_daily_totals')
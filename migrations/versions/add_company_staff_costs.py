@@ -0,0 +1,47 @@
+"""add company staff cost series
+
+Revision ID: f1c3e5a7b9d2
+Revises: e8a2c4f6b1d3
+Create Date: 2025-06-16 10:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f1c3e5a7b9d2'
+down_revision = 'e8a2c4f6b1d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Serie semanal y mensual de coste de personal por empresa
+    op.create_table('company_staff_costs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('company_id', sa.Integer(), nullable=False),
+        sa.Column('period_type', sa.String(length=10), nullable=False),
+        sa.Column('year', sa.Integer(), nullable=False),
+        sa.Column('period', sa.Integer(), nullable=False),
+        sa.Column('start_date', sa.Date(), nullable=False),
+        sa.Column('end_date', sa.Date(), nullable=False),
+        sa.Column('hours', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('hourly_cost', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('staff_cost', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('revenue', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('staff_cost_percentage', sa.Float(), nullable=False, server_default='0'),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.ForeignKeyConstraint(['company_id'], ['companies.id'], ondelete='CASCADE'),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('company_id', 'period_type', 'year', 'period', name='uq_company_staff_cost_period')
+    )
+    op.create_index('ix_company_staff_costs_series', 'company_staff_costs',
+                    ['company_id', 'period_type', 'start_date'], unique=False)
+
+    # La serie se rellena con rebuild_cash_register_summaries.py después de migrar
+
+
+def downgrade():
+    op.drop_index('ix_company_staff_costs_series', table_name='company_staff_costs')
+    op.drop_table('company_staff_costs')
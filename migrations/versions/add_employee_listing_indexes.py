@@ -0,0 +1,29 @@
+"""add indexes for the keyset-paginated employee listing
+
+Revision ID: a1c3e5f7b9d2
+Revises: f8c0e2a4b6d1
+Create Date: 2025-06-26 09:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a1c3e5f7b9d2'
+down_revision = 'f8c0e2a4b6d1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Orden del listado de empleados (apellidos, nombre, id): cada página se busca en el índice
+    op.create_index('ix_employees_name_order', 'employees',
+                    ['last_name', 'first_name', 'id'], unique=False)
+    op.create_index('ix_employees_company_name_order', 'employees',
+                    ['company_id', 'last_name', 'first_name', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_employees_company_name_order', table_name='employees')
+    op.drop_index('ix_employees_name_order', table_name='employees')
@@ -0,0 +1,75 @@
+"""add trigram indexes for the global search
+
+Revision ID: f8c0e2a4b6d1
+Revises: e4b6d8f0a2c5
+Create Date: 2025-06-25 10:15:00.000000
+
+"""
+import logging
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f8c0e2a4b6d1'
+down_revision = 'e4b6d8f0a2c5'
+branch_labels = None
+depends_on = None
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+# Texto buscable de cada tabla: debe coincidir con utils_global_search._search_document
+SEARCH_INDEXES = {
+    'ix_companies_search_trgm': ('companies', ('name', 'tax_id')),
+    'ix_employees_search_trgm': ('employees', ('first_name', 'last_name', 'dni')),
+    'ix_locations_search_trgm': ('locations', ('name', 'city')),
+    'ix_checkpoints_search_trgm': ('checkpoints', ('name', 'location')),
+    'ix_products_search_trgm': ('products', ('name',)),
+}
+
+
+def _document(columns):
+    return " || ' ' || ".join(f"coalesce({column}, '')" for column in columns)
+
+
+def upgrade():
+    bind = op.get_bind()
+    if bind.dialect.name != 'postgresql':
+        # Otros motores usan el índice en memoria de utils_global_search
+        return
+
+    # Las extensiones pueden requerir permisos de superusuario: sin ellas la búsqueda usa el índice en memoria
+    try:
+        with bind.begin_nested():
+            op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            op.execute('CREATE EXTENSION IF NOT EXISTS unaccent')
+    except sa.exc.DBAPIError as e:
+        logger.warning(f"No se pudieron crear las extensiones pg_trgm/unaccent: {e}")
+        return
+
+    # unaccent() no es inmutable (depende del diccionario configurado): se fija el diccionario para poder indexarla.
+    # La función y el diccionario se califican con el esquema de la extensión para que se resuelvan
+    # con cualquier search_path (índices, pg_dump/pg_restore)
+    schema = bind.execute(sa.text(
+        "SELECT n.nspname FROM pg_extension e JOIN pg_namespace n ON n.oid = e.extnamespace "
+        "WHERE e.extname = 'unaccent'"
+    )).scalar() or 'public'
+    schema = '"' + schema.replace('"', '""') + '"'
+    op.execute(f"""
+        CREATE OR REPLACE FUNCTION search_unaccent(text) RETURNS text AS $$
+            SELECT {schema}.unaccent('{schema}.unaccent'::regdictionary, $1)
+        $$ LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+    """)
+
+    for name, (table, columns) in SEARCH_INDEXES.items():
+        op.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} "
+                   f"USING gin (search_unaccent(lower({_document(columns)})) gin_trgm_ops)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        return
+    for name in SEARCH_INDEXES:
+        op.execute(f'DROP INDEX IF EXISTS {name}')
+    op.execute('DROP FUNCTION IF EXISTS search_unaccent(text)')
@@ -0,0 +1,51 @@
+"""link monthly expenses to their fixed expense
+
+Revision ID: b8e1d3f5a7c9
+Revises: a4d6f8b2c1e7
+Create Date: 2025-06-19 11:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b8e1d3f5a7c9'
+down_revision = 'a4d6f8b2c1e7'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Gasto fijo del que procede cada gasto mensual (antes se relacionaban por nombre)
+    op.add_column('monthly_expenses', sa.Column('fixed_expense_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_monthly_expenses_fixed_expense_id', 'monthly_expenses', 'fixed_expenses',
+                          ['fixed_expense_id'], ['id'], ondelete='SET NULL')
+
+    # Enlazar los gastos fijos ya creados con el gasto fijo del mismo nombre en la empresa
+    expenses = sa.table('monthly_expenses',
+                        sa.column('company_id', sa.Integer),
+                        sa.column('name', sa.String),
+                        sa.column('is_fixed', sa.Boolean),
+                        sa.column('fixed_expense_id', sa.Integer))
+    fixed = sa.table('fixed_expenses',
+                     sa.column('id', sa.Integer),
+                     sa.column('company_id', sa.Integer),
+                     sa.column('name', sa.String))
+    op.get_bind().execute(
+        expenses.update()
+        .where(expenses.c.is_fixed == sa.true(), expenses.c.fixed_expense_id.is_(None))
+        .values(fixed_expense_id=sa.select(sa.func.min(fixed.c.id))
+                .where(fixed.c.company_id == expenses.c.company_id, fixed.c.name == expenses.c.name)
+                .scalar_subquery())
+    )
+
+    # Índice para comprobar qué gastos fijos tiene ya cada mes
+    op.create_index('ix_monthly_expenses_fixed_period', 'monthly_expenses',
+                    ['fixed_expense_id', 'year', 'month'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_monthly_expenses_fixed_period', table_name='monthly_expenses')
+    op.drop_constraint('fk_monthly_expenses_fixed_expense_id', 'monthly_expenses', type_='foreignkey')
+    op.drop_column('monthly_expenses', 'fixed_expense_id')
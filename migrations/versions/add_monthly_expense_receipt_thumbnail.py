@@ -0,0 +1,25 @@
+"""add receipt thumbnail to monthly expenses
+
+Revision ID: c2f4a6e8d0b1
+Revises: b8e1d3f5a7c9
+Create Date: 2025-06-20 10:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c2f4a6e8d0b1'
+down_revision = 'b8e1d3f5a7c9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Miniatura del recibo para los listados (se genera al procesar la imagen)
+    op.add_column('monthly_expenses', sa.Column('receipt_thumbnail', sa.String(length=255), nullable=True))
+
+
+def downgrade():
+    op.drop_column('monthly_expenses', 'receipt_thumbnail')
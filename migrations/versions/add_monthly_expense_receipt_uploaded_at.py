@@ -0,0 +1,40 @@
+"""add receipt upload date to monthly expenses
+
+Revision ID: d6a8c0e2f4b3
+Revises: c2f4a6e8d0b1
+Create Date: 2025-06-21 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd6a8c0e2f4b3'
+down_revision = 'c2f4a6e8d0b1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Fecha de subida del recibo: la retención se decide desde la base de datos
+    op.add_column('monthly_expenses', sa.Column('receipt_uploaded_at', sa.DateTime(), nullable=True))
+
+    # Los recibos se suben al crear el gasto
+    expenses = sa.table('monthly_expenses',
+                        sa.column('receipt_image', sa.String),
+                        sa.column('receipt_uploaded_at', sa.DateTime),
+                        sa.column('created_at', sa.DateTime))
+    op.get_bind().execute(
+        expenses.update()
+        .where(expenses.c.receipt_image.isnot(None))
+        .values(receipt_uploaded_at=sa.func.coalesce(expenses.c.created_at, sa.func.current_timestamp()))
+    )
+
+    op.create_index('ix_monthly_expenses_receipt_uploaded_at', 'monthly_expenses',
+                    ['receipt_uploaded_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_monthly_expenses_receipt_uploaded_at', table_name='monthly_expenses')
+    op.drop_column('monthly_expenses', 'receipt_uploaded_at')
@@ -0,0 +1,55 @@
+"""add print jobs table
+
+Revision ID: b7c4e2f9a310
+Revises: a1b2c3d4e5f6
+Create Date: 2025-06-03 09:12:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7c4e2f9a310'
+down_revision = 'a1b2c3d4e5f6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Crear tabla para la cola de trabajos de impresión de etiquetas
+    op.create_table('print_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('status', sa.Enum('PENDIENTE', 'IMPRIMIENDO', 'COMPLETADO', 'ERROR', name='printjobstatus'), nullable=False),
+        sa.Column('description', sa.String(length=255), nullable=True),
+        sa.Column('pages_data', sa.Text(), nullable=False),
+        sa.Column('page_count', sa.Integer(), nullable=True),
+        sa.Column('label_count', sa.Integer(), nullable=True),
+        sa.Column('label_format', sa.String(length=20), nullable=True),
+        sa.Column('attempts', sa.Integer(), nullable=True),
+        sa.Column('total_attempts', sa.Integer(), nullable=True),
+        sa.Column('tried_printer_ids', sa.String(length=255), nullable=True),
+        sa.Column('next_attempt_at', sa.DateTime(), nullable=True),
+        sa.Column('last_error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.Column('updated_at', sa.DateTime(), nullable=True),
+        sa.Column('started_at', sa.DateTime(), nullable=True),
+        sa.Column('completed_at', sa.DateTime(), nullable=True),
+        sa.Column('printer_id', sa.Integer(), nullable=True),
+        sa.Column('location_id', sa.Integer(), nullable=False),
+        sa.Column('local_user_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['printer_id'], ['network_printers.id'], ),
+        sa.ForeignKeyConstraint(['location_id'], ['locations.id'], ),
+        sa.ForeignKeyConstraint(['local_user_id'], ['local_users.id'], ),
+        sa.PrimaryKeyConstraint('id')
+    )
+
+    # Índice para que cada hilo de impresora encuentre su siguiente trabajo
+    op.create_index('ix_print_jobs_printer_status', 'print_jobs',
+                    ['printer_id', 'status', 'next_attempt_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_print_jobs_printer_status', table_name='print_jobs')
+    op.drop_table('print_jobs')
+    sa.Enum(name='printjobstatus').drop(op.get_bind(), checkfirst=True)
@@ -0,0 +1,36 @@
+"""add content-addressed upload storage
+
+Revision ID: e4b6d8f0a2c5
+Revises: d6a8c0e2f4b3
+Create Date: 2025-06-23 11:00:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e4b6d8f0a2c5'
+down_revision = 'd6a8c0e2f4b3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Archivos subidos guardados por su hash, con su número de referencias
+    op.create_table('stored_files',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('sha256', sa.String(length=64), nullable=False),
+        sa.Column('size', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('content_type', sa.String(length=128), nullable=True),
+        sa.Column('ref_count', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('created_at', sa.DateTime(), nullable=True),
+        sa.PrimaryKeyConstraint('id'),
+        sa.UniqueConstraint('sha256', name='uq_stored_files_sha256')
+    )
+
+    # Los archivos existentes se pasan al almacén con migrate_uploads_to_storage.py
+
+
+def downgrade():
+    op.drop_table('stored_files')
@@ -0,0 +1,123 @@
+"""compact product labels into batches
+
+Revision ID: c5e8a1d2f4b6
+Revises: b7c4e2f9a310
+Create Date: 2025-06-09 10:30:00.000000
+
+"""
+from datetime import timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c5e8a1d2f4b6'
+down_revision = 'b7c4e2f9a310'
+branch_labels = None
+depends_on = None
+
+# Filas que se leen en cada bloque al compactar
+CHUNK_SIZE = 10000
+
+# Las etiquetas de un mismo lote se registraban en un bucle: filas consecutivas
+# con los mismos datos y creadas con pocos segundos de diferencia
+BATCH_WINDOW = timedelta(seconds=5)
+
+
+def _compact_existing_labels(bind):
+    """Agrupa las filas existentes (una por etiqueta) en un registro por lote."""
+    labels = sa.table('product_labels',
+                      sa.column('id', sa.Integer),
+                      sa.column('created_at', sa.DateTime),
+                      sa.column('expiry_date', sa.Date),
+                      sa.column('product_id', sa.Integer),
+                      sa.column('local_user_id', sa.Integer),
+                      sa.column('conservation_type', sa.String),
+                      sa.column('quantity', sa.Integer),
+                      sa.column('first_sequence', sa.Integer),
+                      sa.column('last_sequence', sa.Integer))
+
+    update_stmt = labels.update().where(labels.c.id == sa.bindparam('label_id')).values(
+        quantity=sa.bindparam('quantity'),
+        first_sequence=sa.bindparam('first_sequence'),
+        last_sequence=sa.bindparam('last_sequence'),
+    )
+
+    # Numeración correlativa por producto
+    sequences = {}
+    current = None
+    last_id = 0
+
+    def close_batch(batch, updates, deletes):
+        first = sequences.get(batch['product_id'], 0) + 1
+        last = first + len(batch['ids']) - 1
+        sequences[batch['product_id']] = last
+        updates.append({'label_id': batch['ids'][0], 'quantity': len(batch['ids']),
+                        'first_sequence': first, 'last_sequence': last})
+        deletes.extend(batch['ids'][1:])
+
+    while True:
+        rows = bind.execute(
+            sa.select(labels.c.id, labels.c.created_at, labels.c.expiry_date, labels.c.product_id,
+                      labels.c.local_user_id, labels.c.conservation_type)
+            .where(labels.c.id > last_id)
+            .order_by(labels.c.id)
+            .limit(CHUNK_SIZE)
+        ).fetchall()
+        if not rows:
+            break
+
+        updates = []
+        deletes = []
+        for row in rows:
+            key = (row.product_id, row.local_user_id, row.conservation_type, row.expiry_date)
+            if (current is not None and current['key'] == key and row.created_at and current['created_at']
+                    and row.created_at - current['created_at'] <= BATCH_WINDOW):
+                current['ids'].append(row.id)
+            else:
+                if current is not None:
+                    close_batch(current, updates, deletes)
+                current = {'key': key, 'product_id': row.product_id,
+                           'created_at': row.created_at, 'ids': [row.id]}
+        last_id = rows[-1].id
+
+        if updates:
+            bind.execute(update_stmt, updates)
+        for start in range(0, len(deletes), 1000):
+            bind.execute(labels.delete().where(labels.c.id.in_(deletes[start:start + 1000])))
+
+    if current is not None:
+        updates = []
+        deletes = []
+        close_batch(current, updates, deletes)
+        bind.execute(update_stmt, updates)
+        if deletes:
+            bind.execute(labels.delete().where(labels.c.id.in_(deletes)))
+
+
+def upgrade():
+    # Un registro por lote impreso en lugar de uno por etiqueta
+    op.add_column('product_labels', sa.Column('quantity', sa.Integer(), nullable=False, server_default='1'))
+    op.add_column('product_labels', sa.Column('first_sequence', sa.Integer(), nullable=True))
+    op.add_column('product_labels', sa.Column('last_sequence', sa.Integer(), nullable=True))
+    op.add_column('product_labels', sa.Column('template_id', sa.Integer(), nullable=True))
+    op.create_foreign_key('fk_product_labels_template_id', 'product_labels', 'label_templates',
+                          ['template_id'], ['id'], ondelete='SET NULL')
+
+    _compact_existing_labels(op.get_bind())
+
+    # Índice para las consultas de trazabilidad por producto y caducidad
+    op.create_index('ix_product_labels_product_expiry', 'product_labels',
+                    ['product_id', 'expiry_date'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_product_labels_product_expiry', table_name='product_labels')
+
+    # Los lotes no se vuelven a expandir: se conserva un registro por lote
+    op.drop_constraint('fk_product_labels_template_id', 'product_labels', type_='foreignkey')
+    op.drop_column('product_labels', 'template_id')
+    op.drop_column('product_labels', 'last_sequence')
+    op.drop_column('product_labels', 'first_sequence')
+    op.drop_column('product_labels', 'quantity')
@@ -0,0 +1,34 @@
+"""maintain cash register summaries on write
+
+Revision ID: d3f7b9c1e2a4
+Revises: c5e8a1d2f4b6
+Create Date: 2025-06-12 09:15:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd3f7b9c1e2a4'
+down_revision = 'c5e8a1d2f4b6'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Horas trabajadas guardadas en el resumen (el dashboard ya no las recalcula)
+    op.add_column('cash_register_summaries', sa.Column('weekly_hours', sa.Float(), nullable=False, server_default='0'))
+    op.add_column('cash_register_summaries', sa.Column('monthly_hours', sa.Float(), nullable=False, server_default='0'))
+
+    # Índice para los agregados por empresa y rango de fechas
+    op.create_index('ix_cash_registers_company_date', 'cash_registers', ['company_id', 'date'], unique=False)
+
+    # Los resúmenes existentes se calcularon con semanas no ISO: se regeneran con
+    # rebuild_cash_register_summaries.py después de migrar
+
+
+def downgrade():
+    op.drop_index('ix_cash_registers_company_date', table_name='cash_registers')
+    op.drop_column('cash_register_summaries', 'monthly_hours')
+    op.drop_column('cash_register_summaries', 'weekly_hours')
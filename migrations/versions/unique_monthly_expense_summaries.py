@@ -0,0 +1,72 @@
+"""unique monthly expense summaries
+
+Revision ID: a4d6f8b2c1e7
+Revises: f1c3e5a7b9d2
+Create Date: 2025-06-18 09:40:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a4d6f8b2c1e7'
+down_revision = 'f1c3e5a7b9d2'
+branch_labels = None
+depends_on = None
+
+
+def _rebuild_summaries(bind):
+    """Sustituye los resúmenes existentes (que podían estar duplicados o desfasados) por los calculados."""
+    expenses = sa.table('monthly_expenses',
+                        sa.column('id', sa.Integer),
+                        sa.column('company_id', sa.Integer),
+                        sa.column('year', sa.Integer),
+                        sa.column('month', sa.Integer),
+                        sa.column('amount', sa.Float),
+                        sa.column('is_fixed', sa.Boolean))
+    summaries = sa.table('monthly_expense_summaries',
+                         sa.column('company_id', sa.Integer),
+                         sa.column('year', sa.Integer),
+                         sa.column('month', sa.Integer),
+                         sa.column('fixed_expenses_total', sa.Float),
+                         sa.column('custom_expenses_total', sa.Float),
+                         sa.column('total_amount', sa.Float),
+                         sa.column('number_of_expenses', sa.Integer),
+                         sa.column('created_at', sa.DateTime),
+                         sa.column('updated_at', sa.DateTime))
+
+    fixed = sa.case((expenses.c.is_fixed == sa.true(), expenses.c.amount), else_=0.0)
+    custom = sa.case((expenses.c.is_fixed == sa.true(), 0.0), else_=expenses.c.amount)
+    totals = sa.select(
+        expenses.c.company_id, expenses.c.year, expenses.c.month,
+        sa.func.coalesce(sa.func.sum(fixed), 0.0),
+        sa.func.coalesce(sa.func.sum(custom), 0.0),
+        sa.func.coalesce(sa.func.sum(expenses.c.amount), 0.0),
+        sa.func.count(expenses.c.id),
+        sa.func.current_timestamp(),
+        sa.func.current_timestamp(),
+    ).group_by(expenses.c.company_id, expenses.c.year, expenses.c.month)
+
+    bind.execute(summaries.delete())
+    bind.execute(summaries.insert().from_select(
+        ['company_id', 'year', 'month', 'fixed_expenses_total', 'custom_expenses_total',
+         'total_amount', 'number_of_expenses', 'created_at', 'updated_at'],
+        totals
+    ))
+
+
+def upgrade():
+    # Los resúmenes se recalculan desde los gastos: un resumen por empresa y mes
+    _rebuild_summaries(op.get_bind())
+    op.create_unique_constraint('uq_monthly_expense_summary_period', 'monthly_expense_summaries',
+                                ['company_id', 'year', 'month'])
+
+    # Índice para los listados del mes y el recálculo agrupado por año y mes
+    op.create_index('ix_monthly_expenses_company_period', 'monthly_expenses',
+                    ['company_id', 'year', 'month'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_monthly_expenses_company_period', table_name='monthly_expenses')
+    op.drop_constraint('uq_monthly_expense_summary_period', 'monthly_expense_summaries', type_='unique')
@@ -2,7 +2,7 @@ from datetime import datetime, time, timedelta
 import enum
 import random
 from flask_login import UserMixin
-from sqlalchemy import Enum
+from sqlalchemy import Enum, Index
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from app import db, login_manager
@@ -207,6 +207,12 @@ class Employee(db.Model):
     check_ins = db.relationship('EmployeeCheckIn', back_populates='employee', cascade='all, delete-orphan')
     vacations = db.relationship('EmployeeVacation', back_populates='employee', cascade='all, delete-orphan')
     
+    __table_args__ = (
+        # Listados paginados por clave (utils.get_employees_page): todos y por empresa
+        Index('ix_employees_name_order', 'last_name', 'first_name', 'id'),
+        Index('ix_employees_company_name_order', 'company_id', 'last_name', 'first_name', 'id'),
+    )
+    
     def __repr__(self):
         return f'<Employee {self.first_name} {self.last_name}>'
         
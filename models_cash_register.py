@@ -7,7 +7,7 @@ resúmenes acumulados y tokens de acceso para empleados.
 
 import secrets
 from datetime import datetime, timedelta
-from sqlalchemy import Column, Integer, Float, String, Boolean, Date, Text, ForeignKey, UniqueConstraint
+from sqlalchemy import Column, Integer, Float, String, Boolean, Date, Text, ForeignKey, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from app import db
 
@@ -68,6 +68,11 @@ class CashRegister(db.Model):
     
     # Eliminada la restricción única para permitir múltiples arqueos por día
     
+    # Índice para los agregados por empresa y rango de fechas (resúmenes e informes)
+    __table_args__ = (
+        Index('ix_cash_registers_company_date', 'company_id', 'date'),
+    )
+    
     def __repr__(self):
         return f'<CashRegister {self.date} - {self.company.name if self.company else "Unknown"}>'
 
@@ -77,7 +82,11 @@ class CashRegisterSummary(db.Model):
     Modelo para los resúmenes acumulados de arqueos de caja.
     
     Almacena los totales acumulados semanales, mensuales y anuales para facilitar
-    la generación de informes y evitar recálculos.
+    la generación de informes y evitar recálculos. Se mantienen al guardar arqueos
+    y horas trabajadas (ver utils_cash_register.update_cash_register_summaries).
+    
+    La semana es ISO y se asigna al mes de su jueves; los acumulados mensual y
+    anual son los del mes y año naturales indicados en el resumen.
     """
     __tablename__ = 'cash_register_summaries'
     
@@ -106,6 +115,8 @@ class CashRegisterSummary(db.Model):
     monthly_net_amount = Column(Float, nullable=False, default=0.0)
     
     # Datos de coste de personal
+    weekly_hours = Column(Float, nullable=False, default=0.0)
+    monthly_hours = Column(Float, nullable=False, default=0.0)
     weekly_staff_cost = Column(Float, nullable=False, default=0.0)
     monthly_staff_cost = Column(Float, nullable=False, default=0.0)
     weekly_staff_cost_percentage = Column(Float, nullable=False, default=0.0)
@@ -128,6 +139,117 @@ class CashRegisterSummary(db.Model):
         return f'<CashRegisterSummary {self.company.name if self.company else "Unknown"} - W{self.week_number}/{self.month}/{self.year}>'
 
 
+class CashRegisterDailyTotal(db.Model):
+    """
+    Modelo para los totales diarios de arqueos de caja por empresa.
+    
+    Tabla de agregados (un registro por empresa y día con arqueos) con todos los
+    importes por método de pago, IVA y neto. Se mantiene al guardar arqueos y es
+    la fuente de los resúmenes, informes y series para gráficos, que así suman
+    como mucho un registro por día en lugar de todos los arqueos.
+    """
+    __tablename__ = 'cash_register_daily_totals'
+    
+    id = Column(Integer, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), nullable=False)
+    date = Column(Date, nullable=False)
+    
+    # Periodos del día (desnormalizados para agrupar sin funciones de fecha)
+    year = Column(Integer, nullable=False)
+    month = Column(Integer, nullable=False)
+    iso_year = Column(Integer, nullable=False)
+    week_number = Column(Integer, nullable=False)
+    
+    # Número de arqueos del día
+    registers_count = Column(Integer, nullable=False, default=0)
+    
+    # Totales del día
+    total_amount = Column(Float, nullable=False, default=0.0)
+    cash_amount = Column(Float, nullable=False, default=0.0)
+    card_amount = Column(Float, nullable=False, default=0.0)
+    delivery_cash_amount = Column(Float, nullable=False, default=0.0)
+    delivery_online_amount = Column(Float, nullable=False, default=0.0)
+    check_amount = Column(Float, nullable=False, default=0.0)
+    expenses_amount = Column(Float, nullable=False, default=0.0)
+    vat_amount = Column(Float, nullable=False, default=0.0)
+    net_amount = Column(Float, nullable=False, default=0.0)
+    
+    updated_at = Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('company_id', 'date', name='uq_cash_register_daily_total'),
+        Index('ix_cash_register_daily_totals_month', 'company_id', 'year', 'month'),
+        Index('ix_cash_register_daily_totals_week', 'company_id', 'iso_year', 'week_number'),
+    )
+    
+    # Columnas de importes, en el mismo orden y con el mismo nombre que en CashRegister
+    AMOUNT_COLUMNS = (
+        'total_amount', 'cash_amount', 'card_amount', 'delivery_cash_amount',
+        'delivery_online_amount', 'check_amount', 'expenses_amount', 'vat_amount', 'net_amount'
+    )
+    
+    def __repr__(self):
+        return f'<CashRegisterDailyTotal {self.company_id} - {self.date}: {self.total_amount}>'
+
+
+class CompanyStaffCost(db.Model):
+    """
+    Modelo para la serie de coste de personal de una empresa.
+    
+    Un registro por empresa y semana ISO o mes natural con las horas trabajadas
+    (de company_work_hours), su coste, los ingresos de los arqueos y el porcentaje
+    de coste sobre ingresos. Se mantiene al cambiar horas trabajadas o arqueos,
+    de modo que los gráficos y los informes leen la serie sin recalcularla.
+    """
+    __tablename__ = 'company_staff_costs'
+    
+    PERIOD_WEEK = 'week'
+    PERIOD_MONTH = 'month'
+    
+    id = Column(Integer, primary_key=True)
+    company_id = Column(Integer, ForeignKey('companies.id', ondelete='CASCADE'), nullable=False)
+    
+    # Periodo: semana ISO (year = año ISO) o mes natural
+    period_type = Column(String(10), nullable=False)
+    year = Column(Integer, nullable=False)
+    period = Column(Integer, nullable=False)
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=False)
+    
+    # Datos del periodo
+    hours = Column(Float, nullable=False, default=0.0)
+    hourly_cost = Column(Float, nullable=False, default=0.0)
+    staff_cost = Column(Float, nullable=False, default=0.0)
+    revenue = Column(Float, nullable=False, default=0.0)
+    staff_cost_percentage = Column(Float, nullable=False, default=0.0)
+    
+    updated_at = Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        UniqueConstraint('company_id', 'period_type', 'year', 'period', name='uq_company_staff_cost_period'),
+        Index('ix_company_staff_costs_series', 'company_id', 'period_type', 'start_date'),
+    )
+    
+    def to_dict(self):
+        """Punto de la serie para la API."""
+        if self.period_type == self.PERIOD_WEEK:
+            label = f"{self.year}-W{self.period:02d}"
+        else:
+            label = f"{self.year}-{self.period:02d}"
+        return {
+            'period': label,
+            'start_date': self.start_date.isoformat(),
+            'end_date': self.end_date.isoformat(),
+            'hours': round(self.hours, 2),
+            'staff_cost': round(self.staff_cost, 2),
+            'revenue': round(self.revenue, 2),
+            'staff_cost_percentage': round(self.staff_cost_percentage, 2)
+        }
+    
+    def __repr__(self):
+        return f'<CompanyStaffCost {self.company_id} - {self.period_type} {self.period}/{self.year}: {self.staff_cost_percentage:.1f}%>'
+
+
 class CashRegisterToken(db.Model):
     """
     Modelo para los tokens de acceso de empleados a arqueos de caja.
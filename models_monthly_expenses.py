@@ -9,7 +9,7 @@ import datetime
 import secrets
 import string
 from app import db
-from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Text, DateTime, func
+from sqlalchemy import Column, Integer, String, Float, Boolean, ForeignKey, Text, DateTime, Index, UniqueConstraint, func
 from sqlalchemy.orm import relationship
 
 class ExpenseCategory(db.Model):
@@ -81,10 +81,13 @@ class MonthlyExpense(db.Model):
     year = Column(Integer, nullable=False)
     month = Column(Integer, nullable=False)  # 1-12
     is_fixed = Column(Boolean, default=False)  # Indica si también es un gasto fijo
+    fixed_expense_id = Column(Integer, ForeignKey('fixed_expenses.id', ondelete='SET NULL'), nullable=True)  # Gasto fijo del que procede
     expense_date = Column(String(20), nullable=True)  # Fecha del gasto en formato DD-MM-YYYY
     submitted_by_employee = Column(Boolean, default=False)  # Indica si fue enviado por un empleado
     employee_name = Column(String(100), nullable=True)  # Nombre del empleado que reportó el gasto
     receipt_image = Column(String(255), nullable=True)  # Ruta a la imagen del recibo/factura (opcional)
+    receipt_thumbnail = Column(String(255), nullable=True)  # Miniatura del recibo para los listados
+    receipt_uploaded_at = Column(DateTime, nullable=True)  # Fecha de subida del recibo (para la retención)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow)
     
@@ -92,6 +95,15 @@ class MonthlyExpense(db.Model):
     company = relationship('Company', backref='monthly_expenses')
     category = relationship('ExpenseCategory', back_populates='monthly_expenses')
     
+    __table_args__ = (
+        # Listados del mes y recálculo de los resúmenes agrupando por año y mes
+        Index('ix_monthly_expenses_company_period', 'company_id', 'year', 'month'),
+        # Comprobación de gastos fijos ya creados en cada mes
+        Index('ix_monthly_expenses_fixed_period', 'fixed_expense_id', 'year', 'month'),
+        # Selección de recibos caducados
+        Index('ix_monthly_expenses_receipt_uploaded_at', 'receipt_uploaded_at'),
+    )
+    
     def __repr__(self):
         return f"<MonthlyExpense {self.name} - {self.month}/{self.year} - {self.amount}€>"
 
@@ -119,6 +131,11 @@ class MonthlyExpenseSummary(db.Model):
     # Relaciones
     company = relationship('Company', backref='monthly_expense_summaries')
     
+    __table_args__ = (
+        # Un resumen por empresa y mes (destino del INSERT ... ON CONFLICT)
+        UniqueConstraint('company_id', 'year', 'month', name='uq_monthly_expense_summary_period'),
+    )
+    
     def __repr__(self):
         return f"<MonthlyExpenseSummary {self.month}/{self.year} - {self.total_amount}€>"
 
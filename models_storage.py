@@ -0,0 +1,27 @@
+"""
+Modelos del almacenamiento de archivos subidos por contenido.
+
+Cada archivo se guarda una sola vez, con su hash SHA-256 como nombre, y se
+cuenta cuántos registros (documentos, recibos, fotos) lo referencian.
+"""
+from datetime import datetime
+
+from app import db
+
+
+class StoredFile(db.Model):
+    """Archivo del almacén por contenido y número de referencias."""
+    __tablename__ = 'stored_files'
+    __table_args__ = (
+        db.UniqueConstraint('sha256', name='uq_stored_files_sha256'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    sha256 = db.Column(db.String(64), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False, default=0)
+    content_type = db.Column(db.String(128), nullable=True)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<StoredFile {self.sha256[:12]} x{self.ref_count}>'
@@ -484,6 +484,15 @@ class ConservationType(enum.Enum):
     CALIENTE = "caliente"
     SECO = "seco"
 
+# Horas de validez por tipo cuando el producto no tiene configurada la conservación
+DEFAULT_CONSERVATION_HOURS = {
+    ConservationType.DESCONGELACION: 24,  # 1 día
+    ConservationType.REFRIGERACION: 72,   # 3 días
+    ConservationType.GASTRO: 48,          # 2 días
+    ConservationType.CALIENTE: 2,         # 2 horas
+    ConservationType.SECO: 720            # 30 días
+}
+
 class Product(db.Model):
     """Modelo para productos alimenticios que pueden ser etiquetados"""
     __tablename__ = 'products'
@@ -582,6 +591,55 @@ class PrinterType(enum.Enum):
     DIRECT_NETWORK = "direct_network"     # Conexión directa a impresora en red (Brother, etc)
     RASPBERRY_PI = "raspberry_pi"        # Conexión a Raspberry Pi que controla la impresora
 
+# Formato de etiqueta que acepta cada tipo de impresora (ver utils_labels.LABEL_FORMAT_*)
+PRINTER_LABEL_FORMATS = {
+    "DIRECT_NETWORK": "brother_raster",  # Comandos raster Brother de 1 bit
+    "RASPBERRY_PI": "png_1bit",          # PNG de 1 bit que la Raspberry Pi envía a CUPS
+}
+
+def probe_printer_status(ip_address, port, printer_type):
+    """
+    Comprueba si una impresora está en línea sin tocar la base de datos.
+    
+    Returns:
+        tuple: (en línea, texto de estado para last_status)
+    """
+    try:
+        # Si no hay puerto especificado, usar el puerto predeterminado según el tipo
+        if printer_type == "RASPBERRY_PI":
+            port_to_check = port if port else 5000  # Puerto predeterminado para Flask en Raspberry Pi
+        else:  # DIRECT_NETWORK
+            port_to_check = port if port else 80    # Puerto predeterminado para impresoras Brother
+        
+        # Intenta conectarse al puerto de la impresora
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.settimeout(2.0)  # Timeout de 2 segundos
+        result = s.connect_ex((ip_address, port_to_check))
+        s.close()
+        
+        if result != 0:
+            return False, "offline"
+        
+        # Para impresoras Raspberry Pi, verificar también el endpoint específico
+        if printer_type == "RASPBERRY_PI":
+            import requests
+            try:
+                # Verificar que el servicio está respondiendo correctamente
+                check_url = f"http://{ip_address}:{port_to_check}/status"
+                response = requests.get(check_url, timeout=3.0)
+                if response.status_code == 200:
+                    status_data = response.json()
+                    if status_data.get('success'):
+                        return True, "online: " + status_data.get('printer_status', 'ready')
+            except Exception as inner_e:
+                # La conexión TCP funciona pero el servicio no responde correctamente
+                return False, f"error in service: {str(inner_e)}"
+        
+        # Para impresoras de red directas, basta con la conexión TCP
+        return True, "online"
+    except Exception as e:
+        return False, f"error: {str(e)}"
+
 class NetworkPrinter(db.Model):
     """Modelo para almacenar las impresoras de red para imprimir etiquetas"""
     __tablename__ = 'network_printers'
@@ -629,54 +687,20 @@ class NetworkPrinter(db.Model):
             path = self.api_path if self.api_path else '/brother_d/printer/print'
             return f"http://{self.ip_address}:{port_to_use}{path}"
     
+    def get_label_format(self):
+        """Retorna el formato de etiqueta negociado según el tipo de impresora"""
+        return PRINTER_LABEL_FORMATS.get(self.printer_type or "DIRECT_NETWORK", "brother_raster")
+    
+    def send_label_payload(self, payload, timeout=10.0):
+        """Envía una carga de etiquetas (utils_labels.build_label_payload) a la impresora"""
+        from utils_labels import post_label_payload
+        return post_label_payload(self.get_full_url(), payload, timeout=timeout)
+    
     def check_status(self):
         """Verifica si la impresora está en línea"""
-        try:
-            # Intenta conectarse al puerto de la impresora
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.settimeout(2.0)  # Timeout de 2 segundos
-            
-            # Si no hay puerto especificado, usar el puerto predeterminado según el tipo
-            if self.printer_type == "RASPBERRY_PI":
-                port_to_check = self.port if self.port else 5000  # Puerto predeterminado para Flask en Raspberry Pi
-            else:  # DIRECT_NETWORK
-                port_to_check = self.port if self.port else 80    # Puerto predeterminado para impresoras Brother
-            
-            result = s.connect_ex((self.ip_address, port_to_check))
-            s.close()
-            
-            if result == 0:
-                # Para impresoras Raspberry Pi, verificar también el endpoint específico
-                if self.printer_type == "RASPBERRY_PI":
-                    import requests
-                    try:
-                        # Verificar que el servicio está respondiendo correctamente
-                        check_url = f"http://{self.ip_address}:{port_to_check}/status"
-                        response = requests.get(check_url, timeout=3.0)
-                        if response.status_code == 200:
-                            status_data = response.json()
-                            if status_data.get('success'):
-                                self.last_status = "online: " + status_data.get('printer_status', 'ready')
-                                self.last_status_check = datetime.utcnow()
-                                return True
-                    except Exception as inner_e:
-                        # La conexión TCP funciona pero el servicio no responde correctamente
-                        self.last_status = f"error in service: {str(inner_e)}"
-                        self.last_status_check = datetime.utcnow()
-                        return False
-                
-                # Para impresoras de red directas, basta con la conexión TCP
-                self.last_status = "online"
-                self.last_status_check = datetime.utcnow()
-                return True
-            else:
-                self.last_status = "offline"
-                self.last_status_check = datetime.utcnow()
-                return False
-        except Exception as e:
-            self.last_status = f"error: {str(e)}"
-            self.last_status_check = datetime.utcnow()
-            return False
+        is_online, self.last_status = probe_printer_status(self.ip_address, self.port, self.printer_type)
+        self.last_status_check = datetime.utcnow()
+        return is_online
     
     def to_dict(self):
         return {
@@ -786,22 +810,61 @@ class LabelTemplate(db.Model):
         }
 
 class ProductLabel(db.Model):
-    """Modelo para registrar las etiquetas generadas"""
+    """Modelo para registrar las etiquetas generadas (un registro por lote impreso)"""
     __tablename__ = 'product_labels'
+    __table_args__ = (
+        # Trazabilidad: etiquetas de un producto que caducan en una fecha
+        db.Index('ix_product_labels_product_expiry', 'product_id', 'expiry_date'),
+    )
     
     id = db.Column(db.Integer, primary_key=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     expiry_date = db.Column(db.Date, nullable=False)
     
+    # Lote: número de etiquetas y su numeración correlativa por producto
+    quantity = db.Column(db.Integer, nullable=False, default=1)
+    first_sequence = db.Column(db.Integer)
+    last_sequence = db.Column(db.Integer)
+    
     # Relaciones
     product_id = db.Column(db.Integer, db.ForeignKey('products.id'), nullable=False)
     product = db.relationship('Product', back_populates='labels')
     local_user_id = db.Column(db.Integer, db.ForeignKey('local_users.id'), nullable=False)
     local_user = db.relationship('LocalUser', backref=db.backref('generated_labels', lazy=True))
     conservation_type = db.Column(Enum(ConservationType), nullable=False)
+    template_id = db.Column(db.Integer, db.ForeignKey('label_templates.id', ondelete='SET NULL'), nullable=True)
+    template = db.relationship('LabelTemplate')
     
     def __repr__(self):
-        return f'<ProductLabel {self.product.name} - {self.conservation_type.value} - {self.expiry_date}>'
+        return f'<ProductLabel {self.product.name} - {self.conservation_type.value} - {self.expiry_date} x{self.quantity}>'
+    
+    @classmethod
+    def record_batch(cls, product_id, local_user_id, conservation_type, expiry_date, quantity, template_id=None):
+        """
+        Registra un lote de etiquetas en un único registro, continuando la numeración del producto.
+        
+        El registro se añade a la sesión; el llamante es quien confirma la transacción.
+        La fila del producto queda bloqueada (SELECT ... FOR UPDATE) hasta entonces, así
+        que los lotes simultáneos del mismo producto se numeran uno detrás de otro.
+        """
+        db.session.query(Product.id).filter(Product.id == product_id).with_for_update().scalar()
+        last_sequence = db.session.query(db.func.max(cls.last_sequence)).filter(
+            cls.product_id == product_id
+        ).scalar() or 0
+        
+        label = cls(
+            product_id=product_id,
+            local_user_id=local_user_id,
+            conservation_type=conservation_type,
+            expiry_date=expiry_date,
+            quantity=quantity,
+            first_sequence=last_sequence + 1,
+            last_sequence=last_sequence + quantity,
+            template_id=template_id
+        )
+        db.session.add(label)
+        db.session.flush()
+        return label
     
     def to_dict(self):
         return {
@@ -812,5 +875,81 @@ class ProductLabel(db.Model):
             'local_user_name': self.local_user.name if self.local_user else None,
             'created_at': self.created_at.isoformat() if self.created_at else None,
             'expiry_date': self.expiry_date.isoformat() if self.expiry_date else None,
-            'conservation_type': self.conservation_type.value
-        }
\ No newline at end of file
+            'conservation_type': self.conservation_type.value,
+            'quantity': self.quantity,
+            'first_sequence': self.first_sequence,
+            'last_sequence': self.last_sequence,
+            'template_id': self.template_id
+        }
+
+class PrintJobStatus(enum.Enum):
+    PENDIENTE = "pendiente"
+    IMPRIMIENDO = "imprimiendo"
+    COMPLETADO = "completado"
+    ERROR = "error"
+
+class PrintJob(db.Model):
+    """Trabajo de impresión de etiquetas encolado para una impresora de red"""
+    __tablename__ = 'print_jobs'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(Enum(PrintJobStatus), default=PrintJobStatus.PENDIENTE, nullable=False)
+    description = db.Column(db.String(255))
+    
+    # Páginas del lote: JSON [{"content": PNG de 1 bit en base64, "copies": n}, ...]
+    # Se codifican en el formato de la impresora en el momento del envío
+    pages_data = db.Column(db.Text, nullable=False)
+    page_count = db.Column(db.Integer, default=0)
+    label_count = db.Column(db.Integer, default=0)
+    label_format = db.Column(db.String(20))  # Formato usado en el último envío
+    
+    # Reintentos: intentos con la impresora actual, intentos totales e impresoras ya probadas
+    attempts = db.Column(db.Integer, default=0)
+    total_attempts = db.Column(db.Integer, default=0)
+    tried_printer_ids = db.Column(db.String(255), default='')
+    next_attempt_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_error = db.Column(db.Text)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    completed_at = db.Column(db.DateTime)
+    
+    # Relaciones
+    printer_id = db.Column(db.Integer, db.ForeignKey('network_printers.id'), nullable=True)
+    printer = db.relationship('NetworkPrinter', backref=db.backref('print_jobs', lazy=True))
+    location_id = db.Column(db.Integer, db.ForeignKey('locations.id'), nullable=False)
+    location = db.relationship('Location')
+    local_user_id = db.Column(db.Integer, db.ForeignKey('local_users.id'), nullable=True)
+    local_user = db.relationship('LocalUser')
+    
+    __table_args__ = (
+        db.Index('ix_print_jobs_printer_status', 'printer_id', 'status', 'next_attempt_at'),
+    )
+    
+    def __repr__(self):
+        return f'<PrintJob {self.id} - {self.status.value}>'
+    
+    def get_tried_printer_ids(self):
+        """Retorna los ids de las impresoras con las que ya se ha intentado imprimir"""
+        return [int(pid) for pid in (self.tried_printer_ids or '').split(',') if pid]
+    
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'status': self.status.value if self.status else None,
+            'description': self.description,
+            'page_count': self.page_count,
+            'label_count': self.label_count,
+            'label_format': self.label_format,
+            'attempts': self.attempts,
+            'total_attempts': self.total_attempts,
+            'last_error': self.last_error,
+            'printer_id': self.printer_id,
+            'printer_name': self.printer.name if self.printer else None,
+            'location_id': self.location_id,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'next_attempt_at': self.next_attempt_at.isoformat() if self.next_attempt_at else None,
+            'started_at': self.started_at.isoformat() if self.started_at else None,
+            'completed_at': self.completed_at.isoformat() if self.completed_at else None
+        }
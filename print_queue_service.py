@@ -0,0 +1,396 @@
+"""
+Servicio de cola de impresión de etiquetas como proceso en segundo plano.
+
+Los trabajos se guardan en la tabla print_jobs y cada impresora de red activa tiene su
+propio hilo que los envía en orden. Si una impresora falla se reintenta con espera
+exponencial y, agotados los intentos, el trabajo pasa a la siguiente impresora activa
+del local. Así una impresora lenta o apagada no bloquea la petición HTTP ni al resto
+de impresoras.
+
+El reparto de trabajos se hace con una actualización condicional sobre la base de
+datos, por lo que varios procesos (workers de gunicorn) pueden ejecutar el servicio a
+la vez sin imprimir dos veces el mismo trabajo.
+"""
+import threading
+import logging
+from datetime import datetime, timedelta
+
+from app import db
+from models_tasks import NetworkPrinter, PrintJob, PrintJobStatus
+from utils_labels import (build_label_payload, deserialize_label_pages, serialize_label_pages)
+
+logger = logging.getLogger(__name__)
+
+# Intentos con una misma impresora antes de pasar a la siguiente del local
+MAX_ATTEMPTS_PER_PRINTER = 3
+
+# Espera entre reintentos (exponencial, en segundos)
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+
+# Intervalo de sondeo de cada impresora cuando no hay trabajos (en segundos)
+POLL_INTERVAL = 2
+
+# Intervalo para sincronizar los hilos con las impresoras activas (en segundos)
+PRINTER_SYNC_INTERVAL = 30
+
+# Tiempo tras el que un trabajo "imprimiendo" se considera abandonado (en segundos)
+STALE_JOB_TIMEOUT = 5 * 60
+
+# Timeout de cada envío a la impresora (en segundos)
+SEND_TIMEOUT = 10.0
+
+# Variables globales para controlar el estado del servicio
+service_app = None
+service_running = False
+manager_thread = None
+last_sync_time = None
+printer_workers = {}
+workers_lock = threading.Lock()
+manager_wake = threading.Event()
+
+
+class PrinterWorker:
+    """Hilo que envía los trabajos pendientes de una impresora."""
+
+    def __init__(self, printer_id):
+        self.printer_id = printer_id
+        self.running = True
+        self.wake = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True,
+                                       name=f"print-worker-{printer_id}")
+
+    def run(self):
+        logger.info(f"Iniciado hilo de impresión para la impresora {self.printer_id}")
+        while service_running and self.running:
+            processed = False
+            try:
+                with service_app.app_context():
+                    processed = process_next_print_job(self.printer_id)
+            except Exception as e:
+                logger.error(f"Error en el hilo de la impresora {self.printer_id}: {str(e)}")
+
+            if not processed:
+                self.wake.wait(POLL_INTERVAL)
+                self.wake.clear()
+        logger.info(f"Detenido hilo de impresión para la impresora {self.printer_id}")
+
+
+def get_retry_delay(attempts):
+    """Segundos de espera antes del siguiente intento (exponencial con tope)."""
+    return min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** max(0, attempts - 1))
+
+
+def enqueue_print_job(printer, pages, local_user_id=None, description=None):
+    """
+    Encola un lote de etiquetas para una impresora y devuelve el trabajo creado.
+
+    Args:
+        printer: Impresora de destino (NetworkPrinter)
+        pages: Lista de (imagen, copias) con las etiquetas del lote
+        local_user_id: Usuario local que solicita la impresión (opcional)
+        description: Descripción del trabajo (opcional)
+
+    Returns:
+        PrintJob: Trabajo de impresión guardado en la base de datos
+    """
+    job = PrintJob(
+        status=PrintJobStatus.PENDIENTE,
+        description=description,
+        pages_data=serialize_label_pages(pages),
+        page_count=len(pages),
+        label_count=sum(copies for _, copies in pages),
+        label_format=printer.get_label_format(),
+        printer_id=printer.id,
+        location_id=printer.location_id,
+        local_user_id=local_user_id,
+        tried_printer_ids=str(printer.id),
+        next_attempt_at=datetime.utcnow()
+    )
+    db.session.add(job)
+    db.session.commit()
+
+    # Arrancar el servicio en este proceso si aún no está en marcha
+    if not service_running:
+        from flask import current_app
+        start_print_queue_service(current_app._get_current_object())
+
+    notify_printer(printer.id)
+    return job
+
+
+def notify_printer(printer_id):
+    """Despierta el hilo de una impresora (o al gestor si aún no tiene hilo)."""
+    with workers_lock:
+        worker = printer_workers.get(printer_id)
+    if worker:
+        worker.wake.set()
+    else:
+        manager_wake.set()
+
+
+def claim_next_job(printer_id):
+    """
+    Reserva el siguiente trabajo pendiente de una impresora.
+
+    La reserva es una actualización condicional sobre el estado, de modo que si otro
+    proceso se adelanta la actualización no afecta a ninguna fila y se devuelve None.
+    """
+    now = datetime.utcnow()
+    job_id = db.session.query(PrintJob.id).filter(
+        PrintJob.printer_id == printer_id,
+        PrintJob.status == PrintJobStatus.PENDIENTE,
+        PrintJob.next_attempt_at <= now
+    ).order_by(PrintJob.created_at, PrintJob.id).limit(1).scalar()
+
+    if job_id is None:
+        return None
+
+    claimed = PrintJob.query.filter(
+        PrintJob.id == job_id,
+        PrintJob.status == PrintJobStatus.PENDIENTE
+    ).update({
+        PrintJob.status: PrintJobStatus.IMPRIMIENDO,
+        PrintJob.started_at: now
+    }, synchronize_session=False)
+    db.session.commit()
+
+    if claimed != 1:
+        return None
+    return db.session.get(PrintJob, job_id)
+
+
+def next_fallback_printer(job):
+    """
+    Devuelve la siguiente impresora activa del local que aún no se ha probado.
+
+    Las impresoras se recorren en orden (predeterminada primero) a partir de la actual.
+    """
+    printers = NetworkPrinter.query.filter_by(
+        location_id=job.location_id, is_active=True
+    ).order_by(NetworkPrinter.is_default.desc(), NetworkPrinter.id).all()
+
+    tried = set(job.get_tried_printer_ids())
+    if job.printer_id:
+        tried.add(job.printer_id)
+
+    ids = [printer.id for printer in printers]
+    start = ids.index(job.printer_id) + 1 if job.printer_id in ids else 0
+    for printer in printers[start:] + printers[:start]:
+        if printer.id not in tried:
+            return printer
+    return None
+
+
+def reassign_to_fallback(job, reason):
+    """Pasa el trabajo a la siguiente impresora del local o lo marca como fallido."""
+    fallback = next_fallback_printer(job)
+    if fallback is None:
+        job.status = PrintJobStatus.ERROR
+        job.completed_at = datetime.utcnow()
+        logger.warning(f"Trabajo de impresión {job.id} fallido sin impresoras alternativas: {reason}")
+        return None
+
+    logger.info(f"Trabajo de impresión {job.id} redirigido a la impresora {fallback.name} ({reason})")
+    job.printer_id = fallback.id
+    job.attempts = 0
+    job.status = PrintJobStatus.PENDIENTE
+    job.next_attempt_at = datetime.utcnow()
+    job.tried_printer_ids = ','.join(str(pid) for pid in job.get_tried_printer_ids() + [fallback.id])
+    return fallback
+
+
+def process_print_job(job):
+    """
+    Envía un trabajo ya reservado a su impresora y actualiza su estado.
+
+    Returns:
+        bool: True si la impresora aceptó el trabajo
+    """
+    printer = job.printer
+    sent = False
+    fallback = None
+
+    if printer is None or not printer.is_active:
+        message = "Impresora eliminada o desactivada"
+    else:
+        try:
+            payload = build_label_payload(deserialize_label_pages(job.pages_data),
+                                          printer.get_label_format())
+            job.label_format = payload.label_format
+            sent, message = printer.send_label_payload(payload, timeout=SEND_TIMEOUT)
+        except Exception as e:
+            message = f"Error al preparar el trabajo: {str(e)}"
+
+    job.total_attempts = (job.total_attempts or 0) + 1
+
+    if sent:
+        job.status = PrintJobStatus.COMPLETADO
+        job.completed_at = datetime.utcnow()
+        job.last_error = None
+        logger.info(f"Trabajo de impresión {job.id} enviado a {printer.name}: {message}")
+    else:
+        job.attempts = (job.attempts or 0) + 1
+        job.last_error = message
+        if printer is not None and printer.is_active and job.attempts < MAX_ATTEMPTS_PER_PRINTER:
+            delay = get_retry_delay(job.attempts)
+            job.status = PrintJobStatus.PENDIENTE
+            job.next_attempt_at = datetime.utcnow() + timedelta(seconds=delay)
+            logger.warning(f"Trabajo de impresión {job.id} fallido (intento {job.attempts}), "
+                           f"reintento en {delay}s: {message}")
+        else:
+            fallback = reassign_to_fallback(job, message)
+
+    db.session.commit()
+
+    if fallback is not None:
+        notify_printer(fallback.id)
+    return sent
+
+
+def process_next_print_job(printer_id):
+    """
+    Reserva y envía el siguiente trabajo pendiente de una impresora.
+
+    Returns:
+        bool: True si se procesó algún trabajo
+    """
+    job = claim_next_job(printer_id)
+    if job is None:
+        return False
+    process_print_job(job)
+    return True
+
+
+def recover_print_jobs():
+    """
+    Recupera trabajos abandonados y reasigna los de impresoras eliminadas o desactivadas.
+    """
+    stale_before = datetime.utcnow() - timedelta(seconds=STALE_JOB_TIMEOUT)
+    recovered = PrintJob.query.filter(
+        PrintJob.status == PrintJobStatus.IMPRIMIENDO,
+        PrintJob.started_at < stale_before
+    ).update({PrintJob.status: PrintJobStatus.PENDIENTE}, synchronize_session=False)
+    if recovered:
+        logger.warning(f"Recuperados {recovered} trabajos de impresión abandonados")
+
+    orphaned = PrintJob.query.outerjoin(NetworkPrinter, PrintJob.printer_id == NetworkPrinter.id).filter(
+        PrintJob.status == PrintJobStatus.PENDIENTE,
+        db.or_(NetworkPrinter.id.is_(None), NetworkPrinter.is_active == False)
+    ).all()
+    for job in orphaned:
+        reassign_to_fallback(job, "Impresora eliminada o desactivada")
+
+    db.session.commit()
+
+
+def sync_printer_workers():
+    """Arranca un hilo por cada impresora activa y detiene los de impresoras retiradas."""
+    active_ids = {printer_id for (printer_id,) in
+                  db.session.query(NetworkPrinter.id).filter(NetworkPrinter.is_active == True).all()}
+
+    with workers_lock:
+        for printer_id in list(printer_workers):
+            worker = printer_workers[printer_id]
+            if printer_id not in active_ids or not worker.thread.is_alive():
+                worker.running = False
+                worker.wake.set()
+                del printer_workers[printer_id]
+
+        for printer_id in active_ids - set(printer_workers):
+            worker = PrinterWorker(printer_id)
+            printer_workers[printer_id] = worker
+            worker.thread.start()
+
+
+def print_queue_manager_worker():
+    """
+    Función que mantiene un hilo por impresora y recupera trabajos abandonados.
+    """
+    global last_sync_time
+
+    logger.info("Iniciando servicio de cola de impresión")
+    while service_running:
+        try:
+            with service_app.app_context():
+                recover_print_jobs()
+                sync_printer_workers()
+            last_sync_time = datetime.now()
+        except Exception as e:
+            logger.error(f"Error en el gestor de la cola de impresión: {str(e)}")
+
+        manager_wake.wait(PRINTER_SYNC_INTERVAL)
+        manager_wake.clear()
+
+    with workers_lock:
+        for worker in printer_workers.values():
+            worker.running = False
+            worker.wake.set()
+        printer_workers.clear()
+    logger.info("Servicio de cola de impresión detenido")
+
+
+def start_print_queue_service(app=None):
+    """
+    Inicia el servicio de cola de impresión en un hilo separado.
+
+    Args:
+        app: Aplicación Flask (por defecto, la del contexto actual)
+
+    Returns:
+        bool: True si el servicio se inició correctamente, False si ya estaba en ejecución.
+    """
+    global service_app, service_running, manager_thread
+
+    if manager_thread is not None and manager_thread.is_alive():
+        logger.info("El servicio de cola de impresión ya está en ejecución")
+        return False
+
+    if app is None:
+        from flask import current_app
+        app = current_app._get_current_object()
+
+    service_app = app
+    service_running = True
+    manager_thread = threading.Thread(target=print_queue_manager_worker, daemon=True,
+                                      name="print-queue-manager")
+    manager_thread.start()
+    return True
+
+
+def stop_print_queue_service():
+    """
+    Detiene el servicio de cola de impresión y los hilos de todas las impresoras.
+
+    Returns:
+        bool: True si el servicio se detuvo correctamente, False en caso contrario.
+    """
+    global service_running
+
+    if manager_thread is None or not manager_thread.is_alive():
+        service_running = False
+        return False
+
+    service_running = False
+    manager_wake.set()
+    manager_thread.join(timeout=5)
+    return not manager_thread.is_alive()
+
+
+def get_service_status():
+    """
+    Obtiene el estado actual del servicio de cola de impresión.
+
+    Returns:
+        dict: Diccionario con información sobre el estado del servicio.
+    """
+    with workers_lock:
+        workers = sorted(printer_workers)
+
+    return {
+        'active': manager_thread is not None and manager_thread.is_alive(),
+        'running': service_running,
+        'printer_workers': workers,
+        'last_sync': last_sync_time.strftime('%Y-%m-%d %H:%M:%S') if last_sync_time else None,
+        'sync_interval_seconds': PRINTER_SYNC_INTERVAL
+    }
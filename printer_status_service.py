@@ -0,0 +1,177 @@
+"""
+Servicio de comprobación del estado de las impresoras de red en segundo plano.
+
+Cada cierto intervalo se comprueban todas las impresoras activas a la vez (un hilo
+por impresora en un ThreadPoolExecutor) y se guardan last_status y last_status_check
+en una sola actualización. Las vistas y la API leen ese estado guardado en lugar de
+abrir conexiones con las impresoras durante la petición; cuando se pide refrescar,
+la comprobación bajo demanda también se hace en paralelo.
+"""
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from sqlalchemy import update
+
+from app import db
+from models_tasks import NetworkPrinter, probe_printer_status
+
+logger = logging.getLogger(__name__)
+
+# Intervalo entre comprobaciones (en segundos)
+CHECK_INTERVAL = 60
+
+# Número máximo de impresoras que se comprueban a la vez
+MAX_CONCURRENT_PROBES = 32
+
+# Variables globales para controlar el estado del servicio
+service_app = None
+service_thread = None
+service_running = False
+last_run_time = None
+service_wake = threading.Event()
+
+
+def is_status_online(last_status):
+    """Indica si un estado guardado en last_status corresponde a una impresora en línea."""
+    return bool(last_status) and last_status.startswith('online')
+
+
+def refresh_printer_statuses(printer_ids=None, location_id=None, checked_before=None):
+    """
+    Comprueba en paralelo el estado de las impresoras activas y lo guarda en bloque.
+
+    Args:
+        printer_ids: Limitar la comprobación a estas impresoras (opcional)
+        location_id: Limitar la comprobación a las impresoras de una ubicación (opcional)
+        checked_before: Limitar la comprobación a las impresoras no comprobadas desde esta fecha (opcional)
+
+    Returns:
+        dict: id de impresora -> (en línea, estado, fecha de comprobación)
+    """
+    query = db.session.query(NetworkPrinter.id, NetworkPrinter.ip_address,
+                             NetworkPrinter.port, NetworkPrinter.printer_type)
+    if printer_ids is not None:
+        if not printer_ids:
+            return {}
+        query = query.filter(NetworkPrinter.id.in_(list(printer_ids)))
+    else:
+        query = query.filter(NetworkPrinter.is_active == True)
+    if location_id is not None:
+        query = query.filter(NetworkPrinter.location_id == location_id)
+    if checked_before is not None:
+        query = query.filter(db.or_(NetworkPrinter.last_status_check.is_(None),
+                                    NetworkPrinter.last_status_check < checked_before))
+
+    printers = query.all()
+    if not printers:
+        return {}
+
+    # Las comprobaciones no usan la sesión de base de datos, solo la red
+    workers = min(MAX_CONCURRENT_PROBES, len(printers))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='printer-probe') as executor:
+        probes = list(executor.map(
+            lambda printer: probe_printer_status(printer.ip_address, printer.port, printer.printer_type),
+            printers
+        ))
+
+    checked_at = datetime.utcnow()
+    results = {}
+    rows = []
+    for printer, (is_online, status) in zip(printers, probes):
+        results[printer.id] = (is_online, status, checked_at)
+        rows.append({'id': printer.id, 'last_status': status[:50], 'last_status_check': checked_at})
+
+    # Actualización en bloque por clave primaria
+    db.session.execute(update(NetworkPrinter), rows)
+    db.session.commit()
+    return results
+
+
+def printer_status_worker():
+    """
+    Función que comprueba periódicamente el estado de todas las impresoras activas.
+    """
+    global service_running, last_run_time
+
+    logger.info("Iniciando servicio de estado de impresoras")
+    while service_running:
+        try:
+            with service_app.app_context():
+                # Solo las impresoras que nadie (otro proceso o un refresco bajo demanda)
+                # ha comprobado recientemente; las demás se dejan para la siguiente vuelta
+                results = refresh_printer_statuses(
+                    checked_before=datetime.utcnow() - timedelta(seconds=CHECK_INTERVAL / 2))
+                if results:
+                    online = sum(1 for is_online, _, _ in results.values() if is_online)
+                    logger.info(f"Estado de impresoras actualizado: {online}/{len(results)} en línea")
+            last_run_time = datetime.now()
+        except Exception as e:
+            logger.error(f"Error al comprobar el estado de las impresoras: {str(e)}")
+
+        service_wake.wait(CHECK_INTERVAL)
+        service_wake.clear()
+
+    logger.info("Servicio de estado de impresoras detenido")
+
+
+def start_printer_status_service(app=None):
+    """
+    Inicia el servicio de estado de impresoras en un hilo separado.
+
+    Args:
+        app: Aplicación Flask (por defecto, la del contexto actual)
+
+    Returns:
+        bool: True si el servicio se inició correctamente, False si ya estaba en ejecución.
+    """
+    global service_app, service_thread, service_running
+
+    if service_thread is not None and service_thread.is_alive():
+        return False
+
+    if app is None:
+        from flask import current_app
+        app = current_app._get_current_object()
+
+    service_app = app
+    service_running = True
+    service_thread = threading.Thread(target=printer_status_worker, daemon=True,
+                                      name="printer-status")
+    service_thread.start()
+    return True
+
+
+def stop_printer_status_service():
+    """
+    Detiene el servicio de estado de impresoras.
+
+    Returns:
+        bool: True si el servicio se detuvo correctamente, False en caso contrario.
+    """
+    global service_running
+
+    if service_thread is None or not service_thread.is_alive():
+        service_running = False
+        return False
+
+    service_running = False
+    service_wake.set()
+    service_thread.join(timeout=5)
+    return not service_thread.is_alive()
+
+
+def get_service_status():
+    """
+    Obtiene el estado actual del servicio de estado de impresoras.
+
+    Returns:
+        dict: Diccionario con información sobre el estado del servicio.
+    """
+    return {
+        'active': service_thread is not None and service_thread.is_alive(),
+        'running': service_running,
+        'last_run': last_run_time.strftime('%Y-%m-%d %H:%M:%S') if last_run_time else None,
+        'check_interval_seconds': CHECK_INTERVAL
+    }
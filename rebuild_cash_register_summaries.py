@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Script para reconstruir los resúmenes de arqueos de caja.
+
+Los resúmenes se mantienen al guardar arqueos y horas trabajadas; este script
+regenera desde cero los totales diarios, la serie de coste de personal y los
+resúmenes semanales a partir de los arqueos y las horas trabajadas, por ejemplo
+después de migrar, de una importación masiva o de cambiar el coste por hora de
+una empresa.
+
+Uso:
+  python rebuild_cash_register_summaries.py             # todas las empresas
+  python rebuild_cash_register_summaries.py <company_id> [<company_id> ...]
+"""
+import logging
+import sys
+
+from app import create_app, db
+
+# Configurar logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s',
+    datefmt='%Y-%m-%d %H:%M:%S'
+)
+logger = logging.getLogger('cash_register_summaries')
+
+
+def main(company_ids=None):
+    """Reconstruye los resúmenes de las empresas indicadas (o de todas)."""
+    app = create_app()
+    with app.app_context():
+        from models import Company
+        from utils_cash_register import rebuild_cash_register_summaries
+
+        if not company_ids:
+            company_ids = [row[0] for row in db.session.query(Company.id).order_by(Company.id)]
+
+        for company_id in company_ids:
+            count = rebuild_cash_register_summaries(company_id)
+            logger.info(f"Empresa {company_id}: {count} resúmenes semanales")
+
+
+if __name__ == "__main__":
+    main([int(arg) for arg in sys.argv[1:]])
@@ -8,6 +8,7 @@ from flask_login import login_user, logout_user, login_required, current_user
 from urllib.parse import urlparse
 from werkzeug.utils import secure_filename
 from sqlalchemy import func, text
+from sqlalchemy.orm import selectinload
 
 from app import db
 from models import (User, Company, Employee, EmployeeDocument, EmployeeNote, UserRole, 
@@ -20,8 +21,14 @@ from forms import (LoginForm, RegistrationForm, UserUpdateForm, PasswordChangeFo
                   EmployeeVacationForm, GenerateCheckInsForm, ExportCheckInsForm)
 from utils import (save_file, log_employee_change, log_activity, can_manage_company, 
                   can_manage_employee, can_view_employee, get_dashboard_stats, generate_checkins_pdf,
-                  export_company_employees_zip, create_database_backup)
+                  export_company_employees_zip, create_database_backup, can_view_employee_record,
+                  invalidate_user_company_ids, get_user_company_ids, get_employees_page,
+                  EMPLOYEES_PER_PAGE, MAX_EMPLOYEES_PER_PAGE)
+from utils_global_search import global_search, load_results
+from utils_search_index import normalize_search_text
 from clean_database import clean_database
+from utils_excel import ExcelSheet, send_xlsx, EXPORT_YIELD_PER
+from utils_storage import send_stored_file, release_upload
 
 # Create blueprints
 auth_bp = Blueprint('auth', __name__)
@@ -212,55 +219,29 @@ def search():
     if not query:
         return redirect(url_for('main.dashboard'))
     
-    # Search for companies (admin and gerentes only)
-    companies = []
+    # Admin busca en todo; gerentes solo en sus empresas (búsqueda indexada y sin acentos)
+    results = {}
     if current_user.is_admin():
-        companies = Company.query.filter(
-            (Company.name.ilike(f'%{query}%')) |
-            (Company.tax_id.ilike(f'%{query}%'))
-        ).all()
-    elif current_user.is_gerente():
-        # Buscar solo entre las empresas del usuario
-        company_ids = [company.id for company in current_user.companies]
-        if company_ids:
-            companies = Company.query.filter(
-                Company.id.in_(company_ids)
-            ).filter(
-                (Company.name.ilike(f'%{query}%')) |
-                (Company.tax_id.ilike(f'%{query}%'))
-            ).all()
-    
-    # Search for employees based on user role
-    employees = []
-    if current_user.is_admin():
-        employees = Employee.query.filter(
-            (Employee.first_name.ilike(f'%{query}%')) |
-            (Employee.last_name.ilike(f'%{query}%')) |
-            (Employee.dni.ilike(f'%{query}%'))
-        ).all()
+        results = global_search(query)
     elif current_user.is_gerente():
-        # Buscar empleados de todas las empresas asignadas al gerente
-        company_ids = [company.id for company in current_user.companies]
-        if company_ids:
-            employees = Employee.query.filter(
-                Employee.company_id.in_(company_ids)
-            ).filter(
-                (Employee.first_name.ilike(f'%{query}%')) |
-                (Employee.last_name.ilike(f'%{query}%')) |
-                (Employee.dni.ilike(f'%{query}%'))
-            ).all()
-    elif current_user.is_empleado() and current_user.employee:
+        results = global_search(query, company_ids=get_user_company_ids(current_user))
+    
+    employees = load_results('employees', results.get('employees'))
+    if current_user.is_empleado() and current_user.employee:
         # Empleados can only see themselves in search results
-        if (query.lower() in current_user.employee.first_name.lower() or
-            query.lower() in current_user.employee.last_name.lower() or
-            query.lower() in current_user.employee.dni.lower()):
-            employees = [current_user.employee]
+        employee = current_user.employee
+        own_text = normalize_search_text(f'{employee.first_name} {employee.last_name} {employee.dni}')
+        if normalize_search_text(query) in own_text:
+            employees = [employee]
     
     return render_template('search_results.html', 
                           title='Resultados de Búsqueda',
                           query=query,
-                          companies=companies,
-                          employees=employees)
+                          companies=load_results('companies', results.get('companies')),
+                          employees=employees,
+                          locations=load_results('locations', results.get('locations')),
+                          checkpoints=load_results('checkpoints', results.get('checkpoints')),
+                          products=load_results('products', results.get('products')))
 
 # Company routes
 @company_bp.route('/')
@@ -603,31 +584,8 @@ def delete_company(slug):
 @employee_bp.route('/')
 @login_required
 def list_employees():
-    # Obtener parámetro de página, por defecto 1
-    page = request.args.get('page', 1, type=int)
-    per_page = 20  # Número de empleados por página
-    
-    # Preparar la consulta según el rol del usuario
-    if current_user.is_admin():
-        # Para administradores, usar paginación para evitar cargar todos los empleados a la vez
-        query = Employee.query.order_by(Employee.last_name, Employee.first_name)
-    
-    # Gerente puede ver solo empleados de sus empresas
-    elif current_user.is_gerente():
-        # Obtener IDs de todas las empresas asignadas al gerente
-        company_ids = [company.id for company in current_user.companies]
-        if company_ids:
-            query = Employee.query.filter(
-                Employee.company_id.in_(company_ids)
-            ).order_by(Employee.last_name, Employee.first_name)
-        else:
-            employees = []
-            employees_by_company = {}
-            return render_template('employee_list.html', title='Empleados', 
-                                  employees=employees, employees_by_company=employees_by_company, pagination=None)
-    
     # Empleado solo puede verse a sí mismo
-    elif current_user.is_empleado() and current_user.employee:
+    if current_user.is_empleado() and current_user.employee:
         # Para un solo empleado no necesitamos paginación
         employees = [current_user.employee]
         # Agrupar empleado por empresa para visualización consistente
@@ -635,17 +593,18 @@ def list_employees():
         employees_by_company = {company_name: [current_user.employee]}
         return render_template('employee_list.html', title='Empleados', 
                               employees=employees, employees_by_company=employees_by_company, pagination=None)
-    else:
-        employees = []
-        employees_by_company = {}
+    
+    company_ids = _employee_list_company_ids()
+    if company_ids is not None and not company_ids:
         return render_template('employee_list.html', title='Empleados', 
-                              employees=employees, employees_by_company=employees_by_company, pagination=None)
+                              employees=[], employees_by_company={}, pagination=None)
     
-    # Ejecutar consulta paginada
-    pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+    # Paginación por clave (apellidos, nombre, id): cada página cuesta lo mismo sea cual sea su profundidad
+    pagination = get_employees_page(company_ids, after=request.args.get('after'),
+                                    before=request.args.get('before'))
     employees = pagination.items
     
-    # Agrupar empleados por empresa
+    # Agrupar empleados por empresa (las empresas ya vienen cargadas en la misma consulta de la página)
     employees_by_company = {}
     for employee in employees:
         company_name = employee.company.name if employee.company else "Sin Empresa Asignada"
@@ -663,6 +622,42 @@ def list_employees():
                           employees_by_company=sorted_employees_by_company,
                           pagination=pagination)
 
+@employee_bp.route('/data')
+@login_required
+def list_employees_data():
+    """Página siguiente del listado de empleados en JSON (scroll infinito)."""
+    company_ids = _employee_list_company_ids()
+    if current_user.is_empleado() or (company_ids is not None and not company_ids):
+        return jsonify({'employees': [], 'next_cursor': None})
+    
+    per_page = max(1, min(request.args.get('per_page', EMPLOYEES_PER_PAGE, type=int), MAX_EMPLOYEES_PER_PAGE))
+    page = get_employees_page(company_ids, after=request.args.get('after'), per_page=per_page)
+    return jsonify({
+        'employees': [{
+            'id': employee.id,
+            'first_name': employee.first_name,
+            'last_name': employee.last_name,
+            'dni': employee.dni,
+            'position': employee.position,
+            'contract_type': employee.contract_type.name if employee.contract_type else None,
+            'start_date': employee.start_date,
+            'is_active': employee.is_active,
+            'company_id': employee.company_id,
+            'company_name': employee.company.name if employee.company else None,
+            'can_manage': current_user.is_admin() or (
+                current_user.is_gerente() and current_user.company_id == employee.company_id)
+        } for employee in page.items],
+        'next_cursor': page.next_cursor
+    })
+
+def _employee_list_company_ids():
+    """Empresas cuyos empleados puede listar el usuario (None para todas)."""
+    if current_user.is_admin():
+        return None
+    if current_user.is_gerente():
+        return get_user_company_ids(current_user)
+    return frozenset()
+
 @employee_bp.route('/<int:id>')
 @login_required
 def view_employee(id):
@@ -880,6 +875,9 @@ def edit_employee(id):
                             log_employee_change(employee, field, str(old_value) if old_value is not None else None, 
                                              str(new_value) if new_value is not None else None)
                 
+                # Guardar el historial (log_activity ya no confirma la sesión)
+                db.session.commit()
+                
                 # Verificar que los cambios se guardaron correctamente
                 db.session.refresh(employee)
                 
@@ -1040,6 +1038,9 @@ def manage_status(id):
                                           str(old_value) if old_value is not None else None, 
                                           str(new_value) if new_value is not None else None)
                 
+                # Guardar el historial (log_activity ya no confirma la sesión)
+                db.session.commit()
+                
                 # Registrar en el log
                 log_activity(f'Estado de empleado actualizado: {employee.first_name} {employee.last_name}')
                 flash(f'Estado del empleado "{employee.first_name} {employee.last_name}" actualizado correctamente.', 'success')
@@ -1121,20 +1122,31 @@ def upload_document(id):
 @employee_bp.route('/documents/<int:doc_id>')
 @login_required
 def download_document(doc_id):
-    document = EmployeeDocument.query.get_or_404(doc_id)
-    employee = Employee.query.get_or_404(document.employee_id)
+    # Documento y empresa/usuario del empleado en una consulta (sin cargar el empleado)
+    row = db.session.execute(
+        db.select(EmployeeDocument, Employee.company_id, Employee.user_id)
+        .join(Employee, Employee.id == EmployeeDocument.employee_id)
+        .where(EmployeeDocument.id == doc_id)
+    ).first()
+    if row is None:
+        abort(404)
+    document = row.EmployeeDocument
     
     # Check if user has permission to download this document
-    if not can_view_employee(employee):
+    if not can_view_employee_record(row.company_id, row.user_id):
         flash('No tienes permiso para descargar este documento.', 'danger')
         return redirect(url_for('employee.list_employees'))
     
-    log_activity(f'Documento descargado: {document.original_filename}')
-    return send_from_directory(
-        os.path.dirname(document.file_path),
-        os.path.basename(document.file_path),
+    # Las revalidaciones (304) y los rangos de una misma descarga no se registran
+    if request.method == 'GET' and not request.if_none_match and not request.range:
+        log_activity(f'Documento descargado: {document.original_filename}')
+    # El contenido de un documento no cambia: se puede guardar en la caché sin revalidar
+    return send_stored_file(
+        document.file_path,
+        mimetype=document.file_type,
         as_attachment=True,
-        download_name=document.original_filename
+        download_name=document.original_filename,
+        immutable=True
     )
 
 @employee_bp.route('/documents/<int:doc_id>/delete', methods=['POST'])
@@ -1148,9 +1160,8 @@ def delete_document(doc_id):
         flash('No tienes permiso para eliminar este documento.', 'danger')
         return redirect(url_for('employee.list_employees'))
     
-    # Delete file from filesystem
-    if os.path.exists(document.file_path):
-        os.remove(document.file_path)
+    # Release the stored file (it is removed from disk with its last reference)
+    release_upload(document.file_path)
     
     document_name = document.original_filename
     db.session.delete(document)
@@ -1350,6 +1361,7 @@ def edit_user(id):
             user.companies = []
         
         db.session.commit()
+        invalidate_user_company_ids(user.id)
         
         log_activity(f'Usuario actualizado: {user.username}')
         flash(f'Usuario "{user.username}" actualizado correctamente.', 'success')
@@ -2100,143 +2112,81 @@ def clean_database_route():
 @admin_required
 def export_all_companies():
     """Export all companies data to Excel file"""
-    from io import BytesIO
-    from openpyxl import Workbook
-    from openpyxl.styles import Font, PatternFill
-    from openpyxl.utils import get_column_letter
-    
-    # Obtener todas las empresas
-    companies = Company.query.all()
-    
-    if not companies:
+    # Comprobar que hay empresas
+    if not db.session.query(Company.query.exists()).scalar():
         flash('No hay empresas para exportar.', 'info')
         return redirect(url_for('main.dashboard'))
     
-    # Crear archivo Excel
-    output = BytesIO()
-    workbook = Workbook()
-    
-    # Hoja de empresas
-    companies_sheet = workbook.active
-    companies_sheet.title = "Empresas"
-    
     # Encabezados para empresas
     company_headers = ["ID", "Nombre", "CIF/NIF", "Dirección", "Ciudad", "Código Postal", 
                       "País", "Sector", "Teléfono", "Email", "Sitio Web", "Activa", 
                       "Fecha de Creación", "Última Actualización"]
     
-    for col_num, header in enumerate(company_headers, 1):
-        col_letter = get_column_letter(col_num)
-        companies_sheet[f'{col_letter}1'] = header
-        companies_sheet[f'{col_letter}1'].font = Font(bold=True)
-        companies_sheet[f'{col_letter}1'].fill = PatternFill(start_color="DDDDDD", end_color="DDDDDD", fill_type="solid")
-    
-    # Datos de empresas
-    for row_num, company in enumerate(companies, 2):
-        created_at = company.created_at.strftime('%d-%m-%Y %H:%M') if company.created_at else ''
-        updated_at = company.updated_at.strftime('%d-%m-%Y %H:%M') if company.updated_at else ''
-        
-        row = [
-            company.id,
-            company.name,
-            company.tax_id,
-            company.address,
-            company.city,
-            company.postal_code,
-            company.country,
-            company.sector,
-            company.phone,
-            company.email,
-            company.website,
-            "Sí" if company.is_active else "No",
-            created_at,
-            updated_at
-        ]
-        
-        for col_num, cell_value in enumerate(row, 1):
-            col_letter = get_column_letter(col_num)
-            companies_sheet[f'{col_letter}{row_num}'] = cell_value
-    
-    # Ajustar anchos de columna
-    for column in companies_sheet.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            if cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        adjusted_width = (max_length + 2)
-        companies_sheet.column_dimensions[column_letter].width = adjusted_width
-    
-    # Hoja de empleados
-    employees_sheet = workbook.create_sheet(title="Empleados")
+    def company_rows():
+        for company in Company.query.order_by(Company.id).yield_per(EXPORT_YIELD_PER):
+            created_at = company.created_at.strftime('%d-%m-%Y %H:%M') if company.created_at else ''
+            updated_at = company.updated_at.strftime('%d-%m-%Y %H:%M') if company.updated_at else ''
+            
+            yield [
+                company.id,
+                company.name,
+                company.tax_id,
+                company.address,
+                company.city,
+                company.postal_code,
+                company.country,
+                company.sector,
+                company.phone,
+                company.email,
+                company.website,
+                "Sí" if company.is_active else "No",
+                created_at,
+                updated_at
+            ]
     
     # Encabezados para empleados
     employee_headers = ["ID", "Empresa", "Nombre", "Apellidos", "DNI/NIE", "Email", 
                        "Teléfono", "Dirección", "Fecha Nacimiento", "Fecha Inicio", 
                        "Fecha Fin", "Posición", "Tipo Contrato", "Estado"]
     
-    for col_num, header in enumerate(employee_headers, 1):
-        col_letter = get_column_letter(col_num)
-        employees_sheet[f'{col_letter}1'] = header
-        employees_sheet[f'{col_letter}1'].font = Font(bold=True)
-        employees_sheet[f'{col_letter}1'].fill = PatternFill(start_color="DDDDDD", end_color="DDDDDD", fill_type="solid")
-    
-    # Obtener todos los empleados
-    employees = Employee.query.all()
-    
-    # Datos de empleados
-    for row_num, employee in enumerate(employees, 2):
-        company_name = employee.company.name if employee.company else "No asignada"
-        contract_type = employee.contract_type.name if employee.contract_type else "No especificado"
-        status_name = employee.status.name if employee.status else "No especificado"
-        
-        row = [
-            employee.id,
-            company_name,
-            employee.first_name,
-            employee.last_name,
-            employee.identity_document,
-            employee.email,
-            employee.phone,
-            employee.address,
-            employee.birth_date,
-            employee.start_date,
-            employee.end_date,
-            employee.position,
-            contract_type,
-            status_name
-        ]
-        
-        for col_num, cell_value in enumerate(row, 1):
-            col_letter = get_column_letter(col_num)
-            employees_sheet[f'{col_letter}{row_num}'] = cell_value
-    
-    # Ajustar anchos de columna
-    for column in employees_sheet.columns:
-        max_length = 0
-        column_letter = column[0].column_letter
-        for cell in column:
-            if cell.value:
-                max_length = max(max_length, len(str(cell.value)))
-        adjusted_width = (max_length + 2)
-        employees_sheet.column_dimensions[column_letter].width = adjusted_width
-    
-    workbook.save(output)
-    output.seek(0)
+    def employee_rows():
+        # La empresa se carga con una consulta por lote en lugar de una por empleado
+        employees = Employee.query.options(selectinload(Employee.company)).order_by(Employee.id).yield_per(EXPORT_YIELD_PER)
+        for employee in employees:
+            company_name = employee.company.name if employee.company else "No asignada"
+            contract_type = employee.contract_type.name if employee.contract_type else "No especificado"
+            status_name = employee.status.name if employee.status else "No especificado"
+            
+            yield [
+                employee.id,
+                company_name,
+                employee.first_name,
+                employee.last_name,
+                employee.dni,
+                employee.email,
+                employee.phone,
+                employee.address,
+                None,  # La fecha de nacimiento no se guarda en el modelo
+                employee.start_date,
+                employee.end_date,
+                employee.position,
+                contract_type,
+                status_name
+            ]
     
     # Generar nombre de archivo
     now = datetime.now().strftime('%Y%m%d_%H%M%S')
     filename = f"datos_empresas_empleados_{now}.xlsx"
     
+    response = send_xlsx([
+        ExcelSheet("Empresas", company_headers, company_rows()),
+        ExcelSheet("Empleados", employee_headers, employee_rows()),
+    ], filename)
+    
     # Registrar actividad
     log_activity('Exportados datos de todas las empresas y empleados a Excel')
     
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
-    )
+    return response
 
 # Ruta para exportar todos los fichajes (para el panel de backup)
 @checkin_bp.route('/export/all', methods=['GET'])
@@ -31,7 +31,10 @@ from forms_cash_register import (
     CashRegisterTokenForm, PublicCashRegisterForm, PinVerificationForm
 )
 from utils_cash_register import (
-    calculate_weekly_summary, calculate_staff_cost, calculate_monthly_revenue,
+    update_cash_register_summaries, get_weekly_summary, get_summary_staff_cost,
+    get_period_totals, get_revenue_series, SERIES_GRANULARITIES,
+    get_user_companies_overview, OVERVIEW_CACHE_SECONDS,
+    get_staff_cost, get_staff_cost_series, calculate_monthly_revenue,
     calculate_yearly_revenue, format_currency, format_percentage,
     get_current_week_number, get_week_dates, get_week_number, get_date_range,
     generate_token_url
@@ -206,6 +209,49 @@ def dashboard():
 
 
 
+@cash_register_bp.route('/overview')
+@login_required
+def companies_overview():
+    """
+    Vista consolidada de todas las empresas a las que tiene acceso el usuario.
+    
+    Muestra para cada empresa los ingresos de la semana actual, del mes y del año
+    hasta hoy, el porcentaje de coste de personal y la fecha del último arqueo.
+    """
+    overview = get_user_companies_overview(current_user)
+    
+    if not overview:
+        flash('No tiene acceso a ninguna empresa', 'warning')
+        return redirect(url_for('main.index'))
+    
+    totals = {
+        key: sum(item[key] for item in overview)
+        for key in ('week_total', 'month_total', 'year_total', 'week_staff_cost', 'month_staff_cost')
+    }
+    
+    return render_template(
+        'cash_register/overview.html',
+        title='Resumen de Arqueos por Empresa',
+        overview=overview,
+        totals=totals,
+        format_currency=format_currency,
+        format_percentage=format_percentage
+    )
+
+
+@cash_register_bp.route('/api/overview')
+@login_required
+def api_companies_overview():
+    """API con el resumen consolidado de las empresas del usuario."""
+    overview = get_user_companies_overview(current_user)
+    response = jsonify({
+        'success': True,
+        'companies': overview
+    })
+    response.headers['Cache-Control'] = f'private, max-age={OVERVIEW_CACHE_SECONDS}'
+    return response
+
+
 @cash_register_bp.route('/company/<int:company_id>')
 @login_required
 def company_dashboard(company_id):
@@ -253,8 +299,8 @@ def company_dashboard(company_id):
     # Obtener fechas de inicio y fin de la semana seleccionada
     week_start, week_end = get_week_dates(current_year, current_week)
     
-    # Calcular o actualizar el resumen semanal para la semana seleccionada
-    summary = calculate_weekly_summary(company_id, current_year, current_week)
+    # Resumen semanal ya calculado (se mantiene al guardar arqueos y horas)
+    summary = get_weekly_summary(company_id, current_year, current_week)
     
     # Obtener arqueos recientes
     recent_registers = CashRegister.query.filter_by(company_id=company_id)\
@@ -287,10 +333,8 @@ def company_dashboard(company_id):
             ]
         }
     
-    # Obtener datos de horas trabajadas y calcular coste
-    staff_cost = calculate_staff_cost(
-        company_id, current_year, current_month, current_week
-    )
+    # Datos de horas trabajadas y coste guardados en el resumen
+    staff_cost = get_summary_staff_cost(summary)
     
     return render_template(
         'cash_register/company_dashboard.html',
@@ -379,16 +423,15 @@ def new_register(company_id):
             
             logger.info("Añadiendo registro a la sesión de base de datos")
             db.session.add(register)
+            db.session.flush()
+            
+            # Actualizar resumen semanal y mensual en la misma transacción
+            logger.info(f"Actualizando resúmenes para la fecha {register.date}")
+            update_cash_register_summaries(company_id, register.date)
             
             logger.info("Ejecutando commit para guardar el arqueo")
             db.session.commit()
             
-            # Actualizar resumen semanal y mensual
-            year = form.date.data.year
-            week_number = get_week_number(form.date.data)
-            logger.info(f"Actualizando resumen semanal: año={year}, semana={week_number}")
-            calculate_weekly_summary(company_id, year, week_number)
-            
             logger.info("Arqueo registrado correctamente")
             flash('Arqueo de caja registrado correctamente', 'success')
             return redirect(url_for('cash_register.company_dashboard', company_id=company_id))
@@ -443,6 +486,8 @@ def edit_register(register_id):
     
     if form.validate_on_submit():
         try:
+            previous_date = register.date
+            
             # Guardar cambios
             form.populate_obj(register)
             
@@ -450,12 +495,12 @@ def edit_register(register_id):
             if form.employee_id.data == 0:
                 register.employee_id = None
             
-            db.session.commit()
+            db.session.flush()
             
-            # Actualizar resumen semanal y mensual
-            year = register.date.year
-            week_number = get_week_number(register.date)
-            calculate_weekly_summary(company.id, year, week_number)
+            # Actualizar resumen semanal y mensual (también el de la fecha anterior si cambió)
+            update_cash_register_summaries(company.id, previous_date, register.date)
+            
+            db.session.commit()
             
             flash('Arqueo actualizado correctamente', 'success')
             return redirect(url_for('cash_register.company_dashboard', company_id=company.id))
@@ -522,15 +567,16 @@ def delete_cash_register(register_id):
     try:
         # Obtener datos para actualizar sumarios después
         company_id = register.company_id
-        year = register.date.year
-        week_number = get_week_number(register.date)
+        register_date = register.date
         
         # Eliminar arqueo
         db.session.delete(register)
-        db.session.commit()
+        db.session.flush()
         
         # Actualizar resumen semanal y mensual
-        calculate_weekly_summary(company_id, year, week_number)
+        update_cash_register_summaries(company_id, register_date)
+        
+        db.session.commit()
         
         flash('Arqueo eliminado correctamente', 'success')
     except Exception as e:
@@ -577,6 +623,8 @@ def company_report(company_id):
     
     # Construir la consulta base
     query = CashRegister.query.filter_by(company_id=company_id)
+    start_date = end_date = None
+    filter_confirmed = False
     
     # Aplicar filtros si se enviaron
     if request.method == 'POST' and form.validate():
@@ -586,60 +634,49 @@ def company_report(company_id):
             
             # Filtrar por mes
             if form.month.data > 0:
-                month = form.month.data
-                start_date, end_date = get_date_range(year, month)
-                query = query.filter(
-                    CashRegister.date >= start_date,
-                    CashRegister.date <= end_date
-                )
+                start_date, end_date = get_date_range(year, form.month.data)
             # Filtrar por semana
             elif form.week.data:
-                week = form.week.data
-                start_date, end_date = get_date_range(year, week=week)
-                query = query.filter(
-                    CashRegister.date >= start_date,
-                    CashRegister.date <= end_date
-                )
+                start_date, end_date = get_date_range(year, week=form.week.data)
             # Filtrar por año completo
             else:
                 start_date, end_date = get_date_range(year)
-                query = query.filter(
-                    CashRegister.date >= start_date,
-                    CashRegister.date <= end_date
-                )
         
         # Filtrar por fechas específicas
         elif form.start_date.data or form.end_date.data:
-            if form.start_date.data:
-                query = query.filter(CashRegister.date >= form.start_date.data)
-            if form.end_date.data:
-                query = query.filter(CashRegister.date <= form.end_date.data)
+            start_date = form.start_date.data
+            end_date = form.end_date.data
         
         # Filtrar por estado (confirmado/pendiente)
         if form.is_confirmed.data != 'all':
+            filter_confirmed = True
             is_confirmed = form.is_confirmed.data == 'true'
             query = query.filter(CashRegister.is_confirmed == is_confirmed)
     else:
         # Por defecto, mostrar el mes actual
         start_date, end_date = get_date_range(current_year, current_month)
-        query = query.filter(
-            CashRegister.date >= start_date,
-            CashRegister.date <= end_date
-        )
+    
+    if start_date:
+        query = query.filter(CashRegister.date >= start_date)
+    if end_date:
+        query = query.filter(CashRegister.date <= end_date)
     
     # Ejecutar la consulta
     registers = query.order_by(CashRegister.date.desc()).all()
     
-    # Calcular totales
-    totals = {
-        'total_amount': sum(r.total_amount for r in registers),
-        'cash_amount': sum(r.cash_amount for r in registers),
-        'card_amount': sum(r.card_amount for r in registers),
-        'delivery_cash_amount': sum(r.delivery_cash_amount for r in registers),
-        'delivery_online_amount': sum(r.delivery_online_amount for r in registers),
-        'check_amount': sum(r.check_amount for r in registers),
-        'expenses_amount': sum(r.expenses_amount for r in registers)
-    }
+    # Calcular totales: de los totales diarios, salvo que se filtre por estado
+    if filter_confirmed:
+        totals = {
+            'total_amount': sum(r.total_amount for r in registers),
+            'cash_amount': sum(r.cash_amount for r in registers),
+            'card_amount': sum(r.card_amount for r in registers),
+            'delivery_cash_amount': sum(r.delivery_cash_amount for r in registers),
+            'delivery_online_amount': sum(r.delivery_online_amount for r in registers),
+            'check_amount': sum(r.check_amount for r in registers),
+            'expenses_amount': sum(r.expenses_amount for r in registers)
+        }
+    else:
+        totals = get_period_totals(company_id, start_date, end_date)
     
     # Calcular datos para gráfico
     payment_methods_data = {
@@ -659,7 +696,7 @@ def company_report(company_id):
     # Obtener datos de personal si tenemos año y mes específicos
     staff_cost = None
     if form.year.data and form.month.data > 0:
-        staff_cost = calculate_staff_cost(
+        staff_cost = get_staff_cost(
             company_id, form.year.data, form.month.data, form.week.data or None
         )
     
@@ -677,6 +714,88 @@ def company_report(company_id):
     )
 
 
+@cash_register_bp.route('/company/<int:company_id>/api/series')
+@login_required
+def api_revenue_series(company_id):
+    """
+    API para obtener la serie de ingresos de una empresa para gráficos.
+    
+    Parámetros: granularity ('day', 'week', 'month' o 'year'; por defecto 'month'),
+    start_year y end_year (por defecto, los tres últimos años).
+    
+    Args:
+        company_id: ID de la empresa
+    """
+    from models import Company
+    
+    # Verificar acceso a la empresa
+    company = Company.query.get_or_404(company_id)
+    if not current_user.is_admin() and company not in current_user.companies:
+        return jsonify({'success': False, 'error': 'No tiene acceso a esta empresa'}), 403
+    
+    granularity = request.args.get('granularity', 'month')
+    if granularity not in SERIES_GRANULARITIES:
+        return jsonify({'success': False, 'error': 'Agrupación no válida'}), 400
+    
+    end_year = request.args.get('end_year', type=int, default=datetime.now().year)
+    start_year = request.args.get('start_year', type=int, default=end_year - 2)
+    if start_year > end_year:
+        return jsonify({'success': False, 'error': 'Rango de años no válido'}), 400
+    
+    start_date, _ = get_date_range(start_year)
+    _, end_date = get_date_range(end_year)
+    
+    return jsonify({
+        'success': True,
+        'company_id': company_id,
+        'granularity': granularity,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'series': get_revenue_series(company_id, start_date, end_date, granularity)
+    })
+
+
+@cash_register_bp.route('/company/<int:company_id>/api/staff-cost')
+@login_required
+def api_staff_cost_series(company_id):
+    """
+    API para obtener la serie de coste de personal de una empresa para gráficos.
+    
+    Parámetros: granularity ('week' o 'month'; por defecto 'week'), start_year y
+    end_year (por defecto, el año actual y el anterior).
+    
+    Args:
+        company_id: ID de la empresa
+    """
+    from models import Company
+    
+    # Verificar acceso a la empresa
+    company = Company.query.get_or_404(company_id)
+    if not current_user.is_admin() and company not in current_user.companies:
+        return jsonify({'success': False, 'error': 'No tiene acceso a esta empresa'}), 403
+    
+    granularity = request.args.get('granularity', 'week')
+    if granularity not in ('week', 'month'):
+        return jsonify({'success': False, 'error': 'Agrupación no válida'}), 400
+    
+    end_year = request.args.get('end_year', type=int, default=datetime.now().year)
+    start_year = request.args.get('start_year', type=int, default=end_year - 1)
+    if start_year > end_year:
+        return jsonify({'success': False, 'error': 'Rango de años no válido'}), 400
+    
+    start_date, _ = get_date_range(start_year)
+    _, end_date = get_date_range(end_year)
+    
+    return jsonify({
+        'success': True,
+        'company_id': company_id,
+        'granularity': granularity,
+        'start_date': start_date.isoformat(),
+        'end_date': end_date.isoformat(),
+        'series': get_staff_cost_series(company_id, start_date, end_date, granularity)
+    })
+
+
 @cash_register_bp.route('/company/<int:company_id>/tokens', methods=['GET', 'POST'])
 @login_required
 def manage_tokens(company_id):
@@ -908,17 +1027,16 @@ def public_register(token_str):
             # Asignar el token al registro
             logger.info(f"Asignando token {token.id} al arqueo")
             register.token_id = token.id
+            db.session.flush()
+            
+            # Actualizar resumen semanal y mensual en la misma transacción
+            logger.info(f"Actualizando resúmenes para la fecha {register.date}")
+            update_cash_register_summaries(company.id, register.date)
             
             # Guardar los cambios
             logger.info("Ejecutando commit para guardar el arqueo")
             db.session.commit()
             
-            # Actualizar resumen semanal y mensual
-            year = form.date.data.year
-            week_number = get_week_number(form.date.data)
-            logger.info(f"Actualizando resumen semanal: año={year}, semana={week_number}")
-            calculate_weekly_summary(company.id, year, week_number)
-            
             logger.info("Arqueo por token registrado correctamente")
             
             # Mostrar página de confirmación
@@ -9,8 +9,6 @@ import logging
 from datetime import datetime, date, timedelta
 import calendar
 import os
-import io
-import csv
 from decimal import Decimal
 
 # Imports de Flask y extensiones
@@ -27,10 +25,12 @@ from models import Company, Employee, User
 from models_cash_register import CashRegister, CashRegisterToken, CashRegisterSummary
 from forms_cash_register import CashRegisterForm, CashRegisterSearchForm
 from utils_cash_register import (
-    calculate_weekly_summary, calculate_staff_cost, calculate_monthly_revenue,
+    update_cash_register_summaries, calculate_monthly_revenue,
     calculate_yearly_revenue, format_currency, format_percentage,
-    get_current_week_number, get_week_dates, get_week_number, get_date_range
+    get_current_week_number, get_week_dates, get_week_number, get_date_range,
+    register_export_headers, iter_register_export_rows
 )
+from utils_excel import ExcelSheet, send_xlsx, send_csv
 
 # Configuración del logger
 logger = logging.getLogger(__name__)
@@ -52,6 +52,30 @@ def get_user_companies(user):
     return user.companies
 
 
+def send_register_export(company_ids, start_date, end_date, filename, export_format, back_url,
+                         include_company=False):
+    """
+    Envía la exportación de arqueos en el formato pedido.
+    
+    El CSV se genera en streaming y el Excel en modo write_only, con subtotales
+    mensuales, sin cargar los arqueos en memoria.
+    """
+    headers = register_export_headers(include_company)
+    
+    if export_format == 'csv':
+        rows = iter_register_export_rows(company_ids, start_date, end_date,
+                                         include_company=include_company, as_text=True)
+        return send_csv(headers, rows, f"{filename}.csv")
+    
+    if export_format == 'excel':
+        rows = iter_register_export_rows(company_ids, start_date, end_date,
+                                         include_company=include_company)
+        return send_xlsx([ExcelSheet('Arqueos de Caja', headers, rows)], f"{filename}.xlsx")
+    
+    flash('Formato de exportación no soportado.', 'danger')
+    return redirect(back_url)
+
+
 # Definición de las rutas adicionales para gestión centralizada de arqueos
 def register_routes(cash_register_bp):
     """
@@ -169,10 +193,13 @@ def register_routes(cash_register_bp):
         check_company_access(company)
         
         company_id = register.company_id
+        register_date = register.date
         
         try:
-            # Eliminar el arqueo
+            # Eliminar el arqueo y actualizar sus resúmenes
             db.session.delete(register)
+            db.session.flush()
+            update_cash_register_summaries(company_id, register_date)
             db.session.commit()
             flash('Arqueo eliminado correctamente.', 'success')
         except Exception as e:
@@ -194,147 +221,63 @@ def register_routes(cash_register_bp):
         company = Company.query.get_or_404(company_id)
         check_company_access(company)
         
-        # Obtener formato de exportación
-        export_format = request.args.get('format', 'csv')
-        
-        # Obtener parámetros de filtrado
+        # Obtener parámetros de filtrado (los mismos que manage_registers)
         year = request.args.get('year', datetime.now().year, type=int)
         month = request.args.get('month', 0, type=int)
         start_date = request.args.get('start_date')
         end_date = request.args.get('end_date')
         
-        # Iniciar consulta base
-        query = CashRegister.query.filter_by(company_id=company_id)
-        
-        # Aplicar filtros (código similar a manage_registers)
         if start_date and end_date:
             start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
             end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
-            query = query.filter(
-                CashRegister.date >= start_date,
-                CashRegister.date <= end_date
-            )
         elif month > 0:
             start_date, end_date = get_date_range(year, month)
-            query = query.filter(
-                CashRegister.date >= start_date,
-                CashRegister.date <= end_date
-            )
         elif year:
-            start_date = date(year, 1, 1)
-            end_date = date(year, 12, 31)
-            query = query.filter(
-                CashRegister.date >= start_date,
-                CashRegister.date <= end_date
-            )
-            
-        # Obtener registros ordenados por fecha
-        registers = query.order_by(CashRegister.date.desc()).all()
+            start_date, end_date = get_date_range(year)
+        else:
+            start_date = end_date = None
         
-        if export_format == 'csv':
-            # Exportar a CSV
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Cabecera
-            writer.writerow([
-                'Fecha', 'Efectivo', 'Tarjeta', 'Delivery Efectivo', 
-                'Delivery Online', 'Cheque', 'Gastos', 'Total',
-                'Notas Gastos', 'Notas', 'Empleado'
-            ])
-            
-            # Datos
-            for reg in registers:
-                writer.writerow([
-                    reg.date.strftime('%d/%m/%Y'),
-                    f"{reg.cash_amount:.2f}",
-                    f"{reg.card_amount:.2f}",
-                    f"{reg.delivery_cash_amount:.2f}",
-                    f"{reg.delivery_online_amount:.2f}",
-                    f"{reg.check_amount:.2f}",
-                    f"{reg.expenses_amount:.2f}",
-                    f"{reg.total_amount:.2f}",
-                    reg.expenses_notes,
-                    reg.notes,
-                    reg.employee_name
-                ])
-            
-            # Configurar respuesta
-            output.seek(0)
-            filename = f"arqueos_{company.name}_{datetime.now().strftime('%Y%m%d')}.csv"
-            return send_file(
-                io.BytesIO(output.getvalue().encode('utf-8-sig')),
-                mimetype='text/csv',
-                as_attachment=True,
-                download_name=filename
-            )
-            
-        elif export_format == 'excel':
-            try:
-                import openpyxl
-                from openpyxl.styles import Font, Alignment, PatternFill
-                
-                # Crear libro de Excel
-                wb = openpyxl.Workbook()
-                ws = wb.active
-                ws.title = "Arqueos de Caja"
-                
-                # Estilo para encabezados
-                header_font = Font(bold=True, color="FFFFFF")
-                header_fill = PatternFill(start_color="0366D6", end_color="0366D6", fill_type="solid")
-                
-                # Cabecera
-                headers = [
-                    'Fecha', 'Efectivo', 'Tarjeta', 'Delivery Efectivo', 
-                    'Delivery Online', 'Cheque', 'Gastos', 'Total',
-                    'Notas Gastos', 'Notas', 'Empleado'
-                ]
-                
-                # Aplicar estilos a la cabecera
-                for col, header in enumerate(headers, 1):
-                    cell = ws.cell(row=1, column=col, value=header)
-                    cell.font = header_font
-                    cell.fill = header_fill
-                    cell.alignment = Alignment(horizontal='center')
-                
-                # Datos
-                for row, reg in enumerate(registers, 2):
-                    ws.cell(row=row, column=1, value=reg.date.strftime('%d/%m/%Y'))
-                    ws.cell(row=row, column=2, value=reg.cash_amount)
-                    ws.cell(row=row, column=3, value=reg.card_amount)
-                    ws.cell(row=row, column=4, value=reg.delivery_cash_amount)
-                    ws.cell(row=row, column=5, value=reg.delivery_online_amount)
-                    ws.cell(row=row, column=6, value=reg.check_amount)
-                    ws.cell(row=row, column=7, value=reg.expenses_amount)
-                    ws.cell(row=row, column=8, value=reg.total_amount)
-                    ws.cell(row=row, column=9, value=reg.expenses_notes)
-                    ws.cell(row=row, column=10, value=reg.notes)
-                    ws.cell(row=row, column=11, value=reg.employee_name)
-                
-                # Ajustar ancho de columnas
-                for col in range(1, len(headers) + 1):
-                    ws.column_dimensions[openpyxl.utils.get_column_letter(col)].width = 15
-                
-                # Guardar a bytes
-                output = io.BytesIO()
-                wb.save(output)
-                output.seek(0)
-                
-                # Configurar respuesta
-                filename = f"arqueos_{company.name}_{datetime.now().strftime('%Y%m%d')}.xlsx"
-                return send_file(
-                    output,
-                    mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-                    as_attachment=True,
-                    download_name=filename
-                )
-            except ImportError:
-                flash('No se pudo exportar a Excel. Librería openpyxl no disponible.', 'danger')
-                return redirect(url_for('cash_register.manage_registers', company_id=company_id))
+        filename = f"arqueos_{company.name}_{datetime.now().strftime('%Y%m%d')}"
+        return send_register_export([company.id], start_date, end_date, filename,
+                                    request.args.get('format', 'csv'),
+                                    url_for('cash_register.manage_registers', company_id=company_id))
+
+
+    @cash_register_bp.route('/export')
+    @login_required
+    def export_companies_registers():
+        """
+        Exporta los arqueos de varias empresas y años a CSV o Excel.
+        
+        Parámetros: company_id (repetible; por defecto, todas las empresas del
+        usuario), start_year y end_year (por defecto, el año actual) o start_date
+        y end_date, y format ('csv' o 'excel').
+        """
+        companies = get_user_companies(current_user)
+        allowed_ids = {company.id for company in companies}
         
+        company_ids = request.args.getlist('company_id', type=int) or sorted(allowed_ids)
+        if any(company_id not in allowed_ids for company_id in company_ids):
+            abort(403)
+        
+        start_date = request.args.get('start_date')
+        end_date = request.args.get('end_date')
+        if start_date and end_date:
+            start_date = datetime.strptime(start_date, '%Y-%m-%d').date()
+            end_date = datetime.strptime(end_date, '%Y-%m-%d').date()
         else:
-            flash('Formato de exportación no soportado.', 'danger')
-            return redirect(url_for('cash_register.manage_registers', company_id=company_id))
+            end_year = request.args.get('end_year', datetime.now().year, type=int)
+            start_year = request.args.get('start_year', end_year, type=int)
+            start_date, _ = get_date_range(min(start_year, end_year))
+            _, end_date = get_date_range(max(start_year, end_year))
+        
+        logger.info(f"Exportando arqueos de {len(company_ids)} empresas entre {start_date} y {end_date}")
+        
+        filename = f"arqueos_empresas_{datetime.now().strftime('%Y%m%d')}"
+        return send_register_export(company_ids, start_date, end_date, filename,
+                                    request.args.get('format', 'csv'),
+                                    url_for('cash_register.companies_overview'),
+                                    include_company=True)
 
 
     @cash_register_bp.route('/print/<int:register_id>')
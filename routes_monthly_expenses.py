@@ -7,6 +7,7 @@ incluyendo vistas para categorías, gastos fijos, gastos mensuales y reportes.
 
 import os
 import datetime
+import hashlib
 import json
 import calendar
 from datetime import date
@@ -24,6 +25,13 @@ from models import Company
 from models_monthly_expenses import ExpenseCategory, FixedExpense, MonthlyExpense, MonthlyExpenseSummary, MonthlyExpenseToken
 from forms_monthly_expenses import ExpenseCategoryForm, FixedExpenseForm, MonthlyExpenseForm, PeriodSelectorForm, MonthlyExpenseSearchForm
 from forms_monthly_expenses import MonthlyExpenseTokenForm, EmployeeExpenseForm
+from utils_monthly_expenses import (refresh_expense_summaries, get_expense_summary,
+                                    materialize_fixed_expenses, get_pending_fixed_expenses,
+                                    get_expense_report, iter_report_sheets, MONTH_NAMES)
+from utils_excel import send_xlsx
+from utils_receipt_images import submit_receipt_processing
+from utils_storage import store_upload, storage_relative_path, release_upload, send_stored_file
+from utils import can_access_company
 
 
 # Crear Blueprint para las rutas de gastos mensuales
@@ -76,90 +84,6 @@ def format_currency(amount):
     return f"{amount:,.2f} €".replace(".", "*").replace(",", ".").replace("*", ",")
 
 
-def get_or_create_summary(company_id, year, month):
-    """
-    Obtiene o crea un resumen mensual de gastos para una empresa, año y mes específicos.
-    También actualiza los totales si el resumen ya existe.
-    """
-    # Buscar si ya existe el resumen
-    summary = MonthlyExpenseSummary.query.filter_by(
-        company_id=company_id,
-        year=year,
-        month=month
-    ).first()
-    
-    # Si no existe, crearlo
-    if not summary:
-        summary = MonthlyExpenseSummary(
-            company_id=company_id,
-            year=year,
-            month=month,
-            fixed_expenses_total=0.0,
-            custom_expenses_total=0.0,
-            total_amount=0.0,
-            number_of_expenses=0
-        )
-        db.session.add(summary)
-    
-    # Calcular los totales
-    # 1. Total de gastos fijos incluidos para este mes
-    fixed_expenses_query = db.session.query(func.sum(MonthlyExpense.amount)).filter(
-        MonthlyExpense.company_id == company_id,
-        MonthlyExpense.year == year,
-        MonthlyExpense.month == month,
-        MonthlyExpense.is_fixed == True
-    )
-    fixed_total = fixed_expenses_query.scalar() or 0.0
-    
-    # 2. Total de gastos personalizados (no fijos) para este mes
-    custom_expenses_query = db.session.query(func.sum(MonthlyExpense.amount)).filter(
-        MonthlyExpense.company_id == company_id,
-        MonthlyExpense.year == year,
-        MonthlyExpense.month == month,
-        MonthlyExpense.is_fixed == False
-    )
-    custom_total = custom_expenses_query.scalar() or 0.0
-    
-    # 3. Contar el número total de gastos
-    expenses_count = MonthlyExpense.query.filter_by(
-        company_id=company_id,
-        year=year,
-        month=month
-    ).count()
-    
-    # Actualizar el resumen con los nuevos valores
-    summary.fixed_expenses_total = fixed_total
-    summary.custom_expenses_total = custom_total
-    summary.total_amount = fixed_total + custom_total
-    summary.number_of_expenses = expenses_count
-    summary.updated_at = datetime.datetime.utcnow()
-    
-    # Guardar cambios
-    db.session.commit()
-    
-    return summary
-
-
-def update_all_summaries_for_company(company_id):
-    """
-    Actualiza todos los resúmenes mensuales de gastos para una empresa.
-    Útil después de operaciones masivas que afectan múltiples meses.
-    """
-    # Obtener todos los distintos pares año/mes que tienen gastos para esta empresa
-    month_year_pairs = db.session.query(
-        MonthlyExpense.year, 
-        MonthlyExpense.month
-    ).filter_by(
-        company_id=company_id
-    ).distinct().all()
-    
-    # Actualizar cada resumen individualmente
-    for year, month in month_year_pairs:
-        get_or_create_summary(company_id, year, month)
-    
-    return len(month_year_pairs)
-
-
 # Rutas principales
 @monthly_expenses_bp.route('/company/<int:company_id>')
 @login_required
@@ -187,64 +111,19 @@ def company_dashboard(company_id):
     if not month:
         month = today.month
     
-    # Obtener el resumen mensual (o crearlo si no existe)
-    summary = get_or_create_summary(company_id, year, month)
+    # Obtener el resumen mensual (a cero si el mes no tiene gastos)
+    summary = get_expense_summary(company_id, year, month)
     
-    # Obtener gastos fijos activos desde la tabla FixedExpense
-    active_fixed_expenses = FixedExpense.query.filter_by(
-        company_id=company_id,
-        is_active=True
-    ).order_by(FixedExpense.name).all()
-    
-    # Obtener gastos fijos registrados para este mes específico
-    fixed_expenses_this_month = MonthlyExpense.query.filter_by(
+    # Gastos fijos registrados para este mes (los crea el servicio de gastos fijos al inicio de cada mes)
+    fixed_expenses = MonthlyExpense.query.filter_by(
         company_id=company_id,
         year=year,
         month=month,
         is_fixed=True
     ).order_by(MonthlyExpense.name).all()
     
-    # Combinar ambas listas para el dashboard, priorizando los que ya existen para este mes
-    # Primero, vamos a convertir los gastos fijos activos en gastos mensuales si no existen ya
-    existing_fixed_names = [expense.name for expense in fixed_expenses_this_month]
-    
-    # Si no hay gastos fijos convertidos para este mes, crearlos a partir de los gastos fijos activos
-    if not fixed_expenses_this_month and active_fixed_expenses:
-        for fixed_expense in active_fixed_expenses:
-            # Crear un gasto mensual a partir del gasto fijo
-            monthly_fixed = MonthlyExpense(
-                company_id=company_id,
-                year=year,
-                month=month,
-                name=fixed_expense.name,
-                description=fixed_expense.description,
-                amount=fixed_expense.amount,
-                category_id=fixed_expense.category_id,
-                is_fixed=True,
-                created_at=datetime.datetime.utcnow(),
-                updated_at=datetime.datetime.utcnow()
-            )
-            db.session.add(monthly_fixed)
-        
-        # Guardar todos los nuevos gastos fijos convertidos
-        try:
-            db.session.commit()
-            # Refrescar la lista de gastos fijos para este mes
-            fixed_expenses_this_month = MonthlyExpense.query.filter_by(
-                company_id=company_id,
-                year=year,
-                month=month,
-                is_fixed=True
-            ).order_by(MonthlyExpense.name).all()
-            
-            # Actualizar el resumen con los nuevos gastos
-            summary = get_or_create_summary(company_id, year, month)
-        except SQLAlchemyError as e:
-            db.session.rollback()
-            flash(f'Error al crear gastos fijos para este mes: {str(e)}', 'warning')
-    
-    # Usar los gastos fijos mensuales para mostrar en el dashboard
-    fixed_expenses = fixed_expenses_this_month
+    # Gastos fijos activos que aún no se han añadido a este mes
+    pending_fixed_expenses = get_pending_fixed_expenses(company_id, year, month)
     
     # Obtener gastos personalizados para este mes
     custom_expenses = MonthlyExpense.query.filter_by(
@@ -304,6 +183,7 @@ def company_dashboard(company_id):
         company=company,
         summary=summary,
         fixed_expenses=fixed_expenses,
+        pending_fixed_expenses=pending_fixed_expenses,
         custom_expenses=custom_expenses,
         all_summaries=all_summaries,
         form=form,
@@ -321,6 +201,38 @@ def company_dashboard(company_id):
     )
 
 
+@monthly_expenses_bp.route('/company/<int:company_id>/apply-fixed/<int:year>/<int:month>', methods=['POST'])
+@login_required
+def apply_fixed_expenses(company_id, year, month):
+    """
+    Añade a un mes los gastos fijos activos que aún no tiene.
+    El mes en curso lo completa el servicio de gastos fijos; esta ruta sirve para
+    meses pasados o futuros y para gastos fijos creados a mitad de mes.
+    """
+    # Verificar permisos
+    if not current_user.is_admin() and not current_user.has_company_access(company_id):
+        flash('No tiene permisos para acceder a esta empresa.', 'danger')
+        return redirect(url_for('main.dashboard'))
+    
+    if not 1 <= month <= 12:
+        abort(404)
+    
+    try:
+        created = materialize_fixed_expenses((year, month), company_ids=[company_id])
+        db.session.commit()
+        flash(f'Se han añadido {created} gastos fijos a este mes.', 'success')
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        flash(f'Error al crear gastos fijos para este mes: {str(e)}', 'danger')
+    
+    return redirect(url_for(
+        'monthly_expenses.company_dashboard',
+        company_id=company_id,
+        year=year,
+        month=month
+    ))
+
+
 # Rutas para gestión de categorías
 @monthly_expenses_bp.route('/categories/<int:company_id>', methods=['GET', 'POST'])
 @login_required
@@ -543,12 +455,16 @@ def new_monthly_expense(company_id):
                     is_active=True
                 )
                 db.session.add(fixed_expense)
+                db.session.flush()
+                
+                # El gasto de este mes es la instancia del nuevo gasto fijo
+                expense.fixed_expense_id = fixed_expense.id
             
+            # Actualizar resumen mensual en la misma transacción
+            db.session.flush()
+            refresh_expense_summaries(company_id, [(form.year.data, form.month.data)])
             db.session.commit()
             
-            # Actualizar resumen mensual
-            get_or_create_summary(company_id, form.year.data, form.month.data)
-            
             flash('Gasto mensual creado correctamente.', 'success')
             return redirect(url_for(
                 'monthly_expenses.company_dashboard', 
@@ -622,17 +538,11 @@ def edit_monthly_expense(expense_id):
             expense.year = form.year.data
             expense.month = form.month.data
             
+            # Actualizar resúmenes afectados (el antiguo y el nuevo si cambia el mes)
+            db.session.flush()
+            refresh_expense_summaries(expense.company_id, [(old_year, old_month), (form.year.data, form.month.data)])
             db.session.commit()
             
-            # Actualizar resúmenes afectados
-            if old_year != form.year.data or old_month != form.month.data:
-                # Actualizar tanto el resumen antiguo como el nuevo
-                get_or_create_summary(expense.company_id, old_year, old_month)
-                get_or_create_summary(expense.company_id, form.year.data, form.month.data)
-            else:
-                # Solo actualizar el resumen actual
-                get_or_create_summary(expense.company_id, form.year.data, form.month.data)
-            
             flash('Gasto mensual actualizado correctamente.', 'success')
             return redirect(url_for(
                 'monthly_expenses.company_dashboard', 
@@ -673,12 +583,17 @@ def delete_monthly_expense(expense_id):
     month = expense.month
     
     try:
+        # Liberar el recibo y su miniatura
+        release_upload(expense.receipt_image)
+        release_upload(expense.receipt_thumbnail)
+        
         # Eliminar el gasto
         db.session.delete(expense)
-        db.session.commit()
+        db.session.flush()
         
         # Actualizar resumen mensual
-        get_or_create_summary(company_id, year, month)
+        refresh_expense_summaries(company_id, [(year, month)])
+        db.session.commit()
         
         flash('Gasto mensual eliminado correctamente.', 'success')
     except SQLAlchemyError as e:
@@ -693,6 +608,50 @@ def delete_monthly_expense(expense_id):
     ))
 
 
+@monthly_expenses_bp.route('/expense/<int:expense_id>/receipt')
+@login_required
+def expense_receipt(expense_id):
+    """
+    Muestra la imagen del recibo de un gasto.
+    """
+    expense = db.session.execute(
+        db.select(MonthlyExpense.company_id, MonthlyExpense.receipt_image).where(MonthlyExpense.id == expense_id)
+    ).first()
+    if expense is None:
+        abort(404)
+    
+    # Verificar permisos (empresas del usuario en caché)
+    if not can_access_company(expense.company_id):
+        abort(403)
+    
+    if not expense.receipt_image:
+        abort(404)
+    
+    return send_stored_file(expense.receipt_image)
+
+
+@monthly_expenses_bp.route('/expense/<int:expense_id>/receipt/thumbnail')
+@login_required
+def expense_receipt_thumbnail(expense_id):
+    """
+    Muestra la miniatura del recibo de un gasto (para los listados).
+    """
+    expense = db.session.execute(
+        db.select(MonthlyExpense.company_id, MonthlyExpense.receipt_thumbnail).where(MonthlyExpense.id == expense_id)
+    ).first()
+    if expense is None:
+        abort(404)
+    
+    # Verificar permisos (empresas del usuario en caché)
+    if not can_access_company(expense.company_id):
+        abort(403)
+    
+    if not expense.receipt_thumbnail:
+        abort(404)
+    
+    return send_stored_file(expense.receipt_thumbnail)
+
+
 # Rutas para la gestión de tokens de gastos
 @monthly_expenses_bp.route('/tokens/<int:company_id>', methods=['GET', 'POST'])
 @login_required
@@ -969,27 +928,14 @@ def employee_submit_expense():
             
             # Guardar la imagen del recibo si se proporciona
             receipt_image_path = None
+            receipt_content_type = None
             if form.receipt_image.data:
-                file = form.receipt_image.data
-                filename = secure_filename(file.filename)
-                # Crear directorio para gastos si no existe
-                receipts_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'expense_receipts')
-                if not os.path.exists(receipts_dir):
-                    os.makedirs(receipts_dir)
+                # Almacén por contenido: el mismo recibo enviado dos veces se guarda una vez
+                stored = store_upload(form.receipt_image.data)
+                receipt_content_type = stored.content_type
                 
-                # Crear directorio para la empresa si no existe
-                company_dir = os.path.join(receipts_dir, str(token.company_id))
-                if not os.path.exists(company_dir):
-                    os.makedirs(company_dir)
-                
-                # Guardar el archivo con timestamp para evitar duplicados
-                timestamp = datetime.datetime.now().strftime('%Y%m%d%H%M%S')
-                filename = f"{timestamp}_{filename}"
-                file_path = os.path.join(company_dir, filename)
-                file.save(file_path)
-                
-                # Guardar ruta relativa
-                receipt_image_path = os.path.join('expense_receipts', str(token.company_id), filename)
+                # Guardar ruta relativa (la imagen se procesa después en segundo plano)
+                receipt_image_path = storage_relative_path(stored.sha256)
             
             # Crear nuevo gasto
             expense = MonthlyExpense(
@@ -1004,6 +950,7 @@ def employee_submit_expense():
                 submitted_by_employee=True,
                 employee_name=form.employee_name.data,
                 receipt_image=receipt_image_path,
+                receipt_uploaded_at=datetime.datetime.utcnow() if receipt_image_path else None,
                 is_fixed=False
             )
             db.session.add(expense)
@@ -1013,10 +960,15 @@ def employee_submit_expense():
             token.total_uses += 1
             
             # Actualizar resumen mensual
-            summary = get_or_create_summary(token.company_id, year, month)
+            db.session.flush()
+            refresh_expense_summaries(token.company_id, [(year, month)])
             
             db.session.commit()
             
+            # Reducir la imagen y generar su miniatura sin hacer esperar al empleado
+            submit_receipt_processing(current_app._get_current_object(), expense.id, receipt_image_path,
+                                      receipt_content_type)
+            
             # Obtener la categoría para el mensaje de confirmación
             category_obj = ExpenseCategory.query.get(category_id)
             category_name = category_obj.name if category_obj else "Otros"
@@ -1232,7 +1184,7 @@ def expenses_report(company_id):
     Muestra un informe anual de gastos mensuales para una empresa específica.
     """
     # Verificar permisos
-    if not current_user.is_admin() and not current_user.has_company_access(company_id):
+    if not can_access_company(company_id):
         flash('No tiene permisos para acceder a esta empresa.', 'danger')
         return redirect(url_for('main.dashboard'))
     
@@ -1242,54 +1194,24 @@ def expenses_report(company_id):
     # Obtener parámetro de año desde la URL
     year = request.args.get('year', type=int) or datetime.datetime.now().year
     
-    # Obtener todos los resúmenes para este año
-    summaries = MonthlyExpenseSummary.query.filter_by(
-        company_id=company_id,
-        year=year
-    ).order_by(MonthlyExpenseSummary.month).all()
-    
-    # Calcular totales por categoría para el año
-    category_totals = db.session.query(
-        ExpenseCategory.name,
-        func.sum(MonthlyExpense.amount).label('total')
-    ).join(
-        MonthlyExpense, 
-        ExpenseCategory.id == MonthlyExpense.category_id
-    ).filter(
-        MonthlyExpense.company_id == company_id,
-        MonthlyExpense.year == year
-    ).group_by(
-        ExpenseCategory.name
-    ).order_by(
-        desc('total')
-    ).all()
-    
-    # Calcular total anual
-    total_year = sum(summary.total_amount for summary in summaries)
+    # Matriz mes × categoría del año (en caché mientras no cambien los gastos)
+    report = get_expense_report(company_id, year)
     
     # Preparar datos para el gráfico de evolución mensual
     months = ['Ene', 'Feb', 'Mar', 'Abr', 'May', 'Jun', 'Jul', 'Ago', 'Sep', 'Oct', 'Nov', 'Dic']
-    fixed_data = [0.0] * 12
-    custom_data = [0.0] * 12
-    
-    for summary in summaries:
-        month_idx = summary.month - 1  # Ajustar para índice base 0
-        fixed_data[month_idx] = float(summary.fixed_expenses_total or 0.0)
-        custom_data[month_idx] = float(summary.custom_expenses_total or 0.0)
-    
     chart_data = {
         'labels': months,
         'datasets': [
             {
                 'label': 'Gastos Fijos',
-                'data': fixed_data,
+                'data': [cell['fixed_amount'] for cell in report['months']],
                 'backgroundColor': 'rgba(54, 162, 235, 0.5)',
                 'borderColor': 'rgba(54, 162, 235, 1)',
                 'borderWidth': 1
             },
             {
                 'label': 'Gastos Variables',
-                'data': custom_data,
+                'data': [cell['variable_amount'] for cell in report['months']],
                 'backgroundColor': 'rgba(255, 99, 132, 0.5)',
                 'borderColor': 'rgba(255, 99, 132, 1)',
                 'borderWidth': 1
@@ -1298,25 +1220,57 @@ def expenses_report(company_id):
     }
     
     # Preparar datos para el gráfico de categorías
-    if category_totals:
-        category_chart_data = {
-            'labels': [cat[0] for cat in category_totals],
-            'data': [float(cat[1]) for cat in category_totals]
-        }
-    else:
-        category_chart_data = {
-            'labels': [],
-            'data': []
-        }
+    category_chart_data = {
+        'labels': [category['name'] for category in report['categories']],
+        'data': [category['amount'] for category in report['categories']]
+    }
     
     return render_template(
         'monthly_expenses/report.html',
         company=company,
-        summaries=summaries,
-        category_totals=category_totals,
-        total_year=total_year,
+        report=report,
+        category_totals=[(category['name'], category['amount']) for category in report['categories']],
+        total_year=report['total']['amount'],
         current_year=year,
+        month_names=MONTH_NAMES,
         chart_data=json.dumps(chart_data),
         category_chart_data=json.dumps(category_chart_data),
         format_currency=format_currency
-    )
\ No newline at end of file
+    )
+
+
+@monthly_expenses_bp.route('/report/<int:company_id>/data')
+@login_required
+def expenses_report_data(company_id):
+    """
+    Informe anual en JSON: matriz mes × categoría con importes y número de gastos.
+    """
+    if not can_access_company(company_id):
+        return jsonify({'error': 'No tiene permisos para acceder a esta empresa.'}), 403
+    
+    year = request.args.get('year', type=int) or datetime.datetime.now().year
+    report = get_expense_report(company_id, year)
+    
+    # La versión de los datos sirve de ETag: sin cambios, el navegador recibe un 304
+    response = jsonify(report)
+    response.set_etag(hashlib.sha1(report['version'].encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
+
+
+@monthly_expenses_bp.route('/report/<int:company_id>/export')
+@login_required
+def export_expenses_report(company_id):
+    """
+    Exporta el informe anual a Excel (importes, número de gastos y fijos/variables por mes).
+    """
+    if not can_access_company(company_id):
+        flash('No tiene permisos para acceder a esta empresa.', 'danger')
+        return redirect(url_for('main.dashboard'))
+    
+    company = Company.query.get_or_404(company_id)
+    year = request.args.get('year', type=int) or datetime.datetime.now().year
+    report = get_expense_report(company_id, year)
+    
+    filename = f"gastos_{secure_filename(company.name) or company.id}_{year}.xlsx"
+    return send_xlsx(iter_report_sheets(report), filename)
\ No newline at end of file
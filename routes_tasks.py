@@ -1,4 +1,4 @@
-from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, session, current_app, send_file, Response
+from flask import Blueprint, render_template, redirect, url_for, flash, request, jsonify, session, current_app, send_file, Response, abort
 from flask_login import login_required, current_user
 from functools import wraps
 from datetime import datetime, date, timedelta
@@ -6,16 +6,18 @@ import os
 import io
 import socket
 import openpyxl
+from types import SimpleNamespace
 from fpdf import FPDF
 from werkzeug.utils import secure_filename
 from wtforms.validators import Optional
+from sqlalchemy.orm import selectinload
 
 from app import db
 from models import User, Company, Employee
 from models_tasks import (Location, LocalUser, Task, TaskSchedule, TaskCompletion, TaskPriority, 
                          TaskFrequency, TaskStatus, WeekDay, TaskGroup, TaskWeekday, TaskMonthDay,
                          Product, ProductConservation, ProductLabel, ConservationType, LabelTemplate,
-                         NetworkPrinter, TaskInstance)
+                         NetworkPrinter, TaskInstance, PrintJob, PrintJobStatus, DEFAULT_CONSERVATION_HOURS)
 from models_checkpoints import CheckPointStatus
 from models_access import LocationAccessToken
 from forms_tasks import (LocationForm, LocalUserForm, TaskForm, DailyScheduleForm, WeeklyScheduleForm, 
@@ -23,9 +25,15 @@ from forms_tasks import (LocationForm, LocalUserForm, TaskForm, DailyScheduleFor
                         LocalUserPinForm, SearchForm, TaskGroupForm, CustomWeekdaysForm, PortalLoginForm,
                         ProductForm, ProductConservationForm, GenerateLabelForm, LabelEditorForm,
                         NetworkPrinterForm)
-from utils import log_activity, can_manage_company, save_file
+from utils import log_activity, can_manage_company, save_file, can_access_company
 from utils_tasks import create_default_local_user, regenerate_portal_password, count_available_employees, sync_employees_to_local_users
+from utils_labels_import import import_products_excel, PRODUCT_EXCEL_HEADERS, PRODUCT_EXCEL_CONSERVATION_COLUMNS
+from utils_excel import ExcelSheet, send_xlsx, EXPORT_YIELD_PER
+from utils_label_preview import label_preview_response
+from utils_product_search import get_location_index, search_products, invalidate_product_search, DEFAULT_SEARCH_LIMIT
+from utils_storage import store_upload, storage_relative_path, release_upload, send_stored_file
 from weekly_tasks_reset_service import reset_weekly_tasks, process_custom_tasks_for_week
+from printer_status_service import start_printer_status_service, refresh_printer_statuses, is_status_online
 
 # Crear el Blueprint para las tareas
 tasks_bp = Blueprint('tasks', __name__)
@@ -643,17 +651,9 @@ def create_local_user(location_id):
         
         # Guardar foto si se proporciona
         if form.photo.data:
-            filename = secure_filename(form.photo.data.filename)
-            # Generar nombre único para evitar colisiones
-            unique_filename = f"user_{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-            photo_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'local_users', unique_filename)
-            
-            # Asegurar que existe el directorio
-            os.makedirs(os.path.dirname(photo_path), exist_ok=True)
-            
-            # Guardar archivo
-            form.photo.data.save(photo_path)
-            user.photo_path = os.path.join('local_users', unique_filename)
+            # Almacén por contenido: la misma foto subida dos veces se guarda una vez
+            stored = store_upload(form.photo.data)
+            user.photo_path = storage_relative_path(stored.sha256)
         
         db.session.add(user)
         db.session.commit()
@@ -700,23 +700,12 @@ def edit_local_user(location_id, id):
         
         # Actualizar foto si se proporciona
         if form.photo.data:
-            # Eliminar foto anterior si existe
+            # Liberar foto anterior si existe
             if user.photo_path:
-                old_photo_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.photo_path)
-                if os.path.exists(old_photo_path):
-                    os.remove(old_photo_path)
-            
-            filename = secure_filename(form.photo.data.filename)
-            # Generar nombre único para evitar colisiones
-            unique_filename = f"user_{datetime.now().strftime('%Y%m%d%H%M%S')}_{filename}"
-            photo_path = os.path.join(current_app.config['UPLOAD_FOLDER'], 'local_users', unique_filename)
-            
-            # Asegurar que existe el directorio
-            os.makedirs(os.path.dirname(photo_path), exist_ok=True)
+                release_upload(user.photo_path)
             
-            # Guardar archivo
-            form.photo.data.save(photo_path)
-            user.photo_path = os.path.join('local_users', unique_filename)
+            stored = store_upload(form.photo.data)
+            user.photo_path = storage_relative_path(stored.sha256)
         
         db.session.commit()
         
@@ -756,11 +745,9 @@ def delete_local_user(location_id, id):
         flash('No se puede eliminar este usuario porque tiene tareas completadas asociadas.', 'warning')
         return redirect(url_for('tasks.list_local_users', location_id=location_id))
     
-    # Eliminar foto si existe
+    # Liberar foto si existe
     if user.photo_path:
-        photo_path = os.path.join(current_app.config['UPLOAD_FOLDER'], user.photo_path)
-        if os.path.exists(photo_path):
-            os.remove(photo_path)
+        release_upload(user.photo_path)
     
     name = user.name
     db.session.delete(user)
@@ -770,6 +757,26 @@ def delete_local_user(location_id, id):
     flash(f'Usuario "{name}" eliminado correctamente.', 'success')
     return redirect(url_for('tasks.list_local_users', location_id=location_id))
 
+@tasks_bp.route('/local-users/<int:id>/photo')
+def local_user_photo(id):
+    """Foto de un usuario local (para la gestión de usuarios y para el portal del local)"""
+    user = db.session.execute(
+        db.select(LocalUser.photo_path, LocalUser.location_id, Location.company_id)
+        .join(Location, Location.id == LocalUser.location_id)
+        .where(LocalUser.id == id)
+    ).first()
+    if user is None or not user.photo_path:
+        abort(404)
+    
+    # Usuarios de la empresa del local (empresas en caché) o portal del propio local
+    if current_user.is_authenticated:
+        if not can_access_company(user.company_id):
+            abort(403)
+    elif not session.get('portal_authenticated') or session.get('portal_location_id') != user.location_id:
+        abort(403)
+    
+    return send_stored_file(user.photo_path)
+
 # Rutas para gestión de tareas
 @tasks_bp.route('/locations/<int:location_id>/tasks')
 @login_required
@@ -2308,6 +2315,144 @@ def ajax_complete_task(task_id):
         'completedAt': datetime.now().strftime('%H:%M')
     })
 
+# Número máximo de tareas aceptadas en una sola petición de completado por lotes
+BATCH_COMPLETE_MAX_TASKS = 200
+
+# Productos que se muestran a la vez en el portal de etiquetas (el resto, con el buscador)
+PORTAL_PRODUCTS_LIMIT = 48
+
+@tasks_bp.route('/local-user/tasks/batch-complete', methods=['POST'])
+@local_user_required
+def ajax_batch_complete_tasks():
+    """
+    Marcar varias tareas como completadas en una sola petición (versión AJAX por lotes).
+
+    Espera un JSON con la forma {"tasks": [{"id": 1, "notes": "..."}, ...]}; también
+    acepta {"task_ids": [1, 2, ...], "notes": {"1": "..."}}. Valida todas las tareas contra
+    el local del usuario en una sola consulta, crea los TaskCompletion y actualiza las
+    TaskInstance del día en una única transacción, y devuelve el resultado de cada tarea.
+    """
+    if not request.is_json:
+        return jsonify({'error': 'Se requiere petición JSON'}), 400
+
+    data = request.get_json(silent=True) or {}
+
+    # Normalizar la entrada a una lista ordenada de (task_id, notas) sin duplicados
+    raw_items = data.get('tasks')
+    if raw_items is None:
+        notes_by_id = data.get('notes') or {}
+        if not isinstance(notes_by_id, dict):
+            notes_by_id = {}
+        raw_items = [{'id': task_id, 'notes': notes_by_id.get(str(task_id), '')}
+                     for task_id in (data.get('task_ids') or [])]
+
+    if not isinstance(raw_items, list) or not raw_items:
+        return jsonify({'error': 'No se han indicado tareas'}), 400
+
+    if len(raw_items) > BATCH_COMPLETE_MAX_TASKS:
+        return jsonify({'error': f'Máximo {BATCH_COMPLETE_MAX_TASKS} tareas por petición'}), 400
+
+    requested = {}
+    results = {}
+    order = []
+    for item in raw_items:
+        if isinstance(item, dict):
+            raw_id, notes = item.get('id'), item.get('notes') or ''
+        else:
+            raw_id, notes = item, ''
+        try:
+            task_id = int(raw_id)
+        except (TypeError, ValueError):
+            if str(raw_id) not in results:
+                order.append(str(raw_id))
+            results[str(raw_id)] = {'taskId': raw_id, 'success': False, 'error': 'Identificador de tarea no válido'}
+            continue
+        if task_id not in requested:
+            order.append(str(task_id))
+            requested[task_id] = str(notes)
+
+    user_id = session['local_user_id']
+    user = LocalUser.query.get_or_404(user_id)
+    today = date.today()
+
+    # Validar todas las tareas contra el local del usuario en una sola consulta
+    tasks = {}
+    if requested:
+        tasks = {task.id: task for task in Task.query.filter(
+            Task.id.in_(list(requested)),
+            Task.location_id == user.location_id
+        ).all()}
+
+    # Tareas que este usuario ya completó hoy (una sola consulta)
+    already_completed = set()
+    if tasks:
+        already_completed = {row.task_id for row in db.session.query(TaskCompletion.task_id).filter(
+            TaskCompletion.task_id.in_(list(tasks)),
+            TaskCompletion.local_user_id == user_id,
+            db.func.date(TaskCompletion.completion_date) == today
+        ).all()}
+
+    completed_tasks = []
+    for task_id, notes in requested.items():
+        task = tasks.get(task_id)
+        if task is None:
+            results[str(task_id)] = {'taskId': task_id, 'success': False,
+                                     'error': 'Tarea no válida para este local'}
+            continue
+        if task_id in already_completed:
+            results[str(task_id)] = {'taskId': task_id, 'success': False,
+                                     'error': 'Ya has completado esta tarea hoy'}
+            continue
+
+        db.session.add(TaskCompletion(task_id=task.id, local_user_id=user_id, notes=notes))
+
+        # Actualizar el estado de la tarea a completada
+        task.status = TaskStatus.COMPLETADA
+        if task.frequency == TaskFrequency.SEMANAL:
+            task.current_week_completed = True
+        elif task.frequency == TaskFrequency.FECHA_ESPECIFICA:
+            task.current_month_completed = True
+
+        completed_tasks.append(task)
+
+    completed_at = datetime.now().strftime('%H:%M')
+
+    if completed_tasks:
+        try:
+            # Actualizar de una vez las instancias programadas para hoy
+            TaskInstance.query.filter(
+                TaskInstance.task_id.in_([task.id for task in completed_tasks]),
+                TaskInstance.scheduled_date == today
+            ).update({
+                TaskInstance.status: TaskStatus.COMPLETADA,
+                TaskInstance.completed_by_id: user_id,
+                TaskInstance.updated_at: datetime.utcnow()
+            }, synchronize_session=False)
+
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            current_app.logger.error(f"Error al completar tareas por lotes: {str(e)}")
+            return jsonify({'error': 'Error al completar las tareas'}), 500
+
+        log_activity(f'Tareas completadas por lotes ({len(completed_tasks)}) por {user.name}')
+
+    for task in completed_tasks:
+        results[str(task.id)] = {
+            'taskId': task.id,
+            'success': True,
+            'taskTitle': task.title,
+            'completedBy': f"{user.name} {user.last_name}",
+            'completedAt': completed_at
+        }
+
+    return jsonify({
+        'success': len(completed_tasks) > 0,
+        'completed': len(completed_tasks),
+        'failed': len(results) - len(completed_tasks),
+        'results': [results[key] for key in order]
+    })
+
 # API para regenerar contraseña del portal
 @tasks_bp.route('/api/regenerate-password/<int:location_id>', methods=['GET', 'POST'])
 @login_required
@@ -2503,25 +2648,51 @@ def local_user_labels():
     user = LocalUser.query.get_or_404(user_id)
     location = user.location
     
-    # Obtener los productos disponibles para este local
-    products = Product.query.filter_by(location_id=location.id, is_active=True).order_by(Product.name).all()
+    # Buscar en el índice de productos del local; sin búsqueda se muestran los primeros
+    # por orden alfabético y el resto se encuentra con el buscador
+    search_query = request.args.get('q', '')
+    search_index = get_location_index(location.id)
+    matches = search_index.search(search_query, PORTAL_PRODUCTS_LIMIT)
+    
+    # Cargar solo los productos que se muestran, en el orden de la búsqueda
+    product_ids = [product_id for product_id, _ in matches]
+    products_by_id = {product.id: product for product in Product.query.filter(
+        Product.id.in_(product_ids)
+    ).options(selectinload(Product.conservation_types)).all()} if product_ids else {}
+    products = [products_by_id[product_id] for product_id in product_ids if product_id in products_by_id]
     
     # Obtener impresoras configuradas
     printers = NetworkPrinter.query.filter_by(location_id=location.id).all()
     
-    # Filtro de búsqueda (si existe)
-    search_query = request.args.get('q', '')
-    if search_query:
-        products = [p for p in products if search_query.lower() in p.name.lower()]
-    
     return render_template('tasks/local_user_labels.html', 
                            title='Selección de Producto',
                            user=user, 
                            location=location, 
                            products=products, 
+                           total_products=len(search_index),
                            printers=printers,
                            search_query=search_query)
 
+@tasks_bp.route('/local-user/labels/search')
+@local_user_required
+def local_user_product_search():
+    """Autocompletado de productos del local del usuario (JSON)"""
+    user = LocalUser.query.get_or_404(session['local_user_id'])
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int)
+    
+    results = search_products(user.location_id, query, limit)
+    
+    return jsonify({
+        'success': True,
+        'query': query,
+        'results': [{
+            'id': product_id,
+            'name': name,
+            'url': url_for('tasks.product_conservation_selection', product_id=product_id)
+        } for product_id, name in results]
+    })
+
 
 @tasks_bp.route('/local-user/raspberry-pi-setup')
 @local_user_required
@@ -2543,6 +2714,31 @@ def raspberry_pi_setup_optimized():
     
     return render_template('tasks/raspberry_pi_setup_optimized.html', user=user, location=location)
 
+@tasks_bp.route('/local-user/labels/<int:product_id>/preview/<conservation_type>.png')
+@local_user_required
+def local_user_label_preview(product_id, conservation_type):
+    """Vista previa (PNG) de la etiqueta de un producto, servida desde la caché de vistas previas"""
+    user = LocalUser.query.get_or_404(session['local_user_id'])
+    product = Product.query.get_or_404(product_id)
+    
+    # Verificar que el producto pertenece al local del usuario
+    if product.location_id != user.location_id:
+        return "Error: El producto no pertenece a este local", 403
+    
+    try:
+        conservation_type = ConservationType(conservation_type)
+    except ValueError:
+        return "Error: Tipo de conservación no válido", 400
+    
+    conservation = ProductConservation.query.filter_by(
+        product_id=product.id,
+        conservation_type=conservation_type
+    ).first()
+    template = LabelTemplate.query.filter_by(location_id=user.location_id, is_default=True).first()
+    
+    return label_preview_response(product, user, conservation_type,
+                                  conservation=conservation, template=template)
+
 # Página de selección de conservación para un producto específico
 @tasks_bp.route('/local-user/labels/<int:product_id>')
 @local_user_required
@@ -2563,11 +2759,17 @@ def product_conservation_selection(product_id):
     # Obtener la fecha y hora actual
     now = datetime.now()
     
+    # Impresoras de red del local para imprimir desde el servidor (cola de impresión)
+    printers = NetworkPrinter.query.filter_by(location_id=user.location_id, is_active=True).order_by(
+        NetworkPrinter.is_default.desc(), NetworkPrinter.name
+    ).all()
+    
     return render_template('tasks/product_conservation_selection.html',
                           title=f'Etiqueta para: {product.name}',
                           user=user,
                           location=location,
                           product=product,
+                          printers=printers,
                           now=now)
 
 # Rutas para gestión de impresoras de red
@@ -2609,6 +2811,14 @@ def list_printers(location_id=None):
         printers = []
         locations = []
     
+    # El estado mostrado es el que guarda el servicio en segundo plano; al pedir
+    # refrescar se comprueban todas las impresoras listadas en paralelo
+    start_printer_status_service()
+    if request.args.get('refresh') and printers:
+        refresh_printer_statuses(printer_ids=[printer.id for printer in printers])
+        for printer in printers:
+            db.session.refresh(printer)
+    
     return render_template('tasks/printer_list.html',
                           title='Gestión de Impresoras',
                           printers=printers,
@@ -2879,6 +3089,64 @@ def api_get_printers(location_id):
         'printers': printer_list
     })
 
+@tasks_bp.route('/api/print-jobs/<int:job_id>')
+def api_get_print_job(job_id):
+    """API para consultar el estado de un trabajo de impresión de etiquetas"""
+    job = PrintJob.query.get_or_404(job_id)
+    
+    # Verificar acceso: usuario local del mismo local o admin/gerente de la empresa
+    if 'local_user_id' in session:
+        user = LocalUser.query.get(session['local_user_id'])
+        if not user or user.location_id != job.location_id:
+            return jsonify({'error': 'Acceso denegado'}), 403
+    elif current_user.is_authenticated:
+        if not current_user.is_admin():
+            company_ids = [c.id for c in current_user.companies] if current_user.is_gerente() else []
+            if job.location.company_id not in company_ids:
+                return jsonify({'error': 'Acceso denegado'}), 403
+    else:
+        return jsonify({'error': 'Acceso denegado'}), 403
+    
+    return jsonify({
+        'success': True,
+        'job': job.to_dict()
+    })
+
+@tasks_bp.route('/api/print-jobs/location/<int:location_id>')
+@login_required
+def api_get_location_print_jobs(location_id):
+    """API para obtener los últimos trabajos de impresión de una ubicación
+    
+    Parámetros Query:
+    - status: Filtrar por estado (pendiente, imprimiendo, completado, error)
+    - limit: Número máximo de trabajos (por defecto 50)
+    """
+    location = Location.query.get_or_404(location_id)
+    
+    # Verificar acceso
+    if not current_user.is_admin():
+        company_ids = [c.id for c in current_user.companies] if current_user.is_gerente() else []
+        if location.company_id not in company_ids:
+            return jsonify({'error': 'Acceso denegado'}), 403
+    
+    query = PrintJob.query.filter_by(location_id=location_id)
+    
+    status = request.args.get('status')
+    if status:
+        try:
+            query = query.filter(PrintJob.status == PrintJobStatus(status))
+        except ValueError:
+            return jsonify({'error': 'Estado no válido'}), 400
+    
+    limit = max(1, min(200, request.args.get('limit', 50, type=int)))
+    jobs = query.order_by(PrintJob.created_at.desc()).limit(limit).all()
+    
+    return jsonify({
+        'success': True,
+        'location_id': location_id,
+        'jobs': [job.to_dict() for job in jobs]
+    })
+
 @tasks_bp.route('/test-label')
 def test_label():
     """Página de test simple para impresora Brother TD-4550DNWB."""
@@ -3040,6 +3308,36 @@ def label_editor(location_id):
                           location=location,
                           template=template)
 
+@tasks_bp.route('/locations/<int:location_id>/label-editor/preview.png')
+@login_required
+@manager_required
+def label_editor_preview(location_id):
+    """Vista previa (PNG) de la etiqueta impresa con la plantilla predeterminada del local"""
+    location = Location.query.get_or_404(location_id)
+    
+    # Verificar permisos
+    if not current_user.is_admin() and (not current_user.is_gerente() or location.company_id not in [c.id for c in current_user.companies]):
+        return "Error: No tienes permiso para ver etiquetas de este local", 403
+    
+    template = LabelTemplate.query.filter_by(location_id=location_id, is_default=True).first()
+    
+    # Se usa el primer producto del local como ejemplo (o uno ficticio si no hay)
+    product = Product.query.filter_by(location_id=location_id, is_active=True).order_by(Product.name).first()
+    conservation = None
+    if product is not None and product.conservation_types:
+        conservation = product.conservation_types[0]
+        conservation_type = conservation.conservation_type
+    else:
+        conservation_type = ConservationType.REFRIGERACION
+    if product is None:
+        product = SimpleNamespace(id=None, name='Producto de ejemplo', shelf_life_days=0, updated_at=None)
+    
+    user = SimpleNamespace(name=current_user.first_name or current_user.username,
+                           last_name=current_user.last_name, username=current_user.username)
+    
+    return label_preview_response(product, user, conservation_type,
+                                  conservation=conservation, template=template)
+
 @tasks_bp.route('/locations/<int:location_id>/label-templates', methods=['GET'])
 @login_required
 @manager_required
@@ -3262,63 +3560,25 @@ def export_labels_excel(location_id):
         flash('No tienes permiso para exportar datos de este local.', 'danger')
         return redirect(url_for('tasks.manage_labels'))
     
-    # Crear un nuevo libro de Excel
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Productos"
-    
-    # Añadir encabezados
-    ws['A1'] = "Nombre"
-    ws['B1'] = "Descripción"
-    ws['C1'] = "Vida útil (días)"
-    ws['D1'] = "Descongelación (horas)"
-    ws['E1'] = "Refrigeración (horas)"
-    ws['F1'] = "Gastro (horas)"
-    ws['G1'] = "Caliente (horas)"
-    ws['H1'] = "Seco (horas)"
-    
-    # Obtener productos de este local
-    products = Product.query.filter_by(location_id=location_id).order_by(Product.name).all()
+    # Obtener productos de este local con sus conservaciones, por lotes
+    products = Product.query.filter_by(location_id=location_id).options(
+        selectinload(Product.conservation_types)
+    ).order_by(Product.name).yield_per(EXPORT_YIELD_PER)
     
-    # Rellenar datos
-    row = 2
-    for product in products:
-        ws[f'A{row}'] = product.name
-        ws[f'B{row}'] = product.description or ""
-        ws[f'C{row}'] = product.shelf_life_days
-        
-        # Buscar horas de conservación para cada tipo
-        for conservation in product.conservation_types:
+    def product_rows():
+        for product in products:
             # Usar horas directamente
-            hours_valid = conservation.hours_valid
-            
-            if conservation.conservation_type == ConservationType.DESCONGELACION:
-                ws[f'D{row}'] = hours_valid
-            elif conservation.conservation_type == ConservationType.REFRIGERACION:
-                ws[f'E{row}'] = hours_valid
-            elif conservation.conservation_type == ConservationType.GASTRO:
-                ws[f'F{row}'] = hours_valid
-            elif conservation.conservation_type == ConservationType.CALIENTE:
-                ws[f'G{row}'] = hours_valid
-            elif conservation.conservation_type == ConservationType.SECO:
-                ws[f'H{row}'] = hours_valid
-        
-        row += 1
-    
-    # Guardar a un objeto BytesIO
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+            hours = {conservation.conservation_type: conservation.hours_valid
+                     for conservation in product.conservation_types}
+            yield [product.name, product.description or "", product.shelf_life_days] + [
+                hours.get(cons_type) for cons_type in PRODUCT_EXCEL_CONSERVATION_COLUMNS
+            ]
     
     # Crear nombre de archivo basado en la ubicación
     filename = f"productos_{location.name.replace(' ', '_').lower()}_{datetime.now().strftime('%Y%m%d')}.xlsx"
     
-    return send_file(
-        output,
-        download_name=filename,
-        as_attachment=True,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
-    )
+    return send_xlsx([ExcelSheet("Productos", PRODUCT_EXCEL_HEADERS, product_rows())],
+                     filename, styled_headers=False)
 
 @tasks_bp.route('/dashboard/labels/import/<int:location_id>', methods=['POST'])
 @login_required
@@ -3349,109 +3609,38 @@ def import_labels_excel(location_id):
         flash('El archivo debe ser un archivo Excel (.xlsx).', 'danger')
         return redirect(url_for('tasks.manage_labels', location_id=location_id))
     
+    dry_run = bool(request.form.get('dry_run'))
+    
     try:
-        # Cargar el archivo Excel
-        wb = openpyxl.load_workbook(file)
-        ws = wb.active
-        
-        # Contar productos actualizados y creados
-        updated = 0
-        created = 0
-        errors = 0
+        # Importar en modo streaming con escrituras por bloques
+        result = import_products_excel(file.stream, location_id, dry_run=dry_run)
         
-        # Empezar desde la fila 2 (después de encabezados)
-        for row in range(2, ws.max_row + 1):
-            try:
-                # Obtener datos del producto
-                product_name = ws[f'A{row}'].value
-                product_description = ws[f'B{row}'].value or ""
-                
-                # Si no hay nombre, ignorar esta fila
-                if not product_name:
-                    continue
-                
-                # Vida útil en días (caducidad secundaria)
-                shelf_life_days = ws[f'C{row}'].value
-                shelf_life_days = int(shelf_life_days) if shelf_life_days is not None else 0
-                
-                # Horas para cada tipo de conservación
-                hours_descongelacion = ws[f'D{row}'].value
-                hours_refrigeracion = ws[f'E{row}'].value
-                hours_gastro = ws[f'F{row}'].value
-                hours_caliente = ws[f'G{row}'].value
-                hours_seco = ws[f'H{row}'].value
-                
-                # Usar horas directamente para almacenar en la base de datos
-                hours_descongelacion = int(hours_descongelacion) if hours_descongelacion is not None else None
-                hours_refrigeracion = int(hours_refrigeracion) if hours_refrigeracion is not None else None
-                hours_gastro = int(hours_gastro) if hours_gastro is not None else None
-                hours_caliente = int(hours_caliente) if hours_caliente is not None else None
-                hours_seco = int(hours_seco) if hours_seco is not None else None
-                
-                # Buscar producto existente por nombre en esta ubicación
-                product = Product.query.filter_by(name=product_name, location_id=location_id).first()
-                
-                if product:
-                    # Actualizar producto existente
-                    product.name = product_name
-                    product.description = product_description
-                    product.shelf_life_days = shelf_life_days
-                    updated += 1
-                else:
-                    # Crear nuevo producto
-                    product = Product(
-                        name=product_name,
-                        description=product_description,
-                        shelf_life_days=shelf_life_days,
-                        location_id=location_id
-                    )
-                    db.session.add(product)
-                    db.session.flush()  # Para obtener el ID generado
-                    created += 1
-                
-                # Actualizar tipos de conservación
-                conservation_types = [
-                    (ConservationType.DESCONGELACION, hours_descongelacion),
-                    (ConservationType.REFRIGERACION, hours_refrigeracion),
-                    (ConservationType.GASTRO, hours_gastro),
-                    (ConservationType.CALIENTE, hours_caliente),
-                    (ConservationType.SECO, hours_seco)
-                ]
-                
-                for cons_type, hours in conservation_types:
-                    if hours is not None and hours > 0:
-                        # Buscar conservación existente o crear una nueva
-                        conservation = ProductConservation.query.filter_by(
-                            product_id=product.id, 
-                            conservation_type=cons_type
-                        ).first()
-                        
-                        if conservation:
-                            conservation.hours_valid = hours
-                        else:
-                            conservation = ProductConservation(
-                                product_id=product.id,
-                                conservation_type=cons_type,
-                                hours_valid=hours
-                            )
-                            db.session.add(conservation)
+        if dry_run:
+            db.session.rollback()
+        else:
+            # Guardar todos los cambios
+            db.session.commit()
             
-            except Exception as e:
-                # Registrar error y continuar con la siguiente fila
-                errors += 1
-                current_app.logger.error(f"Error al importar fila {row}: {str(e)}")
+            # Las escrituras masivas no pasan por los eventos del ORM
+            invalidate_product_search(location_id)
+            
+            # Registrar actividad
+            log_activity(f'Importación de productos desde Excel para {location.name}: {result.created} creados, {result.updated} actualizados')
         
-        # Guardar todos los cambios
-        db.session.commit()
+        for error in result.errors:
+            current_app.logger.warning(f"Error al importar fila {error.row_number}: {error.message}")
         
-        # Mostrar mensaje de éxito
-        if errors > 0:
-            flash(f'Importación completada con {created} productos creados, {updated} actualizados y {errors} errores.', 'warning')
-        else:
-            flash(f'Importación completada con éxito: {created} productos creados y {updated} actualizados.', 'success')
+        # La previsualización y las importaciones con errores muestran el informe por filas
+        if dry_run or result.errors:
+            return render_template('tasks/import_labels_report.html',
+                                  title=f'Importación de productos - {location.name}',
+                                  location=location,
+                                  result=result,
+                                  filename=file.filename)
         
-        # Registrar actividad
-        log_activity(f'Importación de productos desde Excel para {location.name}: {created} creados, {updated} actualizados')
+        # Mostrar mensaje de éxito
+        flash(f'Importación completada con éxito: {result.created} productos creados, {result.updated} actualizados '
+              f'y {result.unchanged} sin cambios.', 'success')
         
     except Exception as e:
         db.session.rollback()
@@ -3513,14 +3702,7 @@ def generate_labels():
             expiry_datetime = now + timedelta(hours=conservation.hours_valid)
         else:
             # Valores predeterminados por tipo
-            hours_map = {
-                ConservationType.DESCONGELACION: 24,  # 1 día
-                ConservationType.REFRIGERACION: 72,   # 3 días
-                ConservationType.GASTRO: 48,          # 2 días
-                ConservationType.CALIENTE: 2,         # 2 horas
-                ConservationType.SECO: 720            # 30 días
-            }
-            hours = hours_map.get(conservation_type, 24)  # 24h por defecto
+            hours = DEFAULT_CONSERVATION_HOURS.get(conservation_type, 24)  # 24h por defecto
             expiry_datetime = now + timedelta(hours=hours)
             
         # Calcular fecha de caducidad secundaria (por vida útil en días)
@@ -3541,16 +3723,10 @@ def generate_labels():
             db.session.add(template)
             db.session.commit()
         
-        # Registrar las etiquetas en la base de datos
+        # Registrar el lote de etiquetas en la base de datos (un registro por lote)
         try:
-            for _ in range(quantity):
-                label = ProductLabel(
-                    product_id=product.id,
-                    local_user_id=user.id,
-                    conservation_type=conservation_type,
-                    expiry_date=expiry_datetime.date()
-                )
-                db.session.add(label)
+            ProductLabel.record_batch(product.id, user.id, conservation_type,
+                                      expiry_datetime.date(), quantity, template_id=template.id)
             db.session.commit()
         except Exception as e:
             db.session.rollback()
@@ -3587,16 +3763,11 @@ def generate_labels():
                 # Usar valor predeterminado si no hay configuración específica (3 días)
                 refrigeration_expiry_datetime = expiry_datetime + timedelta(hours=72)
                 
-            # Registrar etiquetas de refrigeración
+            # Registrar el lote de etiquetas de refrigeración
             try:
-                for _ in range(quantity):
-                    label = ProductLabel(
-                        product_id=product.id,
-                        local_user_id=user.id,
-                        conservation_type=refrigeration_conservation_type,
-                        expiry_date=refrigeration_expiry_datetime.date()
-                    )
-                    db.session.add(label)
+                ProductLabel.record_batch(product.id, user.id, refrigeration_conservation_type,
+                                          refrigeration_expiry_datetime.date(), quantity,
+                                          template_id=template.id)
                 db.session.commit()
             except Exception as e:
                 db.session.rollback()
@@ -3611,120 +3782,42 @@ def generate_labels():
         if True:  # Cambiado temporalmente para debugging
             try:
                 # Generar la imagen de la etiqueta para enviar a la impresora Brother
-                from PIL import Image, ImageDraw, ImageFont
-                import io
-                import base64
-                
-                # Crear imagen de 472x354 píxeles (40mm x 30mm a 300 DPI)
-                width, height = 472, 354  # 40mm x 30mm a 300 DPI
-                image = Image.new('RGB', (width, height), 'white')
-                draw = ImageDraw.Draw(image)
-                
-                # Fuentes optimizadas para 40mm x 30mm con diferentes tamaños
-                try:
-                    font_title = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 42)    # Título más grande
-                    font_type = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 28)     # Tipo conservación
-                    font_date = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 34)     # Fecha caducidad
-                    font_elab = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 24)     # Elaboración
-                    font_vida = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 26)     # Vida útil más pequeña
-                    font_user = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf", 32)     # Usuario aún más grande
-                except:
-                    font_title = ImageFont.load_default()
-                    font_type = ImageFont.load_default()
-                    font_date = ImageFont.load_default()
-                    font_elab = ImageFont.load_default()
-                    font_vida = ImageFont.load_default()
-                    font_user = ImageFont.load_default()
-                
-                # Layout que ocupa toda la altura disponible con mayor separación
-                y_pos = 8  # Comenzar con más margen superior
+                # (fuentes en caché y diseño precompilado, solo se dibujan los campos variables)
+                from utils_labels import render_product_label, label_image_to_base64
                 
-                # Nombre del producto (centrado, título principal)
-                product_name = product.name[:18].upper()  # Limitar caracteres para que encaje
-                # Ajustar fuente si el nombre es muy largo
-                current_font = font_title
-                if len(product_name) > 14:
-                    current_font = font_type
+                image = render_product_label(product, user, conservation_type, now,
+                                             expiry_datetime, template=template)
+                image_base64 = label_image_to_base64(image)
                 
-                bbox = draw.textbbox((0, 0), product_name, font=current_font)
-                text_width = bbox[2] - bbox[0]
-                x_centered = (width - text_width) // 2
-                draw.text((x_centered, y_pos), product_name, fill='black', font=current_font)
-                y_pos += 58  # Más separación
+                # Etiqueta de refrigeración generada automáticamente tras la descongelación
+                refrigeration_image = None
+                refrigeration_image_base64 = None
+                if auto_generate_refrigeration and refrigeration_conservation_type:
+                    refrigeration_image = render_product_label(
+                        product, user, refrigeration_conservation_type, expiry_datetime,
+                        refrigeration_expiry_datetime, template=template, start_prefix='INICIO')
+                    refrigeration_image_base64 = label_image_to_base64(refrigeration_image)
                 
-                # Tipo de conservación (centrado)
-                conservation_text = conservation_type.value.upper()
-                bbox = draw.textbbox((0, 0), conservation_text, font=font_type)
-                text_width = bbox[2] - bbox[0]
-                x_centered = (width - text_width) // 2
-                draw.text((x_centered, y_pos), conservation_text, fill='black', font=font_type)
-                y_pos += 55  # Más separación antes de CAD
-                
-                # Fecha de caducidad con hora si existe (centrada)
-                if expiry_datetime:
-                    expiry_str = expiry_datetime.strftime('%d/%m/%Y %H:%M')
-                    expiry_text = f"CAD: {expiry_str}"
-                    bbox = draw.textbbox((0, 0), expiry_text, font=font_date)
-                    text_width = bbox[2] - bbox[0]
-                    x_centered = (width - text_width) // 2
-                    draw.text((x_centered, y_pos), expiry_text, fill='black', font=font_date)
-                    y_pos += 90  # Más separación después de CAD
-                
-                # Fecha de elaboración con hora (centrada) - fuente más pequeña
-                now_str = now.strftime('%d/%m/%Y %H:%M')
-                elaboration_text = f"ELAB: {now_str}"
-                bbox = draw.textbbox((0, 0), elaboration_text, font=font_elab)
-                text_width = bbox[2] - bbox[0]
-                x_centered = (width - text_width) // 2
-                draw.text((x_centered, y_pos), elaboration_text, fill='black', font=font_elab)
-                y_pos += 42  # Separación normal
-                
-                # Mostrar fecha de vida útil (centrada) - fecha de hoy + días de vida útil
-                shelf_life_text = ""
-                if product.shelf_life_days and product.shelf_life_days > 0:
-                    # Calcular fecha de caducidad por vida útil: fecha actual + días de vida útil
-                    shelf_life_expiry = now.date() + timedelta(days=product.shelf_life_days)
-                    shelf_life_str = shelf_life_expiry.strftime('%d/%m/%Y')
-                    shelf_life_text = f"1ᵃ {shelf_life_str}"
-                
-                if shelf_life_text:
-                    bbox = draw.textbbox((0, 0), shelf_life_text, font=font_vida)
-                    text_width = bbox[2] - bbox[0]
-                    x_centered = (width - text_width) // 2
-                    draw.text((x_centered, y_pos), shelf_life_text, fill='black', font=font_vida)
-                    y_pos += 42  # Más separación
-                
-                # Formatear nombre del usuario: primer nombre + primera letra apellido
-                def format_user_name(name, last_name):
-                    try:
-                        # Usar los campos name y last_name del LocalUser
-                        if name and last_name:
-                            # Primer nombre + primera letra del apellido
-                            return f"{name} {last_name[0]}."
-                        elif name:
-                            # Si solo hay nombre, devolverlo
-                            return name
-                        else:
-                            # Fallback al username si no hay name/last_name
-                            return user.username[:12]
-                    except:
-                        # En caso de error, devolver el username original
-                        return user.username[:12]
-                
-                # Usuario (centrado, con formato mejorado)
-                formatted_user = format_user_name(user.name, user.last_name)
-                user_text = f"{formatted_user}"
-                bbox = draw.textbbox((0, 0), user_text, font=font_user)
-                text_width = bbox[2] - bbox[0]
-                x_centered = (width - text_width) // 2
-                # Posicionar con un poco más de separación
-                draw.text((x_centered, y_pos), user_text, fill='black', font=font_user)
-                
-                # Convertir imagen a base64
-                buffer = io.BytesIO()
-                image.save(buffer, format='PNG')
-                buffer.seek(0)
-                image_base64 = base64.b64encode(buffer.getvalue()).decode('utf-8')
+                # Impresión desde el servidor: el lote se encola para la impresora y se
+                # devuelve el id del trabajo sin esperar a que la impresora responda
+                print_job = None
+                printer_id = request.form.get('printer_id', type=int)
+                if printer_id or request.form.get('print_to_server'):
+                    printer_query = NetworkPrinter.query.filter_by(location_id=user.location_id, is_active=True)
+                    if printer_id:
+                        printer = printer_query.filter_by(id=printer_id).first()
+                    else:
+                        printer = printer_query.order_by(NetworkPrinter.is_default.desc(), NetworkPrinter.id).first()
+                    if not printer:
+                        return jsonify({'success': False, 'message': 'Impresora no válida para este local'}), 404
+                    
+                    from print_queue_service import enqueue_print_job
+                    pages = [(image, quantity)]
+                    if refrigeration_image is not None:
+                        pages.append((refrigeration_image, quantity))
+                    print_job = enqueue_print_job(printer, pages, local_user_id=user.id,
+                                                  description=f"{product.name} - {conservation_type.value}")
+                    current_app.logger.info(f"Trabajo de impresión {print_job.id} encolado para {printer.name}")
                 
                 current_app.logger.info(f"Etiqueta generada exitosamente para {product.name}, tamaño: {len(image_base64)} caracteres")
                 
@@ -3737,7 +3830,10 @@ def generate_labels():
                     'quantity': quantity,
                     'expiry_datetime': expiry_datetime.strftime('%d/%m/%Y %H:%M') if expiry_datetime else None,
                     'label_image': image_base64,  # Imagen en base64 para enviar a la impresora
-                    'print_to_brother': True  # Indicar que debe imprimir con Brother
+                    'refrigeration_label_image': refrigeration_image_base64,
+                    'print_job': print_job.to_dict() if print_job else None,  # Trabajo encolado en el servidor
+                    'print_job_id': print_job.id if print_job else None,
+                    'print_to_brother': print_job is None  # Imprimir con Brother desde el dispositivo
                 })
                 
             except Exception as e:
@@ -3815,7 +3911,9 @@ def list_products(location_id=None):
         return redirect(url_for('tasks.list_locations'))
     
     # Obtener productos de esas ubicaciones
-    products = Product.query.filter(Product.location_id.in_(location_ids)).order_by(Product.name).all()
+    products = Product.query.filter(Product.location_id.in_(location_ids)).options(
+        selectinload(Product.location)
+    ).order_by(Product.name).all()
     
     título = f'Productos de {location.name}' if location else 'Productos'
     
@@ -3827,6 +3925,32 @@ def list_products(location_id=None):
         selected_location=location
     )
 
+@tasks_bp.route('/api/products/search/<int:location_id>')
+@login_required
+@manager_required
+def api_search_products(location_id):
+    """Autocompletado de productos de un local para el panel de gestión (JSON)"""
+    location = Location.query.get_or_404(location_id)
+    
+    # Verificar permisos
+    if not current_user.is_admin() and location.company_id not in [c.id for c in current_user.companies]:
+        return jsonify({'success': False, 'error': 'forbidden', 'message': 'Acceso no permitido a esta ubicación'}), 403
+    
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', DEFAULT_SEARCH_LIMIT, type=int)
+    
+    results = search_products(location_id, query, limit)
+    
+    return jsonify({
+        'success': True,
+        'query': query,
+        'results': [{
+            'id': product_id,
+            'name': name,
+            'url': url_for('tasks.edit_product', id=product_id)
+        } for product_id, name in results]
+    })
+
 @tasks_bp.route('/admin/products/create', methods=['GET', 'POST'])
 @tasks_bp.route('/admin/products/create/<int:location_id>', methods=['GET', 'POST'])
 @login_required
@@ -4119,11 +4243,14 @@ def api_check_printer_status(location_id):
             'message': 'No hay impresora configurada para esta ubicación'
         })
     
-    # Comprobar el estado de la impresora
-    is_online = printer.check_status()
+    # El estado lo mantiene el servicio en segundo plano; solo se comprueba ahora
+    # si se pide expresamente o si la impresora nunca se ha comprobado
+    start_printer_status_service()
+    if request.args.get('refresh') or printer.last_status_check is None:
+        refresh_printer_statuses(printer_ids=[printer.id])
+        db.session.refresh(printer)
     
-    # Actualizar la base de datos con el nuevo estado
-    db.session.commit()
+    is_online = is_status_online(printer.last_status)
     
     return jsonify({
         'success': True,
@@ -4134,6 +4261,42 @@ def api_check_printer_status(location_id):
         'last_check': printer.last_status_check.isoformat() if printer.last_status_check else None
     })
 
+@tasks_bp.route('/api/printers/status/<int:location_id>', methods=['GET', 'POST'])
+def api_location_printers_status(location_id):
+    """API para obtener el estado guardado de todas las impresoras de una ubicación
+    
+    Con POST o con el parámetro refresh=1 se comprueban antes todas las impresoras
+    de la ubicación en paralelo.
+    """
+    # Verificar si hay algún tipo de autenticación (portal o general)
+    if ('portal_authenticated' not in session or not session['portal_authenticated']) and not current_user.is_authenticated:
+        return jsonify({'success': False, 'error': 'unauthorized', 'message': 'No autorizado'}), 403
+    
+    # Si es usuario autenticado del portal, verificar que tenga acceso a esta ubicación
+    if 'portal_authenticated' in session and session['portal_authenticated'] and session.get('location_id') != location_id:
+        return jsonify({'success': False, 'error': 'forbidden', 'message': 'Acceso no permitido a esta ubicación'}), 403
+    
+    start_printer_status_service()
+    if request.method == 'POST' or request.args.get('refresh'):
+        refresh_printer_statuses(location_id=location_id)
+    
+    printers = NetworkPrinter.query.filter_by(location_id=location_id, is_active=True).order_by(
+        NetworkPrinter.is_default.desc(), NetworkPrinter.name
+    ).all()
+    
+    return jsonify({
+        'success': True,
+        'location_id': location_id,
+        'printers': [{
+            'printer_id': printer.id,
+            'printer_name': printer.name,
+            'is_default': printer.is_default,
+            'online': is_status_online(printer.last_status),
+            'status': printer.last_status,
+            'last_check': printer.last_status_check.isoformat() if printer.last_status_check else None
+        } for printer in printers]
+    })
+
 @tasks_bp.route('/api/printers/test-connection', methods=['POST'])
 def api_test_printer_connection():
     """API para probar la conexión con una impresora sin guardar la configuración"""
@@ -0,0 +1,118 @@
+"""
+Script para ejecutar el servicio de gastos fijos mensuales.
+
+Sin argumentos inicia el servicio, que añade los gastos fijos activos a cada
+mes el día 1, y lo mantiene en ejecución hasta que el proceso es terminado.
+Con --desde (y opcionalmente --hasta) añade una sola vez los gastos fijos que
+falten en ese rango de meses y termina.
+
+Uso:
+  python run_fixed_expenses.py
+  python run_fixed_expenses.py --desde 2025-01 [--hasta 2025-06] [--empresa ID]
+"""
+from app import create_app, db
+from fixed_expenses_service import start_fixed_expenses_service, get_service_status
+from utils_monthly_expenses import materialize_fixed_expenses
+import argparse
+import time
+import logging
+import signal
+import sys
+
+# Configurar logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("fixed_expenses.log"),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+# Variable para controlar la ejecución
+running = True
+
+def signal_handler(sig, frame):
+    """Manejador de señales para terminar el proceso correctamente."""
+    global running
+    logger.info(f"Recibida señal de terminación ({sig}). Deteniendo servicio...")
+    running = False
+    sys.exit(0)
+
+def parse_month(value):
+    """Convierte 'AAAA-MM' en (año, mes)."""
+    try:
+        year, month = (int(part) for part in value.split('-'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Mes no válido: {value} (formato AAAA-MM)")
+    if not 1 <= month <= 12:
+        raise argparse.ArgumentTypeError(f"Mes no válido: {value} (formato AAAA-MM)")
+    return year, month
+
+def run_once(app, start, end, company_id):
+    """Añade los gastos fijos que falten en un rango de meses."""
+    with app.app_context():
+        try:
+            created = materialize_fixed_expenses(start, end, company_ids=[company_id] if company_id else None)
+            db.session.commit()
+            logger.info(f"Gastos fijos creados: {created}")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error al crear los gastos fijos: {str(e)}")
+            sys.exit(1)
+
+def main():
+    """Función principal que inicia y mantiene el servicio en ejecución."""
+    parser = argparse.ArgumentParser(description="Gastos fijos mensuales")
+    parser.add_argument('--desde', type=parse_month, help="Primer mes a completar (AAAA-MM)")
+    parser.add_argument('--hasta', type=parse_month, help="Último mes a completar (AAAA-MM)")
+    parser.add_argument('--empresa', type=int, help="ID de la empresa (por defecto, todas)")
+    args = parser.parse_args()
+    
+    app = create_app()
+    
+    if args.desde:
+        run_once(app, args.desde, args.hasta or args.desde, args.empresa)
+        return
+    
+    # Registrar manejadores de señales
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    logger.info("Iniciando servicio de gastos fijos mensuales...")
+    
+    with app.app_context():
+        # Iniciar el servicio
+        success = start_fixed_expenses_service()
+        
+        if not success:
+            logger.error("Error al iniciar el servicio. Abortando.")
+            return
+        
+        # Obtener y mostrar el estado inicial
+        status = get_service_status()
+        logger.info(f"Servicio iniciado. Estado: {status}")
+        
+        # Mantener el proceso en ejecución
+        try:
+            logger.info("Servicio en ejecución. Presiona Ctrl+C para detener.")
+            
+            while running:
+                # Cada hora mostrar el estado actual
+                for _ in range(60):
+                    if running:
+                        time.sleep(60)  # Dormir 1 minuto entre verificaciones
+                
+                status = get_service_status()
+                logger.info(f"Estado actual del servicio: {status}")
+        
+        except KeyboardInterrupt:
+            logger.info("Interrupción de teclado detectada. Deteniendo servicio...")
+        
+        finally:
+            logger.info("Servicio finalizado.")
+
+if __name__ == "__main__":
+    main()
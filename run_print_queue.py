@@ -0,0 +1,71 @@
+"""
+Script para ejecutar el servicio de cola de impresión de etiquetas.
+
+Este script inicia un hilo por cada impresora de red activa que envía los
+trabajos pendientes de la tabla print_jobs y lo mantiene en ejecución hasta
+que el proceso es terminado. Puede ejecutarse junto a los workers web: cada
+trabajo solo lo envía el proceso que lo reserva.
+
+Uso:
+  python run_print_queue.py
+"""
+from app import create_app
+from print_queue_service import start_print_queue_service, stop_print_queue_service, get_service_status
+import time
+import logging
+import signal
+import sys
+
+# Configurar logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("print_queue.log"),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+# Variable para controlar la ejecución
+running = True
+
+def signal_handler(sig, frame):
+    """Manejador de señales para terminar el proceso correctamente."""
+    global running
+    logger.info(f"Recibida señal de terminación ({sig}). Deteniendo servicio...")
+    running = False
+
+def main():
+    """Función principal que inicia y mantiene el servicio en ejecución."""
+    app = create_app()
+    
+    # Registrar manejadores de señales
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    logger.info("Iniciando servicio de cola de impresión...")
+    
+    if not start_print_queue_service(app):
+        logger.error("Error al iniciar el servicio. Abortando.")
+        return
+    
+    try:
+        logger.info("Servicio en ejecución. Presiona Ctrl+C para detener.")
+        
+        while running:
+            # Cada 5 minutos mostrar el estado actual
+            for _ in range(300):
+                if not running:
+                    break
+                time.sleep(1)
+            
+            logger.info(f"Estado actual del servicio: {get_service_status()}")
+    
+    finally:
+        stop_print_queue_service()
+        logger.info("Servicio finalizado.")
+
+if __name__ == "__main__":
+    main()
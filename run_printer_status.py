@@ -0,0 +1,70 @@
+"""
+Script para ejecutar el servicio de estado de las impresoras de red.
+
+Este script comprueba periódicamente y en paralelo todas las impresoras de red
+activas y guarda su estado en la base de datos, de donde lo leen las vistas y la
+API. Si otro proceso acaba de comprobarlas, se salta esa vuelta.
+
+Uso:
+  python run_printer_status.py
+"""
+from app import create_app
+from printer_status_service import start_printer_status_service, stop_printer_status_service, get_service_status
+import time
+import logging
+import signal
+import sys
+
+# Configurar logging
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    handlers=[
+        logging.FileHandler("printer_status.log"),
+        logging.StreamHandler()
+    ]
+)
+
+logger = logging.getLogger(__name__)
+
+# Variable para controlar la ejecución
+running = True
+
+def signal_handler(sig, frame):
+    """Manejador de señales para terminar el proceso correctamente."""
+    global running
+    logger.info(f"Recibida señal de terminación ({sig}). Deteniendo servicio...")
+    running = False
+
+def main():
+    """Función principal que inicia y mantiene el servicio en ejecución."""
+    app = create_app()
+    
+    # Registrar manejadores de señales
+    signal.signal(signal.SIGINT, signal_handler)
+    signal.signal(signal.SIGTERM, signal_handler)
+    
+    logger.info("Iniciando servicio de estado de impresoras...")
+    
+    if not start_printer_status_service(app):
+        logger.error("Error al iniciar el servicio. Abortando.")
+        return
+    
+    try:
+        logger.info("Servicio en ejecución. Presiona Ctrl+C para detener.")
+        
+        while running:
+            # Cada 5 minutos mostrar el estado actual
+            for _ in range(300):
+                if not running:
+                    break
+                time.sleep(1)
+            
+            logger.info(f"Estado actual del servicio: {get_service_status()}")
+    
+    finally:
+        stop_printer_status_service()
+        logger.info("Servicio finalizado.")
+
+if __name__ == "__main__":
+    main()
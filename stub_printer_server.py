@@ -0,0 +1,117 @@
+"""
+Servidor HTTP mínimo que simula una impresora de etiquetas en red.
+
+Responde como el servidor de impresión de la Raspberry Pi (/print, /status, /health)
+y acepta cualquier otra ruta POST como una impresora Brother directa. Sirve para
+medir y probar el envío de etiquetas sin una impresora real.
+
+Uso:
+    python stub_printer_server.py [puerto] [retardo_en_segundos]
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubPrinterServer:
+    """Impresora simulada que registra los trabajos recibidos."""
+
+    def __init__(self, host='127.0.0.1', port=0, delay=0.0, fail_requests=0):
+        """
+        Args:
+            host: Dirección en la que escuchar
+            port: Puerto (0 = uno libre cualquiera)
+            delay: Segundos que tarda la impresora en responder a cada trabajo
+            fail_requests: Número de trabajos iniciales que se responden con error 503
+        """
+        self.delay = delay
+        self.fail_requests = fail_requests
+        self.received = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._make_handler())
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def url(self, path='/print'):
+        return f"http://{self._server.server_address[0]}:{self.port}{path}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _make_handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, format, *args):
+                pass
+
+            def _send_json(self, status, data):
+                body = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def do_GET(self):
+                if self.path in ('/status', '/health'):
+                    self._send_json(200, {'success': True, 'status': 'online', 'printer_status': 'ready'})
+                else:
+                    self._send_json(404, {'success': False})
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+
+                if stub.delay:
+                    time.sleep(stub.delay)
+
+                with stub._lock:
+                    if stub.fail_requests > 0:
+                        stub.fail_requests -= 1
+                        fail = True
+                    else:
+                        fail = False
+                        stub.received.append({
+                            'path': self.path,
+                            'content_type': self.headers.get('Content-Type'),
+                            'label_format': self.headers.get('X-Label-Format'),
+                            'bytes': len(body),
+                            'body': body,
+                        })
+
+                if fail:
+                    self._send_json(503, {'success': False, 'message': 'Impresora ocupada'})
+                else:
+                    self._send_json(200, {'success': True, 'message': 'Trabajo recibido'})
+
+        return Handler
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    delay = float(sys.argv[2]) if len(sys.argv) > 2 else 0.0
+    server = StubPrinterServer(host='0.0.0.0', port=port, delay=delay)
+    print(f"Impresora simulada escuchando en el puerto {server.port}")
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server.stop()
@@ -1,6 +1,7 @@
 import os
 import uuid
 import io
+import base64
 import tempfile
 import zipfile
 import json
@@ -12,9 +13,31 @@ from flask import current_app, flash, request, send_file
 from flask_login import current_user
 from fpdf import FPDF
 import shutil
+import threading
+import time
+from collections import namedtuple
+from sqlalchemy import event
+from sqlalchemy.orm import selectinload
 
 from app import db
-from models import User, Employee, EmployeeHistory, UserRole, ActivityLog, EmployeeDocument
+from models import User, Employee, EmployeeHistory, UserRole, ActivityLog, EmployeeDocument, user_companies
+from utils_storage import store_upload, storage_relative_path, resolve_upload_path
+from activity_log_service import record_activity
+
+# Segundos que se reutilizan las empresas asignadas a un usuario en las comprobaciones de acceso
+# (la caché se descarta antes en todos los procesos si cambia users.updated_at, ver
+# get_user_company_ids)
+ACCESS_CACHE_SECONDS = 300
+
+_company_ids_cache = {}
+_company_ids_cache_lock = threading.Lock()
+
+# Empleados por página en los listados (y máximo que se puede pedir en la variante JSON)
+EMPLOYEES_PER_PAGE = 20
+MAX_EMPLOYEES_PER_PAGE = 100
+
+# Página de un listado por clave: filas y cursores de la página siguiente y anterior
+EmployeePage = namedtuple('EmployeePage', 'items next_cursor prev_cursor')
 
 def create_admin_user():
     """Create admin user if not exists."""
@@ -39,25 +62,19 @@ def allowed_file(filename):
            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
 def save_file(file, description=None):
-    """Save uploaded file to filesystem and return path."""
+    """Save uploaded file to the content-addressed storage and return its data."""
     if file and allowed_file(file.filename):
-        # Get secure filename and add unique identifier
         original_filename = secure_filename(file.filename)
-        file_ext = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else ''
-        unique_filename = f"{uuid.uuid4().hex}.{file_ext}" if file_ext else f"{uuid.uuid4().hex}"
         
-        # Create path for file
-        file_path = os.path.join(current_app.config['UPLOAD_FOLDER'], unique_filename)
-        
-        # Save file to disk
-        file.save(file_path)
+        # Same content uploaded twice is stored only once (see utils_storage)
+        stored = store_upload(file)
         
         return {
-            'filename': unique_filename,
+            'filename': stored.sha256,
             'original_filename': original_filename,
-            'file_path': file_path,
-            'file_type': file.content_type if hasattr(file, 'content_type') else None,
-            'file_size': os.path.getsize(file_path),
+            'file_path': storage_relative_path(stored.sha256),
+            'file_type': stored.content_type,
+            'file_size': stored.size,
             'description': description
         }
     return None
@@ -78,20 +95,20 @@ def log_activity(action, user_id=None, level='info'):
     """
     Log user activity.
     
+    The record is queued and saved in batches by activity_log_service, so this
+    neither waits for the database nor commits the current session.
+    
     Args:
         action: La acción a registrar
         user_id: ID del usuario (opcional, si no se proporciona usa el usuario actual)
         level: Nivel de log ('info', 'warning', 'error', etc.)
     """
     try:
-        # Crear una nueva sesión para evitar problemas con transacciones abiertas
-        log = ActivityLog(
+        record_activity(
+            action,
             user_id=user_id or (current_user.id if current_user.is_authenticated else None),
-            action=action,
-            ip_address=request.remote_addr if request else None,
-            timestamp=datetime.utcnow()
+            ip_address=request.remote_addr if request else None
         )
-        db.session.add(log)
         
         # Registrar en el logger según el nivel
         if level == 'error':
@@ -101,12 +118,6 @@ def log_activity(action, user_id=None, level='info'):
         else:
             # Por defecto, usar nivel info
             current_app.logger.info(action)
-        
-        try:
-            db.session.commit()
-        except Exception as e:
-            db.session.rollback()
-            current_app.logger.error(f"Error al registrar actividad: {e}")
     except Exception as e:
         # Si hay cualquier error, que no impacte el flujo principal de la aplicación
         current_app.logger.error(f"Error general en log_activity: {e}")
@@ -219,6 +230,148 @@ def can_view_employee(employee):
         
     return False
 
+def get_user_company_ids(user):
+    """
+    Return the IDs of the companies assigned to a user (cached for ACCESS_CACHE_SECONDS).
+
+    The cache entry is tied to the user's updated_at, which is bumped whenever their
+    companies change (see _touch_user_companies). The user is loaded from the database
+    on every request, so an entry cached by any worker is discarded on the next request
+    after the change, not when the TTL runs out.
+    """
+    cached = _company_ids_cache.get(user.id)
+    if (cached is not None and cached[1] == user.updated_at
+            and time.monotonic() - cached[0] < ACCESS_CACHE_SECONDS):
+        return cached[2]
+    
+    # Solo la tabla de asignación, sin cargar las empresas
+    company_ids = frozenset(db.session.execute(
+        db.select(user_companies.c.company_id).where(user_companies.c.user_id == user.id)
+    ).scalars())
+    with _company_ids_cache_lock:
+        _company_ids_cache[user.id] = (time.monotonic(), user.updated_at, company_ids)
+    return company_ids
+
+def invalidate_user_company_ids(user_id):
+    """Forget the cached companies of a user (after changing their assignments)."""
+    with _company_ids_cache_lock:
+        _company_ids_cache.pop(user_id, None)
+
+def _touch_user_companies(target, value, initiator):
+    # Cambiar las empresas solo toca user_companies: se actualiza también la fila del
+    # usuario para que los demás procesos descarten su caché (ver get_user_company_ids)
+    target.updated_at = datetime.utcnow()
+    return value
+
+event.listen(User.companies, 'append', _touch_user_companies, retval=True)
+event.listen(User.companies, 'remove', _touch_user_companies)
+
+def can_access_company(company_id):
+    """Check if current user is admin or has the company assigned, using the cached lookup."""
+    if not current_user.is_authenticated:
+        return False
+    if current_user.is_admin():
+        return True
+    return company_id in get_user_company_ids(current_user)
+
+def can_view_employee_record(company_id, employee_user_id):
+    """Same rules as can_view_employee from the employee's company and user IDs, without loading it."""
+    if not current_user.is_authenticated:
+        return False
+    
+    if current_user.is_admin():
+        return True
+    
+    if current_user.is_gerente() and company_id in get_user_company_ids(current_user):
+        return True
+    
+    if current_user.is_empleado() and current_user.id == employee_user_id:
+        return True
+
+    return False
+
+def encode_page_cursor(values):
+    """Encode the sort key of a row as an opaque URL-safe cursor."""
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii').rstrip('=')
+
+def decode_page_cursor(cursor, types):
+    """
+    Decode a cursor from encode_page_cursor.
+
+    Args:
+        cursor: Cursor received from the client
+        types: Expected type of each value of the sort key
+
+    Returns:
+        list or None if the cursor is missing, malformed or its values have other types
+    """
+    if not cursor:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+    except (ValueError, TypeError):
+        return None
+    if not isinstance(values, list) or len(values) != len(types):
+        return None
+    # bool es subclase de int: no se acepta como ID
+    if any(isinstance(value, bool) or not isinstance(value, value_type)
+           for value, value_type in zip(values, types)):
+        return None
+    return values
+
+def get_employees_page(company_ids=None, after=None, before=None, per_page=EMPLOYEES_PER_PAGE):
+    """
+    Return a page of employees ordered by last name, first name and ID.
+
+    Uses keyset pagination: the page starts right after (or ends right before) the
+    cursor of a row instead of skipping rows with OFFSET, so every page costs the
+    same regardless of its depth (see the ix_employees_*name_order indexes). The
+    company of each employee is loaded in a single extra query.
+
+    Args:
+        company_ids: Allowed companies (None for all)
+        after: Cursor of the last row of the previous page
+        before: Cursor of the first row of the next page (to go back)
+        per_page: Employees per page
+
+    Returns:
+        EmployeePage: (items, next_cursor, prev_cursor); cursors are None at the ends
+    """
+    sort_key = (Employee.last_name, Employee.first_name, Employee.id)
+    key_types = (str, str, int)
+    query = Employee.query.options(selectinload(Employee.company))
+    if company_ids is not None:
+        query = query.filter(Employee.company_id.in_(list(company_ids)))
+
+    after = decode_page_cursor(after, key_types)
+    before = decode_page_cursor(before, key_types) if after is None else None
+    if before is not None:
+        # Hacia atrás: orden inverso y se da la vuelta a la página
+        rows = query.filter(db.tuple_(*sort_key) < tuple(before)).order_by(
+            *(column.desc() for column in sort_key)).limit(per_page + 1).all()
+        has_prev = len(rows) > per_page
+        items = rows[:per_page][::-1]
+        has_next = True
+    else:
+        if after is not None:
+            query = query.filter(db.tuple_(*sort_key) > tuple(after))
+        rows = query.order_by(*sort_key).limit(per_page + 1).all()
+        has_next = len(rows) > per_page
+        items = rows[:per_page]
+        has_prev = after is not None
+
+    if not items:
+        return EmployeePage([], None, None)
+    return EmployeePage(
+        items,
+        employee_page_cursor(items[-1]) if has_next else None,
+        employee_page_cursor(items[0]) if has_prev else None
+    )
+
+def employee_page_cursor(employee):
+    """Cursor of an employee in the listing order."""
+    return encode_page_cursor([employee.last_name, employee.first_name, employee.id])
+
 def generate_checkins_pdf(employee, start_date=None, end_date=None):
     """Generate a PDF with employee check-ins between dates."""
     from models import EmployeeCheckIn
@@ -433,9 +586,10 @@ def export_company_employees_zip(company_id):
                     employee_data['documents'].append(document_info)
                     
                     # Copy file to ZIP if exists
-                    if os.path.exists(doc.file_path):
+                    doc_path = resolve_upload_path(doc.file_path)
+                    if doc_path and os.path.exists(doc_path):
                         doc_zip_path = f"{employee_dir}/documentos/{doc.original_filename}"
-                        zipf.write(doc.file_path, doc_zip_path)
+                        zipf.write(doc_path, doc_zip_path)
                 
                 # Add employee JSON data to ZIP
                 employee_json_path = f"{employee_dir}/datos.json"
@@ -6,6 +6,8 @@ y operaciones comunes del sistema de arqueos de caja.
 """
 
 import logging
+import threading
+import time
 from datetime import datetime, date, timedelta
 from decimal import Decimal
 import calendar
@@ -17,8 +19,9 @@ except:
 
 from sqlalchemy.exc import SQLAlchemyError
 from app import db
-from models_cash_register import CashRegister, CashRegisterSummary
+from models_cash_register import CashRegister, CashRegisterSummary, CashRegisterDailyTotal, CompanyStaffCost
 from models_work_hours import CompanyWorkHours
+from utils_db import upsert_insert
 
 # Configurar logging
 logger = logging.getLogger(__name__)
@@ -26,6 +29,23 @@ logger = logging.getLogger(__name__)
 # Constantes
 DEFAULT_HOURLY_EMPLOYEE_COST = 12.0  # Coste por hora por defecto si no está definido
 
+# Agrupaciones disponibles para las series de ingresos
+SERIES_GRANULARITIES = ('day', 'week', 'month', 'year')
+
+# Segundos que se reutiliza la vista consolidada de empresas de un usuario
+OVERVIEW_CACHE_SECONDS = 60
+
+# Columnas de la exportación de arqueos
+REGISTER_EXPORT_HEADERS = [
+    'Fecha', 'Efectivo', 'Tarjeta', 'Delivery Efectivo',
+    'Delivery Online', 'Cheque', 'Gastos', 'Total',
+    'Notas Gastos', 'Notas', 'Empleado'
+]
+REGISTER_EXPORT_AMOUNTS = (
+    'cash_amount', 'card_amount', 'delivery_cash_amount', 'delivery_online_amount',
+    'check_amount', 'expenses_amount', 'total_amount'
+)
+
 
 def get_week_number(date_obj):
     """
@@ -53,8 +73,8 @@ def get_date_range(year, month=None, week=None):
         Tupla con fecha inicial y final del período
     """
     if week:
-        # Calcular la fecha inicial de la semana
-        first_day = datetime.strptime(f"{year}-{week}-1", "%Y-%W-%w").date()
+        # Semana ISO (de lunes a domingo), la misma que devuelve get_week_number
+        first_day = date.fromisocalendar(year, 1, 1) + timedelta(weeks=week - 1)
         last_day = first_day + timedelta(days=6)
         return first_day, last_day
     
@@ -70,185 +90,595 @@ def get_date_range(year, month=None, week=None):
     return first_day, last_day
 
 
-def calculate_weekly_summary(company_id, year, week_number):
+def get_summary_period(date_obj):
     """
-    Calcula y actualiza el resumen semanal para una empresa.
+    Obtiene el periodo del resumen semanal al que pertenece una fecha.
+    
+    Las semanas son ISO (de lunes a domingo) y se asignan al mes de su jueves,
+    igual que la norma ISO asigna cada semana al año de su jueves.
+    
+    Args:
+        date_obj: Objeto de fecha
+        
+    Returns:
+        Tupla (año, mes, número de semana)
+    """
+    iso_year, iso_week, iso_weekday = date_obj.isocalendar()
+    thursday = date_obj + timedelta(days=4 - iso_weekday)
+    return iso_year, thursday.month, iso_week
+
+
+def _sum(column):
+    return db.func.coalesce(db.func.sum(column), 0.0)
+
+
+def _period_hours(company_id, start_date, end_date, week_number=None):
+    """
+    Suma con una consulta las horas de company_work_hours de un periodo.
+    
+    Los registros de horas se guardan por año natural, mes y semana ISO, así que
+    una semana que cruza dos meses tiene dos registros. Si se indica la semana,
+    solo se suman los registros de esa semana dentro del rango de fechas.
+    """
+    months = {(start_date.year, start_date.month), (end_date.year, end_date.month)}
+    filters = [CompanyWorkHours.company_id == company_id,
+               db.or_(*[db.and_(CompanyWorkHours.year == year, CompanyWorkHours.month == month)
+                        for year, month in months])]
+    if week_number is not None:
+        filters.append(CompanyWorkHours.week_number == week_number)
+        column = CompanyWorkHours.weekly_hours
+    else:
+        column = CompanyWorkHours.monthly_hours
+    return db.session.query(_sum(column)).filter(*filters).scalar() or 0.0
+
+
+def _hourly_cost(company_id):
+    from models import Company
+    hourly_cost = db.session.query(Company.hourly_employee_cost).filter(Company.id == company_id).scalar()
+    return hourly_cost or DEFAULT_HOURLY_EMPLOYEE_COST
+
+
+def refresh_daily_totals(company_id, dates):
+    """
+    Recalcula los totales diarios de una empresa para unas fechas.
+    
+    Agrupa con una consulta los arqueos de esas fechas e inserta o actualiza sus
+    registros en cash_register_daily_totals (INSERT ... ON CONFLICT); los días sin
+    arqueos quedan sin registro. No confirma la transacción.
+    
+    La fila de la empresa queda bloqueada (SELECT ... FOR UPDATE) hasta que el
+    llamador confirma: dos arqueos de la misma empresa guardados a la vez se
+    recalculan uno detrás de otro y el segundo ya cuenta el arqueo del primero.
     
     Args:
         company_id: ID de la empresa
-        year: Año
-        week_number: Número de semana
+        dates: Fechas a recalcular
+    """
+    from models import Company
+
+    dates = sorted({d for d in dates if d})
+    if not dates:
+        return
+
+    db.session.query(Company.id).filter(Company.id == company_id).with_for_update().scalar()
+
+    columns = CashRegisterDailyTotal.AMOUNT_COLUMNS
+    rows = db.session.query(
+        CashRegister.date,
+        db.func.count(CashRegister.id),
+        *[_sum(getattr(CashRegister, column)) for column in columns]
+    ).filter(
+        CashRegister.company_id == company_id,
+        CashRegister.date.in_(dates)
+    ).group_by(CashRegister.date).all()
+
+    values = [daily_total_values(company_id, row[0], row[1], row[2:]) for row in rows]
+    insert = upsert_insert()
+    if insert is None:
+        # Otros motores: se reemplazan los registros de esas fechas
+        replaced = dates
+    else:
+        # Solo se eliminan los días que se han quedado sin arqueos
+        replaced = sorted(set(dates) - {row[0] for row in rows})
+    if replaced:
+        db.session.execute(
+            db.delete(CashRegisterDailyTotal).where(
+                CashRegisterDailyTotal.company_id == company_id,
+                CashRegisterDailyTotal.date.in_(replaced)
+            ).execution_options(synchronize_session=False)
+        )
+    if not values:
+        return
+    if insert is None:
+        db.session.execute(db.insert(CashRegisterDailyTotal), values)
+        return
+    stmt = insert(CashRegisterDailyTotal.__table__).values(values)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=['company_id', 'date'],
+        set_={name: stmt.excluded[name] for name in values[0] if name not in ('company_id', 'date')}
+    )
+    db.session.execute(stmt)
+
+
+def daily_total_values(company_id, day, registers_count, amounts):
+    """Valores de un registro de cash_register_daily_totals."""
+    iso_year, week_number, _ = day.isocalendar()
+    values = {
+        'company_id': company_id,
+        'date': day,
+        'year': day.year,
+        'month': day.month,
+        'iso_year': iso_year,
+        'week_number': week_number,
+        'registers_count': registers_count,
+        'updated_at': datetime.utcnow(),
+    }
+    values.update(zip(CashRegisterDailyTotal.AMOUNT_COLUMNS, (float(a or 0) for a in amounts)))
+    return values
+
+
+def get_period_totals(company_id, start_date=None, end_date=None):
+    """
+    Totales de los arqueos de una empresa en un rango de fechas.
+    
+    Suma los totales diarios con una sola consulta sobre el índice (empresa, fecha).
+    
+    Args:
+        company_id: ID de la empresa
+        start_date: Fecha inicial incluida (opcional)
+        end_date: Fecha final incluida (opcional)
         
     Returns:
-        CashRegisterSummary actualizado o None si hay error
+        Diccionario con registers_count y los importes de CashRegisterDailyTotal.AMOUNT_COLUMNS
     """
-    try:
-        # Obtener el mes al que pertenece la semana (usamos el primer día)
-        start_date, end_date = get_date_range(year, week=week_number)
-        month = start_date.month
+    columns = ('registers_count',) + CashRegisterDailyTotal.AMOUNT_COLUMNS
+    query = db.session.query(
+        *[_sum(getattr(CashRegisterDailyTotal, column)) for column in columns]
+    ).filter(CashRegisterDailyTotal.company_id == company_id)
+    if start_date:
+        query = query.filter(CashRegisterDailyTotal.date >= start_date)
+    if end_date:
+        query = query.filter(CashRegisterDailyTotal.date <= end_date)
+    totals = dict(zip(columns, query.one()))
+    totals['registers_count'] = int(totals['registers_count'])
+    return totals
+
+
+def get_revenue_series(company_id, start_date, end_date, granularity='month'):
+    """
+    Serie temporal de ingresos de una empresa para gráficos.
+    
+    Una sola consulta agrupada sobre los totales diarios, válida para rangos de
+    varios años.
+    
+    Args:
+        company_id: ID de la empresa
+        start_date: Fecha inicial incluida
+        end_date: Fecha final incluida
+        granularity: 'day', 'week' (ISO), 'month' o 'year'
         
-        # Buscar registros de arqueo para esta semana y empresa
-        registers = CashRegister.query.filter(
-            CashRegister.company_id == company_id,
-            CashRegister.date >= start_date,
-            CashRegister.date <= end_date
-        ).all()
+    Returns:
+        Lista de diccionarios ordenados por periodo con la etiqueta del periodo y sus totales
+    """
+    if granularity not in SERIES_GRANULARITIES:
+        raise ValueError(f"Agrupación no válida: {granularity}")
+
+    group_columns = {
+        'day': (CashRegisterDailyTotal.date,),
+        'week': (CashRegisterDailyTotal.iso_year, CashRegisterDailyTotal.week_number),
+        'month': (CashRegisterDailyTotal.year, CashRegisterDailyTotal.month),
+        'year': (CashRegisterDailyTotal.year,),
+    }[granularity]
+    columns = ('registers_count',) + CashRegisterDailyTotal.AMOUNT_COLUMNS
+
+    rows = db.session.query(
+        *group_columns,
+        *[db.func.sum(getattr(CashRegisterDailyTotal, column)) for column in columns]
+    ).filter(
+        CashRegisterDailyTotal.company_id == company_id,
+        CashRegisterDailyTotal.date >= start_date,
+        CashRegisterDailyTotal.date <= end_date
+    ).group_by(*group_columns).order_by(*group_columns).all()
+
+    series = []
+    for row in rows:
+        key, values = row[:len(group_columns)], row[len(group_columns):]
+        if granularity == 'day':
+            period = key[0].isoformat()
+        elif granularity == 'week':
+            period = f"{key[0]}-W{key[1]:02d}"
+        elif granularity == 'month':
+            period = f"{key[0]}-{key[1]:02d}"
+        else:
+            period = str(key[0])
+        point = {'period': period}
+        point.update((column, round(float(value or 0), 2)) for column, value in zip(columns, values))
+        point['registers_count'] = int(point['registers_count'])
+        series.append(point)
+    return series
+
+
+def refresh_staff_costs(company_id, weeks=(), months=(), hourly_cost=None):
+    """
+    Recalcula la serie de coste de personal de una empresa para unas semanas y meses.
+    
+    Cada periodo se calcula con dos agregados (horas de company_work_hours e
+    ingresos de los totales diarios). Los periodos sin horas ni ingresos se
+    eliminan de la serie. No confirma la transacción.
+    
+    Args:
+        company_id: ID de la empresa
+        weeks: Semanas ISO como tuplas (año, semana)
+        months: Meses como tuplas (año, mes)
+        hourly_cost: Coste por hora (por defecto, el de la empresa)
         
-        if not registers:
-            logger.info(f"No hay registros para la semana {week_number} de {year} - empresa {company_id}")
+    Returns:
+        Diccionario {(tipo, año, periodo): CompanyStaffCost o None}
+    """
+    keys = [(CompanyStaffCost.PERIOD_WEEK, year, week) for year, week in set(weeks)]
+    keys += [(CompanyStaffCost.PERIOD_MONTH, year, month) for year, month in set(months)]
+    if not keys:
+        return {}
+
+    if hourly_cost is None:
+        hourly_cost = _hourly_cost(company_id)
+
+    existing = {
+        (row.period_type, row.year, row.period): row
+        for row in CompanyStaffCost.query.filter(
+            CompanyStaffCost.company_id == company_id,
+            db.or_(*[db.and_(CompanyStaffCost.period_type == period_type,
+                             CompanyStaffCost.year == year,
+                             CompanyStaffCost.period == period)
+                     for period_type, year, period in keys])
+        )
+    }
+
+    result = {}
+    for key in sorted(keys):
+        period_type, year, period = key
+        if period_type == CompanyStaffCost.PERIOD_WEEK:
+            start_date, end_date = get_date_range(year, week=period)
+            hours = _period_hours(company_id, start_date, end_date, period)
+        else:
+            start_date, end_date = get_date_range(year, period)
+            hours = _period_hours(company_id, start_date, end_date)
+        revenue = get_period_totals(company_id, start_date, end_date)['total_amount']
+
+        row = existing.get(key)
+        if not hours and not revenue:
+            if row is not None:
+                db.session.delete(row)
+            result[key] = None
+            continue
+
+        if row is None:
+            row = CompanyStaffCost(company_id=company_id, period_type=period_type, year=year, period=period)
+            db.session.add(row)
+        row.start_date = start_date
+        row.end_date = end_date
+        row.hours = hours
+        row.hourly_cost = hourly_cost
+        row.staff_cost = hours * hourly_cost
+        row.revenue = revenue
+        row.staff_cost_percentage = row.staff_cost / revenue * 100 if revenue > 0 else 0.0
+        result[key] = row
+    return result
+
+
+def _staff_values(staff):
+    """(horas, coste, porcentaje) de un registro de la serie de coste de personal."""
+    if staff is None:
+        return 0.0, 0.0, 0.0
+    return staff.hours, staff.staff_cost, staff.staff_cost_percentage
+
+
+def _refresh_week_summary(company_id, year, month, week_number, staff):
+    """Recalcula los campos semanales de un resumen a partir de los totales diarios."""
+    start_date, end_date = get_date_range(year, week=week_number)
+    totals = get_period_totals(company_id, start_date, end_date)
+
+    summary = CashRegisterSummary.query.filter_by(
+        company_id=company_id,
+        year=year,
+        month=month,
+        week_number=week_number
+    ).first()
+
+    if not summary:
+        if not totals['registers_count']:
             return None
-        
-        # Buscar o crear resumen para esta semana
-        summary = CashRegisterSummary.query.filter_by(
+        summary = CashRegisterSummary(
             company_id=company_id,
             year=year,
             month=month,
             week_number=week_number
-        ).first()
-        
-        if not summary:
-            summary = CashRegisterSummary(
-                company_id=company_id,
-                year=year,
-                month=month,
-                week_number=week_number
-            )
-            db.session.add(summary)
-        
-        # Reiniciar contadores semanales
-        summary.weekly_total = 0.0
-        summary.weekly_cash = 0.0
-        summary.weekly_card = 0.0
-        summary.weekly_delivery_cash = 0.0
-        summary.weekly_delivery_online = 0.0
-        summary.weekly_check = 0.0
-        summary.weekly_expenses = 0.0
-        
-        # Calcular totales semanales
-        for register in registers:
-            # Sumar totales
-            # Nota: Los gastos no se restan del total, solo se registran
-            summary.weekly_total += register.total_amount
-            summary.weekly_cash += register.cash_amount
-            summary.weekly_card += register.card_amount
-            summary.weekly_delivery_cash += register.delivery_cash_amount
-            summary.weekly_delivery_online += register.delivery_online_amount
-            summary.weekly_check += register.check_amount
-            summary.weekly_expenses += register.expenses_amount
-        
-        # Obtener datos de horas trabajadas de company_work_hours
-        staff_cost = calculate_staff_cost(company_id, year, month, week_number)
-        if staff_cost:
-            summary.weekly_staff_cost = staff_cost['weekly_cost']
-            summary.monthly_staff_cost = staff_cost['monthly_cost']
-            
-            # Calcular porcentaje de coste de personal
-            if summary.weekly_total > 0:
-                summary.weekly_staff_cost_percentage = (staff_cost['weekly_cost'] / summary.weekly_total) * 100
-            else:
-                summary.weekly_staff_cost_percentage = 0
-                
-            # Actualizar porcentaje mensual
-            monthly_revenue = calculate_monthly_revenue(company_id, year, month)
-            if monthly_revenue > 0:
-                summary.monthly_staff_cost_percentage = (staff_cost['monthly_cost'] / monthly_revenue) * 100
-            else:
-                summary.monthly_staff_cost_percentage = 0
-        
-        # Actualizar totales acumulados
-        summary.monthly_total = calculate_monthly_revenue(company_id, year, month)
-        summary.yearly_total = calculate_yearly_revenue(company_id, year)
-        
-        # Guardar cambios
-        db.session.commit()
-        
-        return summary
+        )
+        db.session.add(summary)
+
+    # Nota: Los gastos no se restan del total, solo se registran
+    summary.weekly_total = totals['total_amount']
+    summary.weekly_cash = totals['cash_amount']
+    summary.weekly_card = totals['card_amount']
+    summary.weekly_delivery_cash = totals['delivery_cash_amount']
+    summary.weekly_delivery_online = totals['delivery_online_amount']
+    summary.weekly_check = totals['check_amount']
+    summary.weekly_expenses = totals['expenses_amount']
+    summary.weekly_vat_amount = totals['vat_amount']
+    summary.weekly_net_amount = totals['net_amount']
+
+    (summary.weekly_hours, summary.weekly_staff_cost,
+     summary.weekly_staff_cost_percentage) = _staff_values(staff)
+    return summary
+
+
+def _refresh_month_totals(company_id, year, month, staff):
+    """Actualiza los acumulados mensuales de todos los resúmenes de un mes."""
+    start_date, end_date = get_date_range(year, month)
+    totals = get_period_totals(company_id, start_date, end_date)
+    hours, staff_cost, percentage = _staff_values(staff)
+    db.session.execute(
+        db.update(CashRegisterSummary).where(
+            CashRegisterSummary.company_id == company_id,
+            CashRegisterSummary.year == year,
+            CashRegisterSummary.month == month
+        ).values(
+            monthly_total=totals['total_amount'],
+            monthly_vat_amount=totals['vat_amount'],
+            monthly_net_amount=totals['net_amount'],
+            monthly_hours=hours,
+            monthly_staff_cost=staff_cost,
+            monthly_staff_cost_percentage=percentage
+        ).execution_options(synchronize_session='fetch')
+    )
+
+
+def _refresh_year_totals(company_id, year):
+    """Actualiza el acumulado anual de todos los resúmenes de un año."""
+    start_date, end_date = get_date_range(year)
+    total = get_period_totals(company_id, start_date, end_date)['total_amount']
+    db.session.execute(
+        db.update(CashRegisterSummary).where(
+            CashRegisterSummary.company_id == company_id,
+            CashRegisterSummary.year == year
+        ).values(yearly_total=total).execution_options(synchronize_session='fetch')
+    )
+
+
+def update_cash_register_summaries(company_id, *dates):
+    """
+    Actualiza los resúmenes afectados por un cambio en los arqueos de una empresa.
+    
+    Se llama desde las altas, ediciones y bajas de arqueos con las fechas que han
+    cambiado (en una edición, la fecha anterior y la nueva). Recalcula los
+    totales diarios de esas fechas y, a partir de ellos, la serie de coste de
+    personal, la semana de cada fecha y los acumulados mensual y anual de los
+    resúmenes de esos meses y años. No confirma la transacción: el llamador hace
+    commit junto con el propio arqueo.
+    
+    Args:
+        company_id: ID de la empresa
+        *dates: Fechas de los arqueos modificados
+    """
+    dates = {d for d in dates if d}
+    if not dates:
+        return
+
+    refresh_daily_totals(company_id, dates)
+
+    weeks = {get_summary_period(d) for d in dates}
+    months = {(d.year, d.month) for d in dates} | {(year, month) for year, month, _ in weeks}
+    staff = refresh_staff_costs(company_id, weeks={(year, week) for year, _, week in weeks}, months=months)
+
+    for year, month, week_number in sorted(weeks):
+        _refresh_week_summary(company_id, year, month, week_number,
+                              staff.get((CompanyStaffCost.PERIOD_WEEK, year, week_number)))
+    db.session.flush()
+
+    for year, month in sorted(months):
+        _refresh_month_totals(company_id, year, month,
+                              staff.get((CompanyStaffCost.PERIOD_MONTH, year, month)))
+    for year in sorted({year for year, _ in months}):
+        _refresh_year_totals(company_id, year)
+
+
+def update_staff_cost_summaries(company_id, date_obj):
+    """
+    Actualiza el coste de personal tras un cambio de horas trabajadas.
     
+    Recalcula la serie de coste de personal de la semana y el mes de la fecha y
+    copia sus valores a los resúmenes que ya existen con sentencias UPDATE. No
+    confirma la transacción.
+    
+    Args:
+        company_id: ID de la empresa
+        date_obj: Fecha de las horas modificadas
+    """
+    year, month, week_number = get_summary_period(date_obj)
+    months = {(date_obj.year, date_obj.month), (year, month)}
+    staff = refresh_staff_costs(company_id, weeks={(year, week_number)}, months=months)
+
+    hours, staff_cost, percentage = _staff_values(
+        staff.get((CompanyStaffCost.PERIOD_WEEK, year, week_number)))
+    db.session.execute(
+        db.update(CashRegisterSummary).where(
+            CashRegisterSummary.company_id == company_id,
+            CashRegisterSummary.year == year,
+            CashRegisterSummary.week_number == week_number
+        ).values(
+            weekly_hours=hours,
+            weekly_staff_cost=staff_cost,
+            weekly_staff_cost_percentage=percentage
+        ).execution_options(synchronize_session='fetch')
+    )
+
+    for year, month in sorted(months):
+        hours, staff_cost, percentage = _staff_values(
+            staff.get((CompanyStaffCost.PERIOD_MONTH, year, month)))
+        db.session.execute(
+            db.update(CashRegisterSummary).where(
+                CashRegisterSummary.company_id == company_id,
+                CashRegisterSummary.year == year,
+                CashRegisterSummary.month == month
+            ).values(
+                monthly_hours=hours,
+                monthly_staff_cost=staff_cost,
+                monthly_staff_cost_percentage=percentage
+            ).execution_options(synchronize_session='fetch')
+        )
+
+
+def _work_hours_week(year, month, week_number):
+    """Año ISO de un registro de company_work_hours (guardado por año natural y semana ISO)."""
+    if month == 12 and week_number == 1:
+        return year + 1
+    if month == 1 and week_number >= 52:
+        return year - 1
+    return year
+
+
+def rebuild_cash_register_summaries(company_id):
+    """
+    Reconstruye todos los resúmenes de una empresa a partir de sus arqueos.
+    
+    Regenera los totales diarios, la serie de coste de personal (también de los
+    periodos con horas trabajadas pero sin arqueos) y los resúmenes semanales. Se
+    usa para inicializarlos o después de cambios masivos (importaciones, cambio
+    del coste por hora). Confirma la transacción.
+    
+    Returns:
+        Número de resúmenes semanales resultantes
+    """
+    try:
+        dates = [row[0] for row in db.session.query(CashRegister.date).filter(
+            CashRegister.company_id == company_id
+        ).distinct()]
+        hour_periods = db.session.query(
+            CompanyWorkHours.year, CompanyWorkHours.month, CompanyWorkHours.week_number
+        ).filter(CompanyWorkHours.company_id == company_id).distinct().all()
+
+        CashRegisterSummary.query.filter_by(company_id=company_id).delete(synchronize_session=False)
+        CashRegisterDailyTotal.query.filter_by(company_id=company_id).delete(synchronize_session=False)
+        CompanyStaffCost.query.filter_by(company_id=company_id).delete(synchronize_session=False)
+        update_cash_register_summaries(company_id, *dates)
+        refresh_staff_costs(
+            company_id,
+            weeks={(_work_hours_week(year, month, week), week) for year, month, week in hour_periods},
+            months={(year, month) for year, month, _ in hour_periods}
+        )
+        db.session.commit()
+        return CashRegisterSummary.query.filter_by(company_id=company_id).count()
+
     except SQLAlchemyError as e:
         db.session.rollback()
-        logger.error(f"Error al calcular resumen semanal: {str(e)}")
+        logger.error(f"Error al reconstruir resúmenes de la empresa {company_id}: {str(e)}")
+        raise
+
+
+def get_weekly_summary(company_id, year, week_number):
+    """
+    Obtiene el resumen semanal ya calculado de una empresa (solo lectura).
+    
+    Args:
+        company_id: ID de la empresa
+        year: Año ISO de la semana
+        week_number: Número de semana
+        
+    Returns:
+        CashRegisterSummary o None si no hay arqueos esa semana
+    """
+    return CashRegisterSummary.query.filter_by(
+        company_id=company_id,
+        year=year,
+        week_number=week_number
+    ).first()
+
+
+def get_summary_staff_cost(summary):
+    """
+    Datos de coste de personal guardados en un resumen.
+    
+    Args:
+        summary: CashRegisterSummary (o None)
+        
+    Returns:
+        Diccionario con horas y costes semanales y mensuales, o None
+    """
+    if summary is None:
         return None
+    return {
+        'weekly_hours': summary.weekly_hours,
+        'monthly_hours': summary.monthly_hours,
+        'weekly_cost': summary.weekly_staff_cost,
+        'monthly_cost': summary.monthly_staff_cost
+    }
 
 
-def calculate_staff_cost(company_id, year, month=None, week=None):
+def get_staff_cost(company_id, year, month=None, week=None):
     """
-    Calcula el coste de personal para una empresa en un período.
+    Coste de personal de una empresa en un periodo, leído de la serie mantenida.
     
     Args:
         company_id: ID de la empresa
-        year: Año
+        year: Año (ISO si se indica semana)
         month: Mes (opcional)
         week: Número de semana (opcional)
         
     Returns:
-        Diccionario con costes semanales y mensuales
+        Diccionario con horas y costes semanales y mensuales, y el coste ('cost')
+        y porcentaje sobre ingresos ('ratio') del periodo pedido (la semana si se
+        indica, si no el mes)
     """
-    from models import Company
+    if week and not month:
+        _, month, _ = get_summary_period(get_date_range(year, week=week)[0])
+    month = month or 1
+
+    filters = [db.and_(CompanyStaffCost.period_type == CompanyStaffCost.PERIOD_MONTH,
+                       CompanyStaffCost.year == year, CompanyStaffCost.period == month)]
+    if week:
+        filters.append(db.and_(CompanyStaffCost.period_type == CompanyStaffCost.PERIOD_WEEK,
+                               CompanyStaffCost.year == year, CompanyStaffCost.period == week))
+    rows = {row.period_type: row for row in CompanyStaffCost.query.filter(
+        CompanyStaffCost.company_id == company_id, db.or_(*filters))}
+
+    weekly = rows.get(CompanyStaffCost.PERIOD_WEEK)
+    monthly = rows.get(CompanyStaffCost.PERIOD_MONTH)
+    selected = weekly if week else monthly
+    hourly_cost = (weekly or monthly).hourly_cost if (weekly or monthly) else _hourly_cost(company_id)
+    return {
+        'weekly_hours': weekly.hours if weekly else 0,
+        'monthly_hours': monthly.hours if monthly else 0,
+        'weekly_cost': weekly.staff_cost if weekly else 0,
+        'monthly_cost': monthly.staff_cost if monthly else 0,
+        'hourly_cost': hourly_cost,
+        'cost': selected.staff_cost if selected else 0,
+        'ratio': selected.staff_cost_percentage if selected else 0
+    }
+
+
+def get_staff_cost_series(company_id, start_date, end_date, granularity='week'):
+    """
+    Serie de coste de personal de una empresa para gráficos (solo lectura).
     
-    try:
-        # Obtener coste por hora de la empresa
-        company = Company.query.get(company_id)
-        if not company:
-            return None
-            
-        hourly_cost = company.hourly_employee_cost or DEFAULT_HOURLY_EMPLOYEE_COST
-        
-        # Obtener rango de fechas
-        if week:
-            start_date, end_date = get_date_range(year, week=week)
-            month = start_date.month
-        else:
-            # Si no se especifica semana, usar el mes completo
-            if not month:
-                month = 1  # Valor por defecto
-            start_date, end_date = get_date_range(year, month)
-        
-        # Obtener horas trabajadas semanales (si se especificó una semana)
-        weekly_hours = 0
-        if week:
-            # Buscar en company_work_hours para esta semana
-            week_record = CompanyWorkHours.query.filter_by(
-                company_id=company_id,
-                year=year,
-                week_number=week
-            ).first()
-            
-            if week_record:
-                weekly_hours = week_record.weekly_hours
-        
-        # Obtener horas trabajadas mensuales
-        monthly_hours = 0
-        # Sumar todas las horas de las semanas del mes
-        month_records = CompanyWorkHours.query.filter(
-            CompanyWorkHours.company_id == company_id,
-            CompanyWorkHours.year == year,
-            CompanyWorkHours.month == month
-        ).all()
-        
-        for record in month_records:
-            monthly_hours += record.monthly_hours
-        
-        # Calcular costes
-        weekly_cost = weekly_hours * hourly_cost
-        monthly_cost = monthly_hours * hourly_cost
+    Args:
+        company_id: ID de la empresa
+        start_date: Fecha inicial incluida
+        end_date: Fecha final incluida
+        granularity: 'week' o 'month'
         
-        return {
-            'weekly_hours': weekly_hours,
-            'monthly_hours': monthly_hours,
-            'weekly_cost': weekly_cost,
-            'monthly_cost': monthly_cost,
-            'hourly_cost': hourly_cost
-        }
-    
-    except Exception as e:
-        logger.error(f"Error al calcular coste de personal: {str(e)}")
-        return {
-            'weekly_hours': 0,
-            'monthly_hours': 0,
-            'weekly_cost': 0,
-            'monthly_cost': 0,
-            'hourly_cost': DEFAULT_HOURLY_EMPLOYEE_COST
-        }
+    Returns:
+        Lista de diccionarios ordenados por periodo (ver CompanyStaffCost.to_dict)
+    """
+    if granularity not in (CompanyStaffCost.PERIOD_WEEK, CompanyStaffCost.PERIOD_MONTH):
+        raise ValueError(f"Agrupación no válida: {granularity}")
+
+    rows = CompanyStaffCost.query.filter(
+        CompanyStaffCost.company_id == company_id,
+        CompanyStaffCost.period_type == granularity,
+        CompanyStaffCost.start_date >= start_date,
+        CompanyStaffCost.start_date <= end_date
+    ).order_by(CompanyStaffCost.start_date)
+    return [row.to_dict() for row in rows]
 
 
 def calculate_monthly_revenue(company_id, year, month):
@@ -264,17 +694,9 @@ def calculate_monthly_revenue(company_id, year, month):
         Float con el total de ingresos del mes
     """
     try:
-        # Obtener rango de fechas del mes
+        # Sumar los totales diarios del mes
         start_date, end_date = get_date_range(year, month)
-        
-        # Sumar todos los arqueos del mes
-        result = db.session.query(db.func.sum(CashRegister.total_amount)).filter(
-            CashRegister.company_id == company_id,
-            CashRegister.date >= start_date,
-            CashRegister.date <= end_date
-        ).scalar()
-        
-        return result or 0.0
+        return get_period_totals(company_id, start_date, end_date)['total_amount']
     
     except Exception as e:
         logger.error(f"Error al calcular ingresos mensuales: {str(e)}")
@@ -293,23 +715,190 @@ def calculate_yearly_revenue(company_id, year):
         Float con el total de ingresos del año
     """
     try:
-        # Obtener rango de fechas del año
+        # Sumar los totales diarios del año
         start_date, end_date = get_date_range(year)
-        
-        # Sumar todos los arqueos del año
-        result = db.session.query(db.func.sum(CashRegister.total_amount)).filter(
-            CashRegister.company_id == company_id,
-            CashRegister.date >= start_date,
-            CashRegister.date <= end_date
-        ).scalar()
-        
-        return result or 0.0
+        return get_period_totals(company_id, start_date, end_date)['total_amount']
     
     except Exception as e:
         logger.error(f"Error al calcular ingresos anuales: {str(e)}")
         return 0.0
 
 
+def get_companies_overview(company_ids, today=None):
+    """
+    Resumen consolidado de varias empresas con una sola consulta.
+    
+    Une los totales diarios agrupados por empresa (semana actual, mes y año hasta
+    hoy y último día con arqueos) con las horas de company_work_hours del mes y
+    la semana actuales, de modo que el coste no crece con el número de empresas.
+    
+    Args:
+        company_ids: IDs de las empresas
+        today: Fecha de referencia (por defecto, hoy)
+        
+    Returns:
+        Lista de diccionarios por empresa, ordenada por nombre
+    """
+    from models import Company
+
+    if not company_ids:
+        return []
+
+    today = today or date.today()
+    year, week_number, weekday = today.isocalendar()
+    week_start = today - timedelta(days=weekday - 1)
+    week_end = week_start + timedelta(days=6)
+    month_start = today.replace(day=1)
+    year_start = date(today.year, 1, 1)
+
+    daily = CashRegisterDailyTotal
+    totals = db.session.query(
+        daily.company_id.label('company_id'),
+        _sum(db.case((daily.date.between(week_start, week_end), daily.total_amount), else_=0.0)).label('week_total'),
+        _sum(db.case((daily.date.between(month_start, today), daily.total_amount), else_=0.0)).label('month_total'),
+        _sum(db.case((daily.date.between(year_start, today), daily.total_amount), else_=0.0)).label('year_total'),
+        db.func.max(daily.date).label('last_register_date')
+    ).filter(daily.company_id.in_(company_ids)).group_by(daily.company_id).subquery()
+
+    # Registros de horas de la semana actual (puede cruzar dos meses) y del mes actual
+    hours = CompanyWorkHours
+    week_months = {(week_start.year, week_start.month), (week_end.year, week_end.month)}
+    in_week = db.and_(hours.week_number == week_number,
+                      db.or_(*[db.and_(hours.year == y, hours.month == m) for y, m in week_months]))
+    in_month = db.and_(hours.year == today.year, hours.month == today.month)
+    staff_hours = db.session.query(
+        hours.company_id.label('company_id'),
+        _sum(db.case((in_week, hours.weekly_hours), else_=0.0)).label('week_hours'),
+        _sum(db.case((in_month, hours.monthly_hours), else_=0.0)).label('month_hours')
+    ).filter(hours.company_id.in_(company_ids), db.or_(in_week, in_month)).group_by(hours.company_id).subquery()
+
+    rows = db.session.query(
+        Company.id, Company.name, Company.hourly_employee_cost,
+        totals.c.week_total, totals.c.month_total, totals.c.year_total, totals.c.last_register_date,
+        staff_hours.c.week_hours, staff_hours.c.month_hours
+    ).outerjoin(totals, totals.c.company_id == Company.id)\
+        .outerjoin(staff_hours, staff_hours.c.company_id == Company.id)\
+        .filter(Company.id.in_(company_ids))\
+        .order_by(Company.name).all()
+
+    overview = []
+    for row in rows:
+        hourly_cost = row.hourly_employee_cost or DEFAULT_HOURLY_EMPLOYEE_COST
+        week_total = float(row.week_total or 0)
+        month_total = float(row.month_total or 0)
+        week_staff_cost = float(row.week_hours or 0) * hourly_cost
+        month_staff_cost = float(row.month_hours or 0) * hourly_cost
+        overview.append({
+            'company_id': row.id,
+            'company_name': row.name,
+            'week_total': round(week_total, 2),
+            'month_total': round(month_total, 2),
+            'year_total': round(float(row.year_total or 0), 2),
+            'week_staff_cost': round(week_staff_cost, 2),
+            'month_staff_cost': round(month_staff_cost, 2),
+            'week_staff_cost_percentage': round(week_staff_cost / week_total * 100, 2) if week_total > 0 else 0.0,
+            'month_staff_cost_percentage': round(month_staff_cost / month_total * 100, 2) if month_total > 0 else 0.0,
+            'last_register_date': row.last_register_date.isoformat() if row.last_register_date else None,
+        })
+    return overview
+
+
+_overview_cache = {}
+_overview_cache_lock = threading.Lock()
+
+
+def get_user_companies_overview(user):
+    """
+    Resumen consolidado de las empresas a las que tiene acceso un usuario.
+    
+    El resultado se guarda por usuario durante OVERVIEW_CACHE_SECONDS para que
+    recargar la vista o consultar la API no repita la consulta.
+    """
+    from models import Company
+
+    cached = _overview_cache.get(user.id)
+    if cached is not None and time.monotonic() - cached[0] < OVERVIEW_CACHE_SECONDS:
+        return cached[1]
+
+    if user.is_admin():
+        company_ids = [row[0] for row in db.session.query(Company.id)]
+    else:
+        company_ids = [company.id for company in user.companies]
+
+    overview = get_companies_overview(company_ids)
+    with _overview_cache_lock:
+        _overview_cache[user.id] = (time.monotonic(), overview)
+    return overview
+
+
+def register_export_headers(include_company=False):
+    """Encabezados de la exportación de arqueos (con la empresa si hay varias)."""
+    return (['Empresa'] if include_company else []) + REGISTER_EXPORT_HEADERS
+
+
+def iter_register_export_rows(company_ids, start_date=None, end_date=None,
+                              include_company=False, as_text=False):
+    """
+    Genera las filas de la exportación de arqueos de una o varias empresas.
+    
+    Los arqueos se leen por lotes con yield_per() ordenados por empresa y fecha
+    (más recientes primero) y después de cada mes se añade una fila de subtotal
+    calculada sobre la marcha, de modo que la memoria no depende del número de
+    arqueos ni de años exportados.
+    
+    Args:
+        company_ids: IDs de las empresas
+        start_date: Fecha inicial incluida (opcional)
+        end_date: Fecha final incluida (opcional)
+        include_company: Añadir la columna de empresa
+        as_text: Importes como texto con dos decimales (CSV) en lugar de números (Excel)
+    """
+    from models import Company
+    from utils_excel import EXPORT_YIELD_PER
+
+    query = db.session.query(
+        CashRegister.company_id, Company.name, CashRegister.date,
+        *[getattr(CashRegister, column) for column in REGISTER_EXPORT_AMOUNTS],
+        CashRegister.expenses_notes, CashRegister.notes, CashRegister.employee_name
+    ).join(Company, Company.id == CashRegister.company_id)\
+        .filter(CashRegister.company_id.in_(company_ids))
+    if start_date:
+        query = query.filter(CashRegister.date >= start_date)
+    if end_date:
+        query = query.filter(CashRegister.date <= end_date)
+    query = query.order_by(Company.name, CashRegister.company_id, CashRegister.date.desc(), CashRegister.id)
+
+    def amount(value):
+        value = value or 0.0
+        return f"{value:.2f}" if as_text else value
+
+    def subtotal_row(company_name, period, sums):
+        row = [f"Subtotal {period[1]:02d}/{period[0]}"] + [amount(value) for value in sums] + ['', '', '']
+        return ([company_name] if include_company else []) + row
+
+    # El periodo se agrupa por ID de empresa (puede haber empresas con el mismo nombre)
+    current = None
+    current_name = None
+    sums = None
+    for row in query.yield_per(EXPORT_YIELD_PER):
+        company_id, company_name, register_date = row[0], row[1], row[2]
+        amounts = row[3:3 + len(REGISTER_EXPORT_AMOUNTS)]
+        period = (company_id, register_date.year, register_date.month)
+        if period != current:
+            if current is not None:
+                yield subtotal_row(current_name, current[1:], sums)
+            current, current_name = period, company_name
+            sums = [0.0] * len(REGISTER_EXPORT_AMOUNTS)
+        for index, value in enumerate(amounts):
+            sums[index] += value or 0.0
+
+        line = [register_date.strftime('%d/%m/%Y')] + [amount(value) for value in amounts] + list(row[-3:])
+        yield ([company_name] if include_company else []) + line
+
+    if current is not None:
+        yield subtotal_row(current_name, current[1:], sums)
+
+
 def format_currency(value):
     """
     Formatea un valor como moneda en euros.
@@ -0,0 +1,21 @@
+"""
+Utilidades de base de datos compartidas por los módulos de utilidades.
+"""
+from app import db
+
+
+def upsert_insert(bind=None):
+    """
+    Constructor de INSERT con ON CONFLICT del dialecto actual (o None si no lo admite).
+
+    Args:
+        bind: Conexión o motor cuyo dialecto se usa (por defecto, el de la sesión)
+    """
+    dialect = (bind or db.session.get_bind()).dialect.name
+    if dialect == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    elif dialect == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert
+    else:
+        return None
+    return insert
@@ -0,0 +1,155 @@
+"""
+Utilidades para exportar datos a Excel (y CSV) en memoria constante.
+
+Los libros se escriben con openpyxl en modo write_only: cada fila se vuelca a
+disco según se genera, de modo que las filas pueden venir directamente de una
+consulta con yield_per(). El ancho de las columnas se estima con una muestra de
+las primeras filas (el modo write_only exige fijarlo antes de escribir) y el
+archivo resultante se envía desde un fichero temporal por bloques.
+
+Los CSV no necesitan fichero intermedio: se envían como respuesta en streaming
+según se generan las filas.
+"""
+import csv
+import tempfile
+import unicodedata
+from collections import namedtuple
+from itertools import islice
+from urllib.parse import quote
+
+from flask import Response, send_file, stream_with_context
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Font, PatternFill
+from openpyxl.utils import get_column_letter
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+# Filas que se usan para estimar el ancho de las columnas
+WIDTH_SAMPLE_ROWS = 200
+
+# Ancho máximo de columna estimado
+MAX_COLUMN_WIDTH = 60
+
+# Filas por lote al leer de la base de datos (yield_per)
+EXPORT_YIELD_PER = 1000
+
+# Filas de CSV que se envían juntas en cada bloque de la respuesta
+CSV_CHUNK_ROWS = 500
+
+# Hoja de un libro de exportación: rows puede ser cualquier iterable (p. ej. un generador)
+ExcelSheet = namedtuple('ExcelSheet', 'title headers rows')
+
+
+def estimate_column_widths(headers, sample_rows):
+    """Calcula el ancho de cada columna a partir de los encabezados y una muestra de filas."""
+    widths = [len(str(header)) for header in headers]
+    for row in sample_rows:
+        for index, value in enumerate(row[:len(widths)]):
+            if value is not None and value != '':
+                widths[index] = max(widths[index], len(str(value)))
+    return [min(width + 2, MAX_COLUMN_WIDTH) for width in widths]
+
+
+def write_xlsx(sheets, output, styled_headers=True):
+    """
+    Escribe un libro en modo write_only.
+
+    Args:
+        sheets: Lista de ExcelSheet
+        output: Ruta o fichero binario de destino
+        styled_headers: Encabezados en negrita con fondo gris
+    """
+    workbook = Workbook(write_only=True)
+    header_font = Font(bold=True)
+    header_fill = PatternFill(start_color="DDDDDD", end_color="DDDDDD", fill_type="solid")
+
+    for sheet in sheets:
+        worksheet = workbook.create_sheet(title=sheet.title)
+        rows = iter(sheet.rows)
+
+        # Los anchos deben fijarse antes de escribir la primera fila
+        sample = list(islice(rows, WIDTH_SAMPLE_ROWS))
+        for index, width in enumerate(estimate_column_widths(sheet.headers, sample), 1):
+            worksheet.column_dimensions[get_column_letter(index)].width = width
+
+        if styled_headers:
+            header_cells = []
+            for header in sheet.headers:
+                cell = WriteOnlyCell(worksheet, value=header)
+                cell.font = header_font
+                cell.fill = header_fill
+                header_cells.append(cell)
+            worksheet.append(header_cells)
+        else:
+            worksheet.append(list(sheet.headers))
+
+        for row in sample:
+            worksheet.append(row)
+        for row in rows:
+            worksheet.append(row)
+
+    workbook.save(output)
+
+
+def send_xlsx(sheets, filename, styled_headers=True):
+    """
+    Genera un libro y lo envía como descarga sin cargarlo en memoria.
+
+    El libro se escribe en un fichero temporal que se transmite por bloques y se
+    elimina al terminar la respuesta.
+    """
+    output = tempfile.TemporaryFile(suffix='.xlsx')
+    try:
+        write_xlsx(sheets, output, styled_headers=styled_headers)
+        output.seek(0)
+    except Exception:
+        output.close()
+        raise
+
+    return send_file(
+        output,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=filename
+    )
+
+
+class _CsvLine:
+    """Destino de csv.writer que devuelve cada línea en lugar de escribirla."""
+
+    def write(self, value):
+        return value
+
+
+def iter_csv(headers, rows, chunk_rows=CSV_CHUNK_ROWS):
+    """Genera un CSV (UTF-8 con BOM, para Excel) en bloques de chunk_rows filas."""
+    writer = csv.writer(_CsvLine())
+    chunk = ['\ufeff', writer.writerow(headers)]
+    for row in rows:
+        chunk.append(writer.writerow(row))
+        if len(chunk) >= chunk_rows:
+            yield ''.join(chunk).encode('utf-8')
+            chunk = []
+    if chunk:
+        yield ''.join(chunk).encode('utf-8')
+
+
+def send_csv(headers, rows, filename):
+    """
+    Envía un CSV como descarga en streaming.
+
+    Las filas se consumen dentro del contexto de la petición según se envía la
+    respuesta, así que pueden venir de una consulta con yield_per().
+    """
+    response = Response(stream_with_context(iter_csv(headers, rows)), mimetype='text/csv')
+
+    # Igual que send_file: nombre ASCII y, si hace falta, también el original en UTF-8
+    try:
+        filename.encode('ascii')
+        names = {'filename': filename}
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        names = {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    response.headers.set('Content-Disposition', 'attachment', **names)
+    return response
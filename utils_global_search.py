@@ -0,0 +1,236 @@
+"""
+Búsqueda global (empresas, empleados, locales, puntos de fichaje y productos).
+
+La búsqueda no distingue mayúsculas ni acentos ("Jose" encuentra "José"),
+devuelve los resultados ordenados por relevancia y como mucho un número limitado
+por tipo, restringidos a las empresas a las que tiene acceso el usuario.
+
+En PostgreSQL se usan las extensiones pg_trgm y unaccent: cada tipo tiene un
+índice GIN de trigramas sobre el texto buscable sin acentos (ver la migración
+add_global_search_indexes), que sirve tanto para buscar texto en cualquier parte
+(LIKE '%texto%') como para las coincidencias aproximadas (operador <%). Primero
+van los textos que empiezan por la búsqueda y después los más parecidos.
+
+En otros motores (SQLite en desarrollo) o si las extensiones no están
+disponibles, se usa un índice en memoria por prefijos de palabra y trigramas
+(utils_search_index.NgramSearchIndex) por tipo, que se construye la primera vez
+que se consulta y se descarta cuando cambian los datos: al confirmar la
+transacción en este proceso y, para los cambios de otros procesos, comprobando
+cada cierto tiempo el número de registros y su última modificación.
+"""
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+
+from sqlalchemy import event, text
+from sqlalchemy.orm import object_session
+
+from app import db
+from models import Company, Employee
+from models_checkpoints import CheckPoint
+from models_tasks import Location, Product
+from utils_search_index import NgramSearchIndex, normalize_search_text, INDEX_REVALIDATE_SECONDS
+
+# Resultados por tipo
+DEFAULT_GLOBAL_SEARCH_LIMIT = 20
+
+# Longitud mínima de la búsqueda (sin contar espacios ni signos)
+MIN_QUERY_LENGTH = 2
+
+# Función SQL inmutable (para poder indexarla) que quita los acentos
+UNACCENT_FUNCTION = 'search_unaccent'
+
+# Tipo de resultado: modelo, columnas con el texto buscable, columna de la empresa y join necesario
+SearchType = namedtuple('SearchType', 'model fields company_column join')
+
+SEARCH_TYPES = {
+    'companies': SearchType(Company, (Company.name, Company.tax_id), Company.id, None),
+    'employees': SearchType(Employee, (Employee.first_name, Employee.last_name, Employee.dni),
+                            Employee.company_id, None),
+    'locations': SearchType(Location, (Location.name, Location.city), Location.company_id, None),
+    'checkpoints': SearchType(CheckPoint, (CheckPoint.name, CheckPoint.location), CheckPoint.company_id, None),
+    'products': SearchType(Product, (Product.name,), Location.company_id,
+                           (Location, Location.id == Product.location_id)),
+}
+
+_database_search = {}
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def fold_search_text(value):
+    """Minúsculas y sin acentos, conservando los signos (como search_unaccent(lower(...)))."""
+    decomposed = unicodedata.normalize('NFKD', str(value or '').lower())
+    return ''.join(char for char in decomposed if not unicodedata.combining(char))
+
+
+def database_search_available():
+    """Indica si la base de datos admite la búsqueda con pg_trgm y unaccent (se comprueba una vez)."""
+    engine = db.engine
+    available = _database_search.get(engine.url)
+    if available is None:
+        available = False
+        if engine.dialect.name == 'postgresql':
+            available = bool(db.session.execute(text(
+                "SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm') "
+                "AND EXISTS (SELECT 1 FROM pg_proc WHERE proname = :function)"
+            ), {'function': UNACCENT_FUNCTION}).scalar())
+        _database_search[engine.url] = available
+    return available
+
+
+def _base_select(search_type, *columns):
+    stmt = db.select(*columns)
+    if search_type.join is not None:
+        stmt = stmt.join(*search_type.join)
+    return stmt
+
+
+def _company_filter(stmt, search_type, company_ids):
+    if company_ids is None:
+        return stmt
+    return stmt.where(search_type.company_column.in_(list(company_ids)))
+
+
+def _search_document(search_type):
+    """Expresión SQL del texto buscable; debe coincidir con la de su índice."""
+    document = None
+    for column in search_type.fields:
+        part = db.func.coalesce(column, db.literal_column("''"))
+        document = part if document is None else document.op('||')(db.literal_column("' '")).op('||')(part)
+    return db.func.search_unaccent(db.func.lower(document))
+
+
+def _database_search_type(search_type, query, company_ids, limit):
+    folded = ' '.join(fold_search_text(query).split())
+    escaped = folded.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+    document = _search_document(search_type)
+    similarity = db.func.word_similarity(folded, document)
+
+    stmt = _base_select(search_type, search_type.model.id).where(
+        document.like(f'%{escaped}%', escape='\\') | db.literal(folded).op('<%')(document)
+    )
+    stmt = _company_filter(stmt, search_type, company_ids).order_by(
+        db.case((document.like(f'{escaped}%', escape='\\'), 0), else_=1),
+        similarity.desc(),
+        search_type.model.id
+    ).limit(limit)
+    return list(db.session.execute(stmt).scalars())
+
+
+# Índices en memoria (otros motores)
+
+def get_search_stamp(name):
+    """Marca de versión de los datos de un tipo: (número, última modificación[, del local])."""
+    search_type = SEARCH_TYPES[name]
+    model = search_type.model
+    columns = [db.func.count(model.id), db.func.max(model.updated_at)]
+    if search_type.join is not None:
+        columns.append(db.func.max(search_type.join[0].updated_at))
+    return tuple(db.session.execute(_base_select(search_type, *columns)).one())
+
+
+def build_search_index(name):
+    """Construye el índice en memoria de un tipo."""
+    search_type = SEARCH_TYPES[name]
+    stamp = get_search_stamp(name)
+    rows = db.session.execute(_base_select(
+        search_type, search_type.model.id, search_type.company_column, *search_type.fields))
+    entries = ((row[0], ' '.join(str(value) for value in row[2:] if value), row[1]) for row in rows)
+    return NgramSearchIndex(entries, stamp=stamp)
+
+
+def get_search_index(name):
+    """Devuelve el índice de un tipo, construyéndolo o revalidándolo si hace falta."""
+    index = _indexes.get(name)
+    if index is not None and time.monotonic() - index.checked_at >= INDEX_REVALIDATE_SECONDS:
+        # Cambios hechos por otros procesos
+        if get_search_stamp(name) != index.stamp:
+            index = None
+        else:
+            index.checked_at = time.monotonic()
+
+    if index is None:
+        index = build_search_index(name)
+        with _indexes_lock:
+            _indexes[name] = index
+    return index
+
+
+def invalidate_global_search(name=None):
+    """Descarta el índice en memoria de un tipo (o de todos)."""
+    with _indexes_lock:
+        if name is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(name, None)
+
+
+def global_search(query, company_ids=None, types=None, limit=DEFAULT_GLOBAL_SEARCH_LIMIT):
+    """
+    Busca en varios tipos de registros a la vez.
+
+    Args:
+        query: Texto buscado
+        company_ids: Empresas permitidas (None para todas)
+        types: Nombres de SEARCH_TYPES en los que buscar (por defecto, todos)
+        limit: Resultados máximos por tipo
+
+    Returns:
+        dict: {tipo: [IDs ordenados por relevancia]}
+    """
+    types = list(types or SEARCH_TYPES)
+    if len(normalize_search_text(query).replace(' ', '')) < MIN_QUERY_LENGTH or (
+            company_ids is not None and not company_ids):
+        return {name: [] for name in types}
+
+    results = {}
+    use_database = database_search_available()
+    for name in types:
+        if use_database:
+            results[name] = _database_search_type(SEARCH_TYPES[name], query, company_ids, limit)
+        else:
+            results[name] = [entry_id for entry_id, _ in
+                             get_search_index(name).search(query, limit, groups=company_ids)]
+    return results
+
+
+def load_results(name, ids):
+    """Carga los registros de un tipo en el orden de los resultados."""
+    if not ids:
+        return []
+    model = SEARCH_TYPES[name].model
+    by_id = {obj.id: obj for obj in model.query.filter(model.id.in_(ids))}
+    return [by_id[entry_id] for entry_id in ids if entry_id in by_id]
+
+
+# Invalidación de los índices en memoria al confirmar cambios desde este proceso
+
+def _mark_changed(name):
+    def mark(mapper, connection, target):
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('global_search_invalidate', set()).add(name)
+    return mark
+
+
+def _invalidate_after_commit(session):
+    pending = session.info.pop('global_search_invalidate', None)
+    if pending:
+        for name in pending:
+            invalidate_global_search(name)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('global_search_invalidate', None)
+
+
+for _name, _search_type in SEARCH_TYPES.items():
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_search_type.model, _event_name, _mark_changed(_name))
+# Los productos toman la empresa de su local
+for _event_name in ('after_update', 'after_delete'):
+    event.listen(Location, _event_name, _mark_changed('products'))
+event.listen(db.session, 'after_commit', _invalidate_after_commit)
+event.listen(db.session, 'after_rollback', _discard_after_rollback)
@@ -0,0 +1,243 @@
+"""
+Caché de vistas previas de etiquetas.
+
+Las pantallas de selección de etiquetas (rejilla de productos, selección de
+conservación) y el editor muestran una y otra vez las mismas etiquetas. La vista
+previa se identifica por (versión de la plantilla, producto, tipo de conservación,
+franja horaria, nombre del usuario) y se guarda como PNG en una caché LRU en
+memoria con un tope de entradas y, opcionalmente, en disco bajo uploads/ para
+compartirla entre procesos.
+
+Como la imagen depende solo de la clave, el ETag (fuerte) se calcula a partir de
+la clave sin renderizar nada: una petición condicional que ya tiene la imagen se
+responde con 304 sin tocar la caché.
+"""
+import hashlib
+import io
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+
+from flask import current_app, has_request_context, request
+
+from models_tasks import DEFAULT_CONSERVATION_HOURS
+from utils_labels import format_label_user_name, render_product_label
+
+# Número máximo de vistas previas en memoria (unos 10-20 KB cada una)
+PREVIEW_CACHE_SIZE = 512
+
+# Las fechas de la vista previa se redondean a franjas de estos minutos
+PREVIEW_DATE_BUCKET_MINUTES = 15
+
+# Subcarpeta de uploads/ para la caché en disco
+PREVIEW_DISK_FOLDER = 'label_previews'
+
+# Las vistas previas en disco más antiguas que esto se eliminan (segundos)
+PREVIEW_DISK_MAX_AGE = 24 * 3600
+
+# Cada cuántas escrituras en disco se eliminan las vistas previas caducadas
+PREVIEW_DISK_PRUNE_EVERY = 200
+
+
+class LabelPreviewCache:
+    """Caché LRU de vistas previas (PNG) con una segunda capa opcional en disco."""
+
+    def __init__(self, max_entries=PREVIEW_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_writes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def _disk_path(self, disk_dir, etag):
+        return os.path.join(disk_dir, f"{etag}.png") if disk_dir else None
+
+    def get(self, etag, disk_dir=None):
+        with self._lock:
+            data = self._entries.get(etag)
+            if data is not None:
+                self._entries.move_to_end(etag)
+                self.hits += 1
+                return data
+
+        path = self._disk_path(disk_dir, etag)
+        if path and os.path.exists(path):
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except OSError:
+                data = None
+            if data:
+                self._store(etag, data)
+                with self._lock:
+                    self.disk_hits += 1
+                return data
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _store(self, etag, data):
+        with self._lock:
+            self._entries[etag] = data
+            self._entries.move_to_end(etag)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, etag, data, disk_dir=None):
+        self._store(etag, data)
+
+        path = self._disk_path(disk_dir, etag)
+        if path:
+            try:
+                os.makedirs(disk_dir, exist_ok=True)
+                # Escritura atómica: otro proceso puede estar leyendo el mismo archivo
+                tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+                with open(tmp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except OSError as e:
+                current_app.logger.warning(f"No se pudo guardar la vista previa en disco: {str(e)}")
+                return
+
+            with self._lock:
+                self._disk_writes += 1
+                prune = self._disk_writes % PREVIEW_DISK_PRUNE_EVERY == 0
+            if prune:
+                prune_disk_previews(disk_dir)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': sum(len(data) for data in self._entries.values()),
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+            }
+
+
+preview_cache = LabelPreviewCache()
+
+
+def prune_disk_previews(disk_dir, max_age=PREVIEW_DISK_MAX_AGE):
+    """Elimina las vistas previas en disco que ya no pueden volver a pedirse."""
+    limit = time.time() - max_age
+    removed = 0
+    try:
+        with os.scandir(disk_dir) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file() and entry.stat().st_mtime < limit:
+                        os.remove(entry.path)
+                        removed += 1
+                except OSError:
+                    continue
+    except OSError:
+        pass
+    return removed
+
+
+def get_preview_disk_dir():
+    """Carpeta de la caché en disco, o None si está desactivada."""
+    if not current_app.config.get('LABEL_PREVIEW_DISK_CACHE', True):
+        return None
+    upload_folder = current_app.config.get('UPLOAD_FOLDER')
+    if not upload_folder:
+        return None
+    return os.path.join(upload_folder, PREVIEW_DISK_FOLDER)
+
+
+def preview_date_bucket(now=None):
+    """Inicio de la franja horaria de la vista previa."""
+    now = now or datetime.now()
+    minute = now.minute - now.minute % PREVIEW_DATE_BUCKET_MINUTES
+    return now.replace(minute=minute, second=0, microsecond=0)
+
+
+def preview_bucket_remaining(bucket):
+    """Segundos que quedan hasta el final de la franja (para Cache-Control)."""
+    end = bucket + timedelta(minutes=PREVIEW_DATE_BUCKET_MINUTES)
+    return max(0, int((end - datetime.now()).total_seconds()))
+
+
+def _version(value):
+    return value.isoformat() if value else ''
+
+
+def label_preview_key(template, product, conservation, conservation_type, bucket, user_name):
+    """
+    Clave de la vista previa.
+
+    Además del id del producto se incluye su fecha de modificación (y la de su
+    conservación) para que cambiar el nombre o las horas genere una vista nueva.
+    """
+    template_version = (template.id, _version(template.updated_at)) if template is not None else None
+    product_version = (_version(getattr(product, 'updated_at', None)),
+                       _version(conservation.updated_at) if conservation is not None else '')
+    return (template_version, getattr(product, 'id', None), product_version,
+            conservation_type.value, bucket.strftime('%Y%m%d%H%M'), user_name)
+
+
+def label_preview_etag(key):
+    """ETag fuerte de la vista previa (depende solo de la clave)."""
+    return hashlib.sha256(repr(key).encode('utf-8')).hexdigest()[:32]
+
+
+def get_label_preview(product, user, conservation_type, conservation=None, template=None, now=None):
+    """
+    Devuelve la vista previa de una etiqueta (PNG) y su ETag, renderizándola si no está en caché.
+
+    Args:
+        product: Producto (o un objeto con name y shelf_life_days)
+        user: Usuario local (o un objeto con name, last_name y username)
+        conservation_type: Tipo de conservación
+        conservation: ProductConservation del producto para ese tipo (opcional)
+        template: Plantilla de etiquetas del local (opcional)
+        now: Fecha de referencia (por defecto, ahora)
+
+    Returns:
+        tuple: (PNG en bytes o None si solo se pidió el ETag, etag, inicio de la franja)
+    """
+    bucket = preview_date_bucket(now)
+    key = label_preview_key(template, product, conservation, conservation_type, bucket,
+                            format_label_user_name(user))
+    etag = label_preview_etag(key)
+
+    # El cliente ya tiene esta vista previa
+    if has_request_context() and etag in request.if_none_match:
+        return None, etag, bucket
+
+    disk_dir = get_preview_disk_dir()
+    data = preview_cache.get(etag, disk_dir)
+    if data is None:
+        hours = conservation.hours_valid if conservation is not None else DEFAULT_CONSERVATION_HOURS.get(conservation_type, 24)
+        image = render_product_label(product, user, conservation_type, bucket,
+                                     bucket + timedelta(hours=hours), template=template)
+        buffer = io.BytesIO()
+        image.save(buffer, format='PNG', optimize=True)
+        data = buffer.getvalue()
+        preview_cache.put(etag, data, disk_dir)
+    return data, etag, bucket
+
+
+def label_preview_response(product, user, conservation_type, conservation=None, template=None):
+    """Respuesta HTTP con la vista previa, con ETag fuerte y caché privada hasta el final de la franja."""
+    data, etag, bucket = get_label_preview(product, user, conservation_type,
+                                           conservation=conservation, template=template)
+    if data is None:
+        response = current_app.response_class(status=304)
+    else:
+        response = current_app.response_class(data, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={preview_bucket_remaining(bucket)}'
+    return response
@@ -0,0 +1,420 @@
+"""
+Motor de renderizado de etiquetas de productos (imágenes PIL para Brother / Raspberry Pi).
+
+Las fuentes se cargan una sola vez por proceso y cada diseño de etiqueta se compila
+una vez (posiciones de cada campo y fuentes ya resueltas). Por cada etiqueta solo se
+dibujan los campos variables sobre una copia del fondo precompilado, reutilizando
+los bloques de texto ya rasterizados (nombre del producto, tipo de conservación,
+usuario...) que se repiten de una etiqueta a otra.
+
+Para la impresión desde el servidor las etiquetas se convierten a rasters monocromo de
+1 bit en el formato que entiende cada tipo de impresora (comandos raster Brother o PNG
+de 1 bit) y un lote de N etiquetas se envía como una única carga de varias páginas.
+"""
+import base64
+import io
+import json
+import struct
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import timedelta
+from functools import lru_cache
+
+from PIL import Image, ImageChops, ImageDraw, ImageFont
+
+# Tamaño de la etiqueta: 40mm x 30mm a 300 DPI
+LABEL_WIDTH = 472
+LABEL_HEIGHT = 354
+
+LABEL_FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans-Bold.ttf"
+
+# Formatos de salida de las etiquetas
+LABEL_FORMAT_PNG = 'png'                        # PNG RGB (puente Android / navegador)
+LABEL_FORMAT_PNG_1BIT = 'png_1bit'              # PNG monocromo de 1 bit (Raspberry Pi + CUPS)
+LABEL_FORMAT_BROTHER_RASTER = 'brother_raster'  # Comandos raster Brother (impresión directa)
+
+# Parámetros del raster Brother para la TD-4550DNWB (cabezal de 1248 puntos a 300 DPI)
+BROTHER_RASTER_BYTES_PER_LINE = 156
+BROTHER_MEDIA_WIDTH_MM = 40
+BROTHER_MEDIA_LENGTH_MM = 30
+
+# Número máximo de bloques de texto rasterizados que se conservan por diseño
+TEXT_BLOCK_CACHE_SIZE = 2048
+
+# Un campo de la etiqueta: posición vertical relativa (avance tras dibujarlo),
+# tamaño de fuente y, opcionalmente, una fuente alternativa para textos largos.
+LabelSlot = namedtuple('LabelSlot', ['name', 'font_size', 'advance', 'optional',
+                                     'alt_font_size', 'alt_min_length'])
+
+# Diseño del renderizado directo (el mismo que generaba generate_labels)
+DEFAULT_LABEL_SLOTS = (
+    LabelSlot('product_name', 42, 58, False, 28, 15),   # Título, más pequeño si es largo
+    LabelSlot('conservation', 28, 55, False, None, None),
+    LabelSlot('expiry', 34, 90, False, None, None),
+    LabelSlot('elaboration', 24, 42, False, None, None),
+    LabelSlot('shelf_life', 26, 42, True, None, None),   # Solo si el producto tiene vida útil
+    LabelSlot('user', 32, 0, False, None, None),
+)
+DEFAULT_LABEL_TOP = 8
+
+
+@lru_cache(maxsize=None)
+def get_label_font(size, path=LABEL_FONT_PATH):
+    """Devuelve la fuente TrueType del tamaño indicado, cargada una sola vez por proceso."""
+    try:
+        return ImageFont.truetype(path, size)
+    except OSError:
+        return ImageFont.load_default()
+
+
+class CompiledLabelLayout:
+    """Diseño de etiqueta precompilado: fuentes, posiciones y bloques de texto medidos."""
+
+    def __init__(self, slots=DEFAULT_LABEL_SLOTS, width=LABEL_WIDTH, height=LABEL_HEIGHT,
+                 top=DEFAULT_LABEL_TOP):
+        self.width = width
+        self.height = height
+        self.slots = tuple(slots)
+        self.fonts = {}
+        for slot in self.slots:
+            self.fonts[slot.font_size] = get_label_font(slot.font_size)
+            if slot.alt_font_size:
+                self.fonts[slot.alt_font_size] = get_label_font(slot.alt_font_size)
+
+        # Posiciones verticales para cada combinación de campos opcionales presentes
+        optional_names = [slot.name for slot in self.slots if slot.optional]
+        self.positions = {}
+        for mask in range(2 ** len(optional_names)):
+            present = frozenset(name for i, name in enumerate(optional_names) if mask & (1 << i))
+            y_pos = top
+            slot_positions = {}
+            for slot in self.slots:
+                if slot.optional and slot.name not in present:
+                    continue
+                slot_positions[slot.name] = y_pos
+                y_pos += slot.advance
+            self.positions[present] = slot_positions
+
+        self._background = Image.new('RGB', (width, height), 'white')
+        self._text_blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _font_for(self, slot, text):
+        if slot.alt_font_size and len(text) >= slot.alt_min_length:
+            return slot.alt_font_size
+        return slot.font_size
+
+    def text_block(self, font_size, text):
+        """
+        Devuelve (máscara, desplazamiento x, desplazamiento y, ancho) del texto rasterizado.
+
+        Los bloques se guardan en una caché LRU acotada para no volver a rasterizar los
+        textos que se repiten entre etiquetas.
+        """
+        key = (font_size, text)
+        with self._lock:
+            block = self._text_blocks.get(key)
+            if block is not None:
+                self._text_blocks.move_to_end(key)
+                return block
+
+        font = self.fonts.get(font_size) or get_label_font(font_size)
+        left, top, right, bottom = ImageDraw.Draw(self._background).textbbox((0, 0), text, font=font)
+        mask = Image.new('L', (max(1, right - left), max(1, bottom - top)), 0)
+        ImageDraw.Draw(mask).text((-left, -top), text, fill=255, font=font)
+        block = (mask, left, top, right - left)
+
+        with self._lock:
+            self._text_blocks[key] = block
+            if len(self._text_blocks) > TEXT_BLOCK_CACHE_SIZE:
+                self._text_blocks.popitem(last=False)
+        return block
+
+    def render(self, fields):
+        """
+        Dibuja una etiqueta con los valores de los campos variables.
+
+        Args:
+            fields: Diccionario nombre de campo -> texto. Los campos opcionales vacíos se omiten.
+
+        Returns:
+            Image: Imagen RGB de la etiqueta
+        """
+        present = frozenset(slot.name for slot in self.slots if slot.optional and fields.get(slot.name))
+        positions = self.positions[present]
+
+        image = self._background.copy()
+        for slot in self.slots:
+            if slot.name not in positions:
+                continue
+            text = fields.get(slot.name)
+            if not text:
+                continue
+            mask, left, top, text_width = self.text_block(self._font_for(slot, text), text)
+            x_centered = (self.width - text_width) // 2
+            image.paste((0, 0, 0), (x_centered + left, positions[slot.name] + top), mask)
+        return image
+
+
+_layout_cache = {}
+_layout_cache_lock = threading.Lock()
+
+
+def get_compiled_layout(template=None):
+    """
+    Devuelve el diseño compilado para una plantilla de etiquetas.
+
+    Los diseños se compilan una vez por proceso y se identifican por el id y la fecha de
+    modificación de la plantilla, de modo que editar la plantilla genera un diseño nuevo.
+    """
+    if template is not None and template.id is not None:
+        key = (template.id, template.updated_at)
+    else:
+        key = None
+
+    layout = _layout_cache.get(key)
+    if layout is None:
+        with _layout_cache_lock:
+            layout = _layout_cache.get(key)
+            if layout is None:
+                layout = CompiledLabelLayout()
+                # Descartar versiones anteriores de la misma plantilla
+                if key is not None:
+                    for old_key in [k for k in _layout_cache if k is not None and k[0] == key[0]]:
+                        del _layout_cache[old_key]
+                _layout_cache[key] = layout
+    return layout
+
+
+def format_label_user_name(user):
+    """Primer nombre + inicial del apellido del usuario local (o su username)."""
+    try:
+        if user.name and user.last_name:
+            return f"{user.name} {user.last_name[0]}."
+        elif user.name:
+            return user.name
+        return user.username[:12]
+    except Exception:
+        return (user.username or '')[:12]
+
+
+def build_label_fields(product, user, conservation_type, start_datetime, expiry_datetime,
+                       start_prefix='ELAB'):
+    """
+    Construye los textos variables de una etiqueta.
+
+    Args:
+        product: Producto etiquetado
+        user: Usuario local que genera la etiqueta
+        conservation_type: Tipo de conservación (ConservationType)
+        start_datetime: Fecha de elaboración (o de inicio de la conservación)
+        expiry_datetime: Fecha y hora de caducidad
+        start_prefix: Prefijo de la fecha de inicio ('ELAB' o 'INICIO')
+    """
+    fields = {
+        'product_name': product.name[:18].upper(),
+        'conservation': conservation_type.value.upper(),
+        'elaboration': f"{start_prefix}: {start_datetime.strftime('%d/%m/%Y %H:%M')}",
+        'user': format_label_user_name(user),
+    }
+    if expiry_datetime:
+        fields['expiry'] = f"CAD: {expiry_datetime.strftime('%d/%m/%Y %H:%M')}"
+    if product.shelf_life_days and product.shelf_life_days > 0:
+        shelf_life_expiry = start_datetime.date() + timedelta(days=product.shelf_life_days)
+        fields['shelf_life'] = f"1ᵃ {shelf_life_expiry.strftime('%d/%m/%Y')}"
+    return fields
+
+
+def render_product_label(product, user, conservation_type, start_datetime, expiry_datetime,
+                         template=None, start_prefix='ELAB'):
+    """Renderiza la etiqueta de un producto como imagen PIL usando el diseño compilado."""
+    fields = build_label_fields(product, user, conservation_type, start_datetime,
+                                expiry_datetime, start_prefix=start_prefix)
+    return get_compiled_layout(template).render(fields)
+
+
+def label_image_to_base64(image):
+    """Codifica la imagen de la etiqueta como PNG en base64."""
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+# Salida monocromo para impresión directa
+
+# Carga lista para enviar a una impresora: formato, tipo de contenido, cuerpo y número de páginas/etiquetas
+LabelPrintPayload = namedtuple('LabelPrintPayload', ['label_format', 'content_type', 'body',
+                                                     'page_count', 'label_count'])
+
+
+def to_monochrome(image, threshold=128):
+    """Convierte la etiqueta a 1 bit por píxel (sin tramado, como la imprime el cabezal térmico)."""
+    return image.convert('L').point(lambda value: 255 if value >= threshold else 0, mode='1')
+
+
+def encode_png_1bit(image):
+    """Codifica la etiqueta como PNG monocromo de 1 bit de profundidad."""
+    buffer = io.BytesIO()
+    to_monochrome(image).save(buffer, format='PNG', optimize=True)
+    return buffer.getvalue()
+
+
+def packbits_encode(data):
+    """Comprime una línea con PackBits (compresión TIFF que acepta el modo raster Brother)."""
+    result = bytearray()
+    length = len(data)
+    i = 0
+    while i < length:
+        # Secuencia de bytes repetidos
+        run = 1
+        while i + run < length and run < 128 and data[i + run] == data[i]:
+            run += 1
+        if run > 1:
+            result.append(257 - run)
+            result.append(data[i])
+            i += run
+            continue
+
+        # Secuencia de bytes literales (hasta el inicio de la siguiente repetición)
+        start = i
+        i += 1
+        while i < length and i - start < 128:
+            if i + 1 < length and data[i] == data[i + 1]:
+                break
+            i += 1
+        result.append(i - start - 1)
+        result.extend(data[start:i])
+    return bytes(result)
+
+
+def _brother_raster_lines(image, bytes_per_line):
+    """Líneas raster Brother (PackBits) de una etiqueta, centradas en el cabezal."""
+    head_dots = bytes_per_line * 8
+    mono = to_monochrome(image)
+    width, height = mono.size
+    if width > head_dots:
+        mono = mono.crop((0, 0, head_dots, height))
+        width = head_dots
+
+    # En modo '1' de PIL el blanco es 1; en el raster Brother un bit a 1 es un punto negro
+    canvas = Image.new('1', (head_dots, height), 0)
+    canvas.paste(ImageChops.invert(mono), ((head_dots - width) // 2, 0))
+    raw = canvas.tobytes()
+
+    lines = bytearray()
+    for offset in range(0, len(raw), bytes_per_line):
+        line = raw[offset:offset + bytes_per_line]
+        if not any(line):
+            lines += b'Z'                    # Línea en blanco
+        else:
+            packed = packbits_encode(line)
+            lines += b'G' + struct.pack('<H', len(packed)) + packed
+    return height, bytes(lines)
+
+
+def encode_brother_raster(pages, bytes_per_line=BROTHER_RASTER_BYTES_PER_LINE,
+                          media_width_mm=BROTHER_MEDIA_WIDTH_MM,
+                          media_length_mm=BROTHER_MEDIA_LENGTH_MM):
+    """
+    Genera un único trabajo en modo raster Brother con una página por etiqueta.
+
+    Cada fila de la imagen es una línea raster (comprimida con PackBits) centrada en el
+    cabezal; las páginas se separan con FF y el trabajo termina con Control-Z. Las
+    copias de una misma imagen se codifican una sola vez.
+    """
+    job = bytearray(b'\x00' * 200)           # Invalidar
+    job += b'\x1b@'                          # Inicializar
+    job += b'\x1bia\x01'                     # Cambiar a modo raster
+
+    encoded = {}
+    for page_number, page in enumerate(pages):
+        if id(page) not in encoded:
+            encoded[id(page)] = _brother_raster_lines(page, bytes_per_line)
+        height, lines = encoded[id(page)]
+
+        # Información de impresión: tipo de medio, ancho, largo, número de líneas y página
+        job += b'\x1biz' + bytes([0x8E, 0x0B, media_width_mm, media_length_mm])
+        job += struct.pack('<I', height) + bytes([0 if page_number == 0 else 1, 0])
+        job += b'M\x02'                       # Compresión PackBits
+        job += lines
+        job += b'\x1a' if page_number == len(pages) - 1 else b'\x0c'
+
+    return bytes(job)
+
+
+def build_label_payload(pages, label_format):
+    """
+    Construye una única carga de impresión para un lote de etiquetas.
+
+    Args:
+        pages: Lista de (imagen, copias) con cada etiqueta distinta y cuántas se imprimen
+        label_format: Formato negociado con la impresora (ver LABEL_FORMAT_*)
+
+    Returns:
+        LabelPrintPayload: Carga lista para enviar a la impresora
+    """
+    label_count = sum(copies for _, copies in pages)
+
+    if label_format == LABEL_FORMAT_BROTHER_RASTER:
+        expanded = [image for image, copies in pages for _ in range(copies)]
+        return LabelPrintPayload(label_format, 'application/octet-stream',
+                                 encode_brother_raster(expanded), len(expanded), label_count)
+
+    if label_format == LABEL_FORMAT_PNG_1BIT:
+        encode = lambda image: base64.b64encode(encode_png_1bit(image)).decode('ascii')
+    else:
+        encode = label_image_to_base64
+
+    body = json.dumps({
+        'format': label_format,
+        'pages': [{'content': encode(image), 'copies': copies} for image, copies in pages]
+    }).encode('utf-8')
+    return LabelPrintPayload(label_format, 'application/json', body, len(pages), label_count)
+
+
+def serialize_label_pages(pages):
+    """Serializa un lote [(imagen, copias)] como JSON compacto de PNG de 1 bit."""
+    return json.dumps([
+        {'content': base64.b64encode(encode_png_1bit(image)).decode('ascii'), 'copies': copies}
+        for image, copies in pages
+    ])
+
+
+def deserialize_label_pages(data):
+    """Reconstruye el lote [(imagen, copias)] guardado con serialize_label_pages."""
+    pages = []
+    for page in json.loads(data):
+        image = Image.open(io.BytesIO(base64.b64decode(page['content'])))
+        image.load()
+        pages.append((image, int(page.get('copies', 1))))
+    return pages
+
+
+def post_label_payload(url, payload, timeout=10.0):
+    """
+    Envía una carga de etiquetas a la URL de la impresora.
+
+    Returns:
+        tuple: (éxito, mensaje)
+    """
+    import requests
+
+    try:
+        response = requests.post(url, data=payload.body, timeout=timeout,
+                                 headers={'Content-Type': payload.content_type,
+                                          'X-Label-Format': payload.label_format})
+    except requests.RequestException as e:
+        return False, f"Error de conexión con la impresora: {str(e)}"
+
+    if response.status_code != 200:
+        return False, f"La impresora respondió con el código {response.status_code}"
+
+    if payload.content_type == 'application/json':
+        try:
+            result = response.json()
+        except ValueError:
+            result = {}
+        if result.get('success') is False:
+            return False, result.get('message', 'Error en la impresora')
+
+    return True, f"{payload.label_count} etiqueta(s) enviadas ({len(payload.body)} bytes)"
@@ -0,0 +1,342 @@
+"""
+Importación de productos y tiempos de conservación desde Excel.
+
+El libro se lee en modo solo lectura fila a fila, los productos y conservaciones
+existentes del local se cargan una única vez en diccionarios y los cambios se
+escriben en bloques con inserciones y actualizaciones masivas, de modo que el
+coste no depende de consultas por fila. La importación devuelve un informe con
+los errores de cada fila y puede ejecutarse en modo de previsualización sin
+guardar nada.
+"""
+from collections import namedtuple
+from datetime import datetime
+
+import openpyxl
+from sqlalchemy import insert, update
+
+from app import db
+from models_tasks import Product, ProductConservation, ConservationType
+
+# Encabezados de la hoja de productos (plantilla, exportación e importación)
+PRODUCT_EXCEL_HEADERS = [
+    "Nombre",
+    "Descripción",
+    "Vida útil (días)",
+    "Descongelación (horas)",
+    "Refrigeración (horas)",
+    "Gastro (horas)",
+    "Caliente (horas)",
+    "Seco (horas)",
+]
+
+# Tipo de conservación de cada columna de horas, a partir de la cuarta columna
+PRODUCT_EXCEL_CONSERVATION_COLUMNS = [
+    ConservationType.DESCONGELACION,
+    ConservationType.REFRIGERACION,
+    ConservationType.GASTRO,
+    ConservationType.CALIENTE,
+    ConservationType.SECO,
+]
+
+# Filas que se escriben en cada bloque de inserciones/actualizaciones
+IMPORT_CHUNK_SIZE = 500
+
+# Filas que se muestran en la previsualización
+PREVIEW_MAX_ROWS = 100
+
+# Acciones de cada fila en el informe
+ACTION_CREATE = 'crear'
+ACTION_UPDATE = 'actualizar'
+ACTION_UNCHANGED = 'sin cambios'
+
+ImportRow = namedtuple('ImportRow', 'row_number name description shelf_life_days hours')
+ImportRowError = namedtuple('ImportRowError', 'row_number name message')
+
+
+class ProductImportResult:
+    """Resultado de una importación (o de su previsualización)."""
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.created = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.conservations_created = 0
+        self.conservations_updated = 0
+        self.errors = []
+        self.preview = []
+
+    @property
+    def processed(self):
+        return self.created + self.updated + self.unchanged
+
+    def add_preview(self, row, action):
+        if len(self.preview) < PREVIEW_MAX_ROWS:
+            self.preview.append({
+                'row_number': row.row_number,
+                'name': row.name,
+                'shelf_life_days': row.shelf_life_days,
+                'hours': {cons_type.value: hours for cons_type, hours in row.hours.items()},
+                'action': action,
+            })
+
+    def to_dict(self):
+        return {
+            'dry_run': self.dry_run,
+            'created': self.created,
+            'updated': self.updated,
+            'unchanged': self.unchanged,
+            'conservations_created': self.conservations_created,
+            'conservations_updated': self.conservations_updated,
+            'errors': [error._asdict() for error in self.errors],
+            'preview': self.preview,
+        }
+
+
+def _parse_int(value, field_name):
+    """Convierte una celda en entero no negativo (None si está vacía)."""
+    if value is None or (isinstance(value, str) and not value.strip()):
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field_name}: "{value}" no es un número')
+    if number < 0 or number != int(number):
+        raise ValueError(f'{field_name}: "{value}" debe ser un número entero positivo')
+    return int(number)
+
+
+def parse_product_row(row_number, values):
+    """
+    Valida una fila de la hoja de productos.
+
+    Returns:
+        ImportRow o None si la fila no tiene nombre (se ignora)
+
+    Raises:
+        ValueError: si algún valor de la fila no es válido
+    """
+    values = tuple(values) + (None,) * (len(PRODUCT_EXCEL_HEADERS) - len(values))
+    name = values[0]
+    if name is None or not str(name).strip():
+        return None
+    name = str(name).strip()
+    if len(name) > Product.name.type.length:
+        raise ValueError(f'Nombre: no puede superar {Product.name.type.length} caracteres')
+
+    shelf_life_days = _parse_int(values[2], PRODUCT_EXCEL_HEADERS[2]) or 0
+
+    hours = {}
+    for offset, cons_type in enumerate(PRODUCT_EXCEL_CONSERVATION_COLUMNS):
+        value = _parse_int(values[3 + offset], PRODUCT_EXCEL_HEADERS[3 + offset])
+        if value:
+            hours[cons_type] = value
+
+    return ImportRow(row_number, name, str(values[1]) if values[1] is not None else "", shelf_life_days, hours)
+
+
+def iter_product_rows(file):
+    """
+    Recorre las filas de datos del libro sin cargarlo entero en memoria.
+
+    Yields:
+        (número de fila, valores de la fila)
+    """
+    wb = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        ws = wb.active
+        for row_number, values in enumerate(
+                ws.iter_rows(min_row=2, max_col=len(PRODUCT_EXCEL_HEADERS), values_only=True), start=2):
+            yield row_number, values
+    finally:
+        wb.close()
+
+
+def _load_existing(location_id):
+    """Carga una sola vez los productos y conservaciones del local en diccionarios."""
+    products = {}
+    for product_id, name, description, shelf_life_days in db.session.query(
+            Product.id, Product.name, Product.description, Product.shelf_life_days
+    ).filter(Product.location_id == location_id):
+        # Si hay nombres repetidos en el local se actualiza el primero, como hasta ahora
+        products.setdefault(name, (product_id, description, shelf_life_days))
+
+    conservations = {}
+    for conservation_id, product_id, cons_type, hours_valid in db.session.query(
+            ProductConservation.id, ProductConservation.product_id,
+            ProductConservation.conservation_type, ProductConservation.hours_valid
+    ).join(Product, Product.id == ProductConservation.product_id).filter(Product.location_id == location_id):
+        conservations.setdefault((product_id, cons_type), (conservation_id, hours_valid))
+
+    return products, conservations
+
+
+def _flush_chunk(location_id, new_products, product_updates, conservation_rows, conservations, products):
+    """Escribe un bloque: productos nuevos, productos modificados y conservaciones."""
+    now = datetime.utcnow()
+
+    if new_products:
+        rows = [{
+            'name': row.name,
+            'description': row.description,
+            'shelf_life_days': row.shelf_life_days,
+            'location_id': location_id,
+            'is_active': True,
+            'created_at': now,
+            'updated_at': now,
+        } for row in new_products.values()]
+        inserted = db.session.execute(
+            insert(Product).returning(Product.id, Product.name, sort_by_parameter_order=True), rows
+        )
+        for product_id, name in inserted:
+            row = new_products[name]
+            products[name] = (product_id, row.description, row.shelf_life_days)
+
+    if product_updates:
+        for values in product_updates.values():
+            values['updated_at'] = now
+        db.session.execute(update(Product), list(product_updates.values()))
+
+    # Por clave (producto, tipo) para que una fila repetida sustituya a la anterior
+    conservation_inserts = {}
+    conservation_updates = {}
+    for name, cons_type, hours in conservation_rows:
+        product_id = products[name][0]
+        key = (product_id, cons_type)
+        existing = conservations.get(key)
+        if existing is None or key in conservation_inserts:
+            conservation_inserts[key] = {
+                'product_id': product_id,
+                'conservation_type': cons_type,
+                'hours_valid': hours,
+                'created_at': now,
+                'updated_at': now,
+            }
+            conservations[key] = (None, hours)
+        elif existing[1] != hours or key in conservation_updates:
+            conservation_updates[key] = {'id': existing[0], 'hours_valid': hours, 'updated_at': now}
+            conservations[key] = (existing[0], hours)
+
+    if conservation_inserts:
+        # Con sus IDs, por si el mismo producto vuelve a aparecer en un bloque posterior
+        inserted = db.session.execute(
+            insert(ProductConservation).returning(
+                ProductConservation.id, ProductConservation.product_id, ProductConservation.conservation_type,
+                ProductConservation.hours_valid, sort_by_parameter_order=True),
+            list(conservation_inserts.values())
+        )
+        for conservation_id, product_id, cons_type, hours_valid in inserted:
+            conservations[(product_id, cons_type)] = (conservation_id, hours_valid)
+    if conservation_updates:
+        db.session.execute(update(ProductConservation), list(conservation_updates.values()))
+
+    return len(conservation_inserts), len(conservation_updates)
+
+
+def import_products_excel(file, location_id, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Importa productos y tiempos de conservación desde un Excel a un local.
+
+    Los productos se identifican por nombre dentro del local: los existentes se
+    actualizan y los demás se crean. Las filas con errores se omiten y se anotan
+    en el informe. Con dry_run no se escribe nada en la base de datos; el llamante
+    es quien confirma la transacción.
+
+    Args:
+        file: Archivo Excel (.xlsx) o ruta
+        location_id: ID del local de destino
+        dry_run: Solo calcular el resultado, sin guardar
+        chunk_size: Filas por bloque de escritura
+
+    Returns:
+        ProductImportResult
+    """
+    result = ProductImportResult(dry_run=dry_run)
+    products, conservations = _load_existing(location_id)
+
+    # Cambios pendientes del bloque actual
+    new_products = {}
+    product_updates = {}
+    conservation_rows = []
+    pending_rows = 0
+
+    # Nombres creados y productos existentes ya vistos en esta importación: si se
+    # repiten en el archivo, la última fila manda pero el producto se cuenta una sola
+    # vez (como creado, o como actualizado si alguna de sus filas lo cambia)
+    created_names = set()
+    updated_ids = set()
+    unchanged_ids = set()
+
+    for row_number, values in iter_product_rows(file):
+        try:
+            row = parse_product_row(row_number, values)
+        except ValueError as e:
+            result.errors.append(ImportRowError(row_number, values[0] if values else None, str(e)))
+            continue
+        if row is None:
+            continue
+
+        existing = products.get(row.name)
+        repeated = row.name in created_names
+        if existing is None:
+            # Producto nuevo (o repetido dentro del bloque actual, aún sin insertar)
+            action = ACTION_CREATE
+            if not repeated:
+                result.created += 1
+                created_names.add(row.name)
+            if not dry_run:
+                new_products[row.name] = row
+        else:
+            product_id, description, shelf_life_days = existing
+            hours_changed = any(
+                conservations.get((product_id, cons_type), (None, None))[1] != hours
+                for cons_type, hours in row.hours.items()
+            )
+            fields_changed = description != row.description or shelf_life_days != row.shelf_life_days
+            if fields_changed:
+                product_updates[product_id] = {
+                    'id': product_id,
+                    'description': row.description,
+                    'shelf_life_days': row.shelf_life_days,
+                }
+                products[row.name] = (product_id, row.description, row.shelf_life_days)
+
+            if repeated:
+                # Creado en un bloque anterior de esta misma importación
+                action = ACTION_CREATE
+            elif product_id in updated_ids:
+                action = ACTION_UPDATE
+            elif fields_changed or hours_changed:
+                action = ACTION_UPDATE
+                result.updated += 1
+                updated_ids.add(product_id)
+                if product_id in unchanged_ids:
+                    # Una fila anterior del mismo producto no lo cambiaba
+                    unchanged_ids.discard(product_id)
+                    result.unchanged -= 1
+            else:
+                action = ACTION_UNCHANGED
+                if product_id not in unchanged_ids:
+                    result.unchanged += 1
+                    unchanged_ids.add(product_id)
+
+        result.add_preview(row, action)
+        if dry_run:
+            continue
+
+        conservation_rows.extend((row.name, cons_type, hours) for cons_type, hours in row.hours.items())
+        pending_rows += 1
+        if pending_rows >= chunk_size:
+            created, updated = _flush_chunk(location_id, new_products, product_updates,
+                                            conservation_rows, conservations, products)
+            result.conservations_created += created
+            result.conservations_updated += updated
+            new_products, product_updates, conservation_rows, pending_rows = {}, {}, [], 0
+
+    if not dry_run and pending_rows:
+        created, updated = _flush_chunk(location_id, new_products, product_updates,
+                                        conservation_rows, conservations, products)
+        result.conservations_created += created
+        result.conservations_updated += updated
+
+    return result
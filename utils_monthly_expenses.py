@@ -0,0 +1,403 @@
+"""
+Utilidades para el módulo de gastos mensuales.
+
+Los resúmenes mensuales (MonthlyExpenseSummary) se recalculan a partir de los
+gastos con una única consulta agrupada por año y mes, y se insertan o actualizan
+en la misma sentencia (INSERT ... SELECT ... ON CONFLICT). Sirve igual para un
+mes, para varios meses o para todos los meses de una empresa.
+
+Los gastos fijos activos se copian a cada mes (un MonthlyExpense enlazado por
+fixed_expense_id) con un único INSERT ... SELECT ... WHERE NOT EXISTS para
+cualquier rango de meses y de empresas. Lo ejecuta al inicio de cada mes el
+servicio fixed_expenses_service.py, de modo que consultar un mes no escribe nada.
+
+El informe anual (matriz mes × categoría con importes y número de gastos, fijos
+y variables) sale de una única consulta agrupada y se guarda en memoria por
+empresa y año junto con la versión de los datos: la fecha de la última
+actualización de los resúmenes (que se recalculan con cada cambio de gastos) y
+de las categorías. Mientras la versión no cambia, el informe no se recalcula.
+"""
+
+import datetime
+import logging
+import threading
+
+from sqlalchemy import tuple_
+
+from app import db
+from models_monthly_expenses import ExpenseCategory, FixedExpense, MonthlyExpense, MonthlyExpenseSummary
+from utils_db import upsert_insert
+from utils_excel import ExcelSheet
+
+logger = logging.getLogger(__name__)
+
+# Columnas del resumen que se recalculan
+SUMMARY_TOTAL_COLUMNS = ('fixed_expenses_total', 'custom_expenses_total', 'total_amount', 'number_of_expenses')
+
+# Nombres de los meses para los informes
+MONTH_NAMES = ('Enero', 'Febrero', 'Marzo', 'Abril', 'Mayo', 'Junio',
+               'Julio', 'Agosto', 'Septiembre', 'Octubre', 'Noviembre', 'Diciembre')
+
+# Informes anuales que se mantienen en memoria (empresa y año)
+REPORT_CACHE_SIZE = 256
+
+_report_cache = {}
+_report_cache_lock = threading.Lock()
+
+
+def _months_filter(columns, months):
+    """Condición sobre (año, mes) para un conjunto de meses."""
+    return tuple_(columns.year, columns.month).in_(sorted(set(months)))
+
+
+def _company_filter(column, company_id):
+    """Condición sobre la empresa: un ID, una lista de IDs o None para todas."""
+    if company_id is None:
+        return db.true()
+    if isinstance(company_id, int):
+        return column == company_id
+    return column.in_(list(company_id))
+
+
+def iter_months(start, end):
+    """Genera los (año, mes) entre start y end, ambos (año, mes) e incluidos."""
+    year, month = start
+    while (year, month) <= tuple(end):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def refresh_expense_summaries(company_id, months=None):
+    """
+    Recalcula los resúmenes mensuales de gastos de una empresa.
+
+    No confirma la transacción: se llama antes del commit de la operación que
+    modifica los gastos, de modo que gastos y resúmenes se guardan juntos.
+
+    Args:
+        company_id: ID de la empresa (o lista de IDs, o None para todas)
+        months: Iterable de (año, mes) a recalcular; None recalcula todos los meses
+
+    Returns:
+        int: Número de resúmenes con gastos insertados o actualizados
+    """
+    if months is not None:
+        months = {(int(year), int(month)) for year, month in months}
+        if not months:
+            return 0
+
+    amount = MonthlyExpense.amount
+    fixed_total = db.func.coalesce(db.func.sum(db.case((MonthlyExpense.is_fixed == True, amount), else_=0.0)), 0.0)
+    custom_total = db.func.coalesce(db.func.sum(db.case((MonthlyExpense.is_fixed == True, 0.0), else_=amount)), 0.0)
+    now = datetime.datetime.utcnow()
+
+    totals = db.select(
+        MonthlyExpense.company_id,
+        MonthlyExpense.year,
+        MonthlyExpense.month,
+        fixed_total,
+        custom_total,
+        db.func.coalesce(db.func.sum(amount), 0.0),
+        db.func.count(MonthlyExpense.id),
+        db.literal(now, db.DateTime),
+        db.literal(now, db.DateTime),
+    ).where(_company_filter(MonthlyExpense.company_id, company_id))
+    if months is not None:
+        totals = totals.where(_months_filter(MonthlyExpense, months))
+    totals = totals.group_by(MonthlyExpense.company_id, MonthlyExpense.year, MonthlyExpense.month)
+
+    table = MonthlyExpenseSummary.__table__
+    columns = ['company_id', 'year', 'month', *SUMMARY_TOTAL_COLUMNS, 'created_at', 'updated_at']
+    insert = upsert_insert()
+    if insert is not None:
+        stmt = insert(table).from_select(columns, totals)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['company_id', 'year', 'month'],
+            set_={name: stmt.excluded[name] for name in (*SUMMARY_TOTAL_COLUMNS, 'updated_at')}
+        )
+    else:
+        # Otros motores: se reemplazan los resúmenes con gastos en dos sentencias
+        replaced = db.delete(table).where(
+            _company_filter(table.c.company_id, company_id),
+            db.exists().where(
+                MonthlyExpense.company_id == table.c.company_id,
+                MonthlyExpense.year == table.c.year,
+                MonthlyExpense.month == table.c.month,
+            )
+        )
+        if months is not None:
+            replaced = replaced.where(_months_filter(table.c, months))
+        db.session.execute(replaced)
+        stmt = db.insert(table).from_select(columns, totals)
+    result = db.session.execute(stmt)
+
+    # Los meses que se han quedado sin gastos conservan el resumen, a cero
+    emptied = db.update(table).where(
+        _company_filter(table.c.company_id, company_id),
+        ~db.exists().where(
+            MonthlyExpense.company_id == table.c.company_id,
+            MonthlyExpense.year == table.c.year,
+            MonthlyExpense.month == table.c.month,
+        )
+    )
+    if months is not None:
+        emptied = emptied.where(_months_filter(table.c, months))
+    db.session.execute(emptied.values(updated_at=now, **{name: 0 for name in SUMMARY_TOTAL_COLUMNS}))
+
+    # Los objetos ya cargados en la sesión no reflejan la sentencia
+    for summary in list(db.session.identity_map.values()):
+        if isinstance(summary, MonthlyExpenseSummary):
+            db.session.expire(summary)
+
+    return result.rowcount
+
+
+def materialize_fixed_expenses(start, end=None, company_ids=None):
+    """
+    Crea en cada mes del rango los gastos fijos activos que aún no tiene.
+
+    Una única sentencia INSERT ... SELECT cruza los gastos fijos activos con los
+    meses del rango y descarta los que ya tienen su gasto mensual (mismo
+    fixed_expense_id, año y mes), así que puede repetirse sin duplicar nada.
+    Después se recalculan los resúmenes de esos meses. No confirma la transacción.
+
+    Args:
+        start: (año, mes) inicial
+        end: (año, mes) final, incluido (por defecto, el inicial)
+        company_ids: IDs de las empresas (por defecto, todas)
+
+    Returns:
+        int: Número de gastos mensuales creados
+    """
+    months = list(iter_months(start, end or start))
+    if not months or (company_ids is not None and not company_ids):
+        return 0
+
+    month_rows = [db.select(db.literal(year, db.Integer).label('year'), db.literal(month, db.Integer).label('month'))
+                  for year, month in months]
+    months_table = (db.union_all(*month_rows) if len(month_rows) > 1 else month_rows[0]).subquery('months')
+
+    now = datetime.datetime.utcnow()
+    instances = db.select(
+        FixedExpense.company_id,
+        FixedExpense.category_id,
+        FixedExpense.id,
+        FixedExpense.name,
+        FixedExpense.description,
+        FixedExpense.amount,
+        months_table.c.year,
+        months_table.c.month,
+        db.true(),
+        db.false(),
+        db.literal(now, db.DateTime),
+        db.literal(now, db.DateTime),
+    ).join(months_table, db.true()).where(
+        FixedExpense.is_active == True,
+        _company_filter(FixedExpense.company_id, company_ids),
+        ~db.exists().where(
+            MonthlyExpense.fixed_expense_id == FixedExpense.id,
+            MonthlyExpense.year == months_table.c.year,
+            MonthlyExpense.month == months_table.c.month,
+        )
+    )
+
+    result = db.session.execute(db.insert(MonthlyExpense).from_select(
+        ['company_id', 'category_id', 'fixed_expense_id', 'name', 'description', 'amount',
+         'year', 'month', 'is_fixed', 'submitted_by_employee', 'created_at', 'updated_at'],
+        instances
+    ))
+    created = result.rowcount
+    if created:
+        refresh_expense_summaries(company_ids, months)
+    logger.info(f"Gastos fijos materializados de {months[0][1]:02d}/{months[0][0]} a "
+                f"{months[-1][1]:02d}/{months[-1][0]}: {created}")
+    return created
+
+
+def get_pending_fixed_expenses(company_id, year, month):
+    """Gastos fijos activos de una empresa que aún no tienen su gasto en el mes indicado."""
+    return FixedExpense.query.filter(
+        FixedExpense.company_id == company_id,
+        FixedExpense.is_active == True,
+        ~db.exists().where(
+            MonthlyExpense.fixed_expense_id == FixedExpense.id,
+            MonthlyExpense.year == year,
+            MonthlyExpense.month == month,
+        )
+    ).order_by(FixedExpense.name).all()
+
+
+def get_expense_summary(company_id, year, month):
+    """
+    Devuelve el resumen de un mes sin modificar la base de datos.
+
+    Si el mes no tiene resumen (no ha tenido gastos) se devuelve uno a cero que no
+    se añade a la sesión.
+    """
+    summary = MonthlyExpenseSummary.query.filter_by(
+        company_id=company_id,
+        year=year,
+        month=month
+    ).first()
+    if summary is None:
+        summary = MonthlyExpenseSummary(
+            company_id=company_id,
+            year=year,
+            month=month,
+            fixed_expenses_total=0.0,
+            custom_expenses_total=0.0,
+            total_amount=0.0,
+            number_of_expenses=0
+        )
+    return summary
+
+
+def _empty_cell():
+    return {'amount': 0.0, 'count': 0, 'fixed_amount': 0.0, 'fixed_count': 0,
+            'variable_amount': 0.0, 'variable_count': 0}
+
+
+def _add_to_cell(cell, amount, count, is_fixed):
+    kind = 'fixed' if is_fixed else 'variable'
+    cell['amount'] += amount
+    cell['count'] += count
+    cell[f'{kind}_amount'] += amount
+    cell[f'{kind}_count'] += count
+
+
+def _round_cell(cell):
+    for key in ('amount', 'fixed_amount', 'variable_amount'):
+        cell[key] = round(cell[key], 2)
+    return cell
+
+
+def get_report_version(company_id, year):
+    """
+    Versión de los datos del informe anual de una empresa.
+
+    Una consulta sobre los resúmenes del año (uno por mes, con la restricción
+    única como índice) y las categorías visibles para la empresa.
+    """
+    summaries = db.select(
+        db.func.max(MonthlyExpenseSummary.updated_at),
+        db.func.coalesce(db.func.sum(MonthlyExpenseSummary.number_of_expenses), 0),
+    ).where(MonthlyExpenseSummary.company_id == company_id, MonthlyExpenseSummary.year == year).subquery()
+    categories = db.select(db.func.max(ExpenseCategory.updated_at)).where(
+        (ExpenseCategory.company_id == company_id) | (ExpenseCategory.is_system == True)
+    ).scalar_subquery()
+
+    row = db.session.execute(db.select(summaries, categories)).one()
+    return '|'.join(str(value) for value in row)
+
+
+def build_expense_report(company_id, year):
+    """
+    Calcula la matriz mes × categoría de los gastos de una empresa en un año.
+
+    Una única consulta agrupada por mes, categoría y tipo (fijo o variable).
+
+    Returns:
+        dict: 'categories' (una fila por categoría con sus 12 meses y total,
+              ordenadas por importe), 'months' (totales de cada mes) y 'total'.
+              Cada celda lleva importe y número de gastos, totales y separados
+              en fijos y variables.
+    """
+    is_fixed = db.func.coalesce(MonthlyExpense.is_fixed, False)
+    rows = db.session.execute(
+        db.select(
+            MonthlyExpense.month,
+            ExpenseCategory.id,
+            ExpenseCategory.name,
+            is_fixed,
+            db.func.coalesce(db.func.sum(MonthlyExpense.amount), 0.0),
+            db.func.count(MonthlyExpense.id),
+        )
+        .join(ExpenseCategory, ExpenseCategory.id == MonthlyExpense.category_id)
+        .where(MonthlyExpense.company_id == company_id, MonthlyExpense.year == year)
+        .group_by(MonthlyExpense.month, ExpenseCategory.id, ExpenseCategory.name, is_fixed)
+    ).all()
+
+    months = [dict(_empty_cell(), month=month) for month in range(1, 13)]
+    total = _empty_cell()
+    categories = {}
+    for month, category_id, category_name, fixed, amount, count in rows:
+        if not 1 <= month <= 12:
+            continue
+        category = categories.get(category_id)
+        if category is None:
+            category = categories[category_id] = dict(
+                _empty_cell(), id=category_id, name=category_name,
+                months=[_empty_cell() for _ in range(12)]
+            )
+        amount = float(amount or 0.0)
+        for cell in (category['months'][month - 1], category, months[month - 1], total):
+            _add_to_cell(cell, amount, count, fixed)
+
+    for category in categories.values():
+        _round_cell(category)
+        for cell in category['months']:
+            _round_cell(cell)
+    for cell in months:
+        _round_cell(cell)
+
+    return {
+        'company_id': company_id,
+        'year': year,
+        'categories': sorted(categories.values(), key=lambda category: (-category['amount'], category['name'])),
+        'months': months,
+        'total': _round_cell(total),
+    }
+
+
+def get_expense_report(company_id, year):
+    """
+    Informe anual de gastos de una empresa (ver build_expense_report).
+
+    Se reutiliza mientras no cambie la versión de los datos (get_report_version),
+    así que consultarlo cuesta una consulta pequeña salvo después de un cambio.
+    El resultado se comparte entre peticiones: no debe modificarse.
+    """
+    version = get_report_version(company_id, year)
+    key = (company_id, year)
+    cached = _report_cache.get(key)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+
+    report = build_expense_report(company_id, year)
+    report['version'] = version
+    with _report_cache_lock:
+        if len(_report_cache) >= REPORT_CACHE_SIZE and key not in _report_cache:
+            # Se descarta el informe más antiguo
+            _report_cache.pop(next(iter(_report_cache)))
+        _report_cache[key] = (version, report)
+    return report
+
+
+def iter_report_sheets(report, month_names=MONTH_NAMES):
+    """
+    Hojas de exportación del informe anual (para utils_excel.send_xlsx).
+
+    Args:
+        report: Informe de get_expense_report
+        month_names: Nombres de los 12 meses para los encabezados
+    """
+    def matrix_rows(key):
+        for category in report['categories']:
+            yield [category['name'], *(cell[key] for cell in category['months']), category[key]]
+        yield ['TOTAL', *(cell[key] for cell in report['months']), report['total'][key]]
+
+    def type_rows():
+        for cell in (*report['months'], report['total']):
+            yield [month_names[cell['month'] - 1] if 'month' in cell else 'TOTAL',
+                   cell['fixed_amount'], cell['fixed_count'],
+                   cell['variable_amount'], cell['variable_count'],
+                   cell['amount'], cell['count']]
+
+    headers = ['Categoría', *month_names, 'Total']
+    return [
+        ExcelSheet('Importes', headers, matrix_rows('amount')),
+        ExcelSheet('Número de gastos', headers, matrix_rows('count')),
+        ExcelSheet('Fijos y variables',
+                   ['Mes', 'Fijos', 'Nº fijos', 'Variables', 'Nº variables', 'Total', 'Nº gastos'],
+                   type_rows()),
+    ]
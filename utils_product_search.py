@@ -0,0 +1,122 @@
+"""
+Índice de búsqueda de productos en memoria, uno por local.
+
+El índice (utils_search_index.NgramSearchIndex) normaliza los nombres sin acentos
+ni mayúsculas y los indexa por prefijos de palabra y trigramas. El índice de un
+local se construye la primera vez que se consulta y se descarta cuando cambia
+algún producto de ese local: en el propio proceso al confirmar la transacción y,
+para los cambios hechos por otros procesos, comprobando cada cierto tiempo el
+número de productos y su última modificación.
+"""
+import threading
+import time
+
+from sqlalchemy import event, func
+from sqlalchemy.orm import object_session
+
+from app import db
+from models_tasks import Product
+from utils_search_index import (NgramSearchIndex, normalize_search_text, DEFAULT_SEARCH_LIMIT,
+                                INDEX_REVALIDATE_SECONDS)
+
+# Resultados máximos del autocompletado
+MAX_SEARCH_LIMIT = 50
+
+
+class ProductSearchIndex(NgramSearchIndex):
+    """Índice de los productos activos de un local."""
+
+    def __init__(self, location_id, products, stamp=None):
+        """
+        Args:
+            location_id: ID del local
+            products: Iterable de (id, nombre)
+            stamp: Marca de versión de los productos del local (ver get_location_stamp)
+        """
+        super().__init__(products, stamp=stamp)
+        self.location_id = location_id
+
+
+_indexes = {}
+_indexes_lock = threading.Lock()
+
+
+def get_location_stamp(location_id):
+    """Marca de versión de los productos activos de un local: (número, última modificación)."""
+    count, last_update = db.session.query(func.count(Product.id), func.max(Product.updated_at)).filter(
+        Product.location_id == location_id,
+        Product.is_active == True
+    ).one()
+    return (count, last_update)
+
+
+def build_location_index(location_id):
+    """Construye el índice de los productos activos de un local."""
+    stamp = get_location_stamp(location_id)
+    products = db.session.query(Product.id, Product.name).filter(
+        Product.location_id == location_id,
+        Product.is_active == True
+    ).all()
+    return ProductSearchIndex(location_id, products, stamp=stamp)
+
+
+def get_location_index(location_id):
+    """Devuelve el índice de un local, construyéndolo o revalidándolo si hace falta."""
+    index = _indexes.get(location_id)
+    if index is not None and time.monotonic() - index.checked_at >= INDEX_REVALIDATE_SECONDS:
+        # Cambios hechos por otros procesos (otros workers, importaciones masivas...)
+        if get_location_stamp(location_id) != index.stamp:
+            index = None
+        else:
+            index.checked_at = time.monotonic()
+
+    if index is None:
+        index = build_location_index(location_id)
+        with _indexes_lock:
+            _indexes[location_id] = index
+    return index
+
+
+def invalidate_product_search(location_id=None):
+    """Descarta el índice de un local (o de todos)."""
+    with _indexes_lock:
+        if location_id is None:
+            _indexes.clear()
+        else:
+            _indexes.pop(location_id, None)
+
+
+def search_products(location_id, query, limit=DEFAULT_SEARCH_LIMIT):
+    """Busca productos activos de un local por nombre. Devuelve [(id, nombre)]."""
+    limit = max(1, min(limit or DEFAULT_SEARCH_LIMIT, MAX_SEARCH_LIMIT))
+    return get_location_index(location_id).search(query, limit)
+
+
+# Invalidación al confirmar cambios en productos desde este proceso
+
+def _mark_product_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is None:
+        return
+    pending = session.info.setdefault('product_search_invalidate', set())
+    pending.add(target.location_id)
+    # Si el producto cambia de local, también cambia el índice del local anterior
+    history = db.inspect(target).attrs.location_id.history
+    pending.update(location_id for location_id in history.deleted if location_id is not None)
+
+
+def _invalidate_after_commit(session):
+    pending = session.info.pop('product_search_invalidate', None)
+    if pending:
+        for location_id in pending:
+            invalidate_product_search(location_id)
+
+
+def _discard_after_rollback(session):
+    session.info.pop('product_search_invalidate', None)
+
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Product, _event_name, _mark_product_changed)
+event.listen(db.session, 'after_commit', _invalidate_after_commit)
+event.listen(db.session, 'after_rollback', _discard_after_rollback)
@@ -0,0 +1,328 @@
+"""
+Procesado de las imágenes de recibos de gastos.
+
+Las fotos que suben los empleados (a menudo de 4-8 MB) se guardan tal cual en
+el almacén por contenido (utils_storage) durante la petición y se procesan
+después en un pool de hilos: se corrige la orientación EXIF, se reducen a un
+tamaño máximo, se vuelven a codificar en WebP (o JPEG si Pillow no tiene soporte
+WebP) y se genera una miniatura para los listados. Al terminar se guardan en el
+almacén, se actualiza el gasto con las nuevas rutas, se libera el original y se
+registra el ahorro en bytes.
+
+Los PDF se guardan sin procesar y no tienen miniatura.
+
+La retención se decide desde la base de datos: cada gasto guarda la fecha de
+subida de su recibo (receipt_uploaded_at, indexada), los recibos caducados se
+seleccionan por lotes con una consulta y se eliminan sus archivos a la vez que se
+anulan las referencias. La conciliación de huérfanos compara una sola vez el
+contenido de la carpeta con las rutas de la base de datos.
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+from PIL import Image, ImageOps, features
+
+from app import db
+from models_monthly_expenses import MonthlyExpense
+from utils_storage import (STORAGE_FOLDER, is_stored_path, release_stored_file, release_upload,
+                           resolve_upload_path, storage_relative_path, store_local_file)
+
+logger = logging.getLogger(__name__)
+
+# Subcarpeta de uploads/ de los recibos anteriores al almacén por contenido
+RECEIPTS_FOLDER = 'expense_receipts'
+
+# Lado mayor máximo de la imagen procesada (píxeles)
+RECEIPT_MAX_DIMENSION = 2000
+
+# Calidad de codificación de la imagen procesada
+RECEIPT_QUALITY = 80
+
+# Tamaño máximo de la miniatura y su calidad
+THUMBNAIL_SIZE = (320, 320)
+THUMBNAIL_QUALITY = 70
+
+# Hilos dedicados al procesado de imágenes
+RECEIPT_WORKERS = 2
+
+# Extensiones y tipos que se procesan (el resto, p. ej. PDF, se guardan tal cual)
+PROCESSABLE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+PROCESSABLE_CONTENT_TYPES = ('image/jpeg', 'image/png')
+
+# Recibos caducados que se eliminan en cada lote
+RETENTION_BATCH_SIZE = 500
+
+# Los archivos sin referencia más recientes que esto se respetan (subidas o procesados en curso)
+ORPHAN_GRACE_SECONDS = 3600
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def receipt_format():
+    """Formato de salida: WebP si Pillow lo admite, si no JPEG."""
+    return ('WEBP', '.webp') if features.check('webp') else ('JPEG', '.jpg')
+
+
+def is_processable(path, content_type=None):
+    """Indica si el archivo es una imagen que se procesa (por su tipo o, si no se conoce, su extensión)."""
+    if content_type:
+        return content_type.lower() in PROCESSABLE_CONTENT_TYPES
+    return os.path.splitext(path)[1].lower() in PROCESSABLE_EXTENSIONS
+
+
+def _save_image(image, path, image_format, quality):
+    """Guarda una imagen de forma atómica y devuelve su tamaño en bytes."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    options = {'quality': quality}
+    if image_format == 'JPEG':
+        options.update(optimize=True, progressive=True)
+    else:
+        options['method'] = 4
+    image.save(tmp_path, format=image_format, **options)
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def process_receipt_image(source, processed_path, thumbnail_path):
+    """
+    Procesa una imagen de recibo ya guardada.
+
+    Args:
+        source: Ruta absoluta del original
+        processed_path: Ruta absoluta donde se escribe la imagen procesada
+        thumbnail_path: Ruta absoluta donde se escribe la miniatura
+
+    Returns:
+        tuple: (bytes originales, bytes finales)
+    """
+    image_format, _ = receipt_format()
+    original_size = os.path.getsize(source)
+
+    with Image.open(source) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode not in ('RGB', 'L'):
+            # Sin transparencias: fondo blanco
+            background = Image.new('RGB', image.size, 'white')
+            rgba = image.convert('RGBA')
+            background.paste(rgba, mask=rgba.getchannel('A'))
+            image = background
+        image.thumbnail((RECEIPT_MAX_DIMENSION, RECEIPT_MAX_DIMENSION), Image.LANCZOS)
+        processed_size = _save_image(image, processed_path, image_format, RECEIPT_QUALITY)
+
+        image.thumbnail(THUMBNAIL_SIZE, Image.LANCZOS)
+        _save_image(image, thumbnail_path, image_format, THUMBNAIL_QUALITY)
+
+    return original_size, processed_size
+
+
+def _process_expense_receipt(app, expense_id, relative_path):
+    """Tarea del pool: procesa el recibo de un gasto y actualiza sus rutas."""
+    upload_folder = app.config['UPLOAD_FOLDER']
+    image_format, extension = receipt_format()
+    content_type = f"image/{image_format.lower()}"
+
+    # Las imágenes se escriben en un temporal dentro del almacén y se guardan después por su hash
+    work_dir = os.path.join(upload_folder, STORAGE_FOLDER)
+    os.makedirs(work_dir, exist_ok=True)
+    with tempfile.TemporaryDirectory(prefix='.receipt-', dir=work_dir) as tmp_dir:
+        processed_tmp = os.path.join(tmp_dir, f"receipt{extension}")
+        thumbnail_tmp = os.path.join(tmp_dir, f"thumbnail{extension}")
+        try:
+            original_size, processed_size = process_receipt_image(
+                resolve_upload_path(relative_path, upload_folder), processed_tmp, thumbnail_tmp)
+        except Exception as e:
+            # Se conserva el original tal cual
+            logger.error(f"Error al procesar el recibo {relative_path}: {str(e)}")
+            return None
+
+        with app.app_context():
+            try:
+                processed_path = storage_relative_path(store_local_file(
+                    processed_tmp, content_type, move=True, upload_folder=upload_folder).sha256)
+                thumbnail_path = storage_relative_path(store_local_file(
+                    thumbnail_tmp, content_type, move=True, upload_folder=upload_folder).sha256)
+
+                # Solo si el gasto sigue apuntando al original
+                result = db.session.execute(
+                    db.update(MonthlyExpense)
+                    .where(MonthlyExpense.id == expense_id, MonthlyExpense.receipt_image == relative_path)
+                    .values(receipt_image=processed_path, receipt_thumbnail=thumbnail_path)
+                )
+                updated = result.rowcount
+
+                # Se libera lo que ya no se usa: el original o, si el gasto ha cambiado, lo procesado
+                if updated:
+                    release_upload(relative_path)
+                else:
+                    release_stored_file(processed_path)
+                    release_stored_file(thumbnail_path)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Error al actualizar el recibo del gasto {expense_id}: {str(e)}")
+                updated = 0
+
+    if updated:
+        saved = original_size - processed_size
+        percentage = saved / original_size * 100 if original_size else 0
+        logger.info(f"Recibo del gasto {expense_id} procesado: {original_size} -> {processed_size} bytes "
+                    f"({saved} bytes ahorrados, {percentage:.0f}%)")
+    return processed_path if updated else None
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=RECEIPT_WORKERS, thread_name_prefix='receipt-image')
+        return _executor
+
+
+def submit_receipt_processing(app, expense_id, relative_path, content_type=None):
+    """
+    Encola el procesado del recibo de un gasto y vuelve inmediatamente.
+
+    Debe llamarse después de confirmar el gasto en la base de datos.
+
+    Returns:
+        Future o None si el archivo no es una imagen que se procese
+    """
+    if not relative_path or not is_processable(relative_path, content_type):
+        return None
+    return _get_executor().submit(_process_expense_receipt, app, expense_id, relative_path)
+
+
+def _remove_files(upload_folder, relative_paths):
+    """
+    Elimina archivos de uploads. Devuelve (eliminados, errores); los que no existen no cuentan.
+
+    Los del almacén por contenido solo pierden una referencia: el archivo se
+    elimina al confirmar la transacción si era la última.
+    """
+    removed = errors = 0
+    for relative_path in relative_paths:
+        if release_stored_file(relative_path):
+            removed += 1
+            continue
+        try:
+            os.remove(os.path.join(upload_folder, relative_path))
+            removed += 1
+        except FileNotFoundError:
+            continue
+        except OSError as e:
+            logger.error(f"Error al eliminar el archivo {relative_path}: {str(e)}")
+            errors += 1
+    return removed, errors
+
+
+def expire_receipts(upload_folder, retention_days, now=None, batch_size=RETENTION_BATCH_SIZE):
+    """
+    Elimina los recibos subidos hace más de retention_days días.
+
+    Los gastos caducados se leen por lotes (una consulta por lote sobre el índice
+    de receipt_uploaded_at); de cada lote se eliminan los archivos y se anulan
+    las referencias del gasto, confirmando lote a lote.
+
+    Returns:
+        dict: gastos actualizados, archivos eliminados y errores
+    """
+    cutoff = (now or datetime.utcnow()) - timedelta(days=retention_days)
+    stats = {'expenses': 0, 'files': 0, 'errors': 0}
+    last_id = 0
+
+    while True:
+        rows = db.session.execute(
+            db.select(MonthlyExpense.id, MonthlyExpense.receipt_image, MonthlyExpense.receipt_thumbnail)
+            .where(MonthlyExpense.receipt_uploaded_at < cutoff, MonthlyExpense.id > last_id)
+            .order_by(MonthlyExpense.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        paths = [path for row in rows for path in (row.receipt_image, row.receipt_thumbnail) if path]
+        removed, errors = _remove_files(upload_folder, paths)
+
+        db.session.execute(
+            db.update(MonthlyExpense)
+            .where(MonthlyExpense.id.in_([row.id for row in rows]))
+            .values(receipt_image=None, receipt_thumbnail=None, receipt_uploaded_at=None)
+        )
+        db.session.commit()
+
+        stats['expenses'] += len(rows)
+        stats['files'] += removed
+        stats['errors'] += errors
+
+    return stats
+
+
+def reconcile_receipt_files(upload_folder, dry_run=False, grace_seconds=ORPHAN_GRACE_SECONDS):
+    """
+    Compara los archivos de la carpeta de recibos con las rutas de la base de datos.
+
+    Se recorre la carpeta una vez y se leen todas las rutas referenciadas en una
+    consulta. Los archivos sin referencia (salvo los muy recientes) se eliminan y
+    las referencias a archivos que ya no existen se anulan. Los recibos del almacén
+    por contenido se comprueban uno a uno; sus archivos sin referencia los elimina
+    utils_storage.remove_unreferenced_files.
+
+    Returns:
+        dict: archivos revisados, huérfanos eliminados, referencias rotas anuladas y errores
+    """
+    receipts_dir = os.path.join(upload_folder, RECEIPTS_FOLDER)
+    stats = {'files': 0, 'orphans': 0, 'missing': 0, 'errors': 0}
+
+    files = {}
+    for root, _, filenames in os.walk(receipts_dir):
+        for filename in filenames:
+            path = os.path.join(root, filename)
+            try:
+                files[os.path.relpath(path, upload_folder)] = os.stat(path).st_mtime
+            except OSError:
+                continue
+    stats['files'] = len(files)
+
+    referenced = {}
+    for expense_id, image, thumbnail in db.session.execute(
+            db.select(MonthlyExpense.id, MonthlyExpense.receipt_image, MonthlyExpense.receipt_thumbnail)
+            .where(MonthlyExpense.receipt_image.isnot(None))):
+        referenced[image] = expense_id
+        if thumbnail:
+            referenced[thumbnail] = expense_id
+
+    limit = time.time() - grace_seconds
+    orphans = [path for path, mtime in files.items()
+               if path not in referenced and mtime < limit and not path.endswith('.tmp')]
+    def exists(path):
+        if is_stored_path(path):
+            return os.path.exists(os.path.join(upload_folder, path))
+        return path in files
+
+    missing = sorted({expense_id for path, expense_id in referenced.items() if not exists(path)})
+    stats['orphans'] = len(orphans)
+    stats['missing'] = len(missing)
+
+    if dry_run:
+        return stats
+
+    # De un gasto sin imagen sobra también la miniatura (y al revés); las referencias del almacén se liberan
+    missing_set = set(missing)
+    orphans.extend(path for path, expense_id in referenced.items()
+                   if expense_id in missing_set and (path in files or is_stored_path(path)))
+    stats['orphans'], stats['errors'] = _remove_files(upload_folder, orphans)
+    for start in range(0, len(missing), RETENTION_BATCH_SIZE):
+        db.session.execute(
+            db.update(MonthlyExpense)
+            .where(MonthlyExpense.id.in_(missing[start:start + RETENTION_BATCH_SIZE]))
+            .values(receipt_image=None, receipt_thumbnail=None, receipt_uploaded_at=None)
+        )
+    db.session.commit()
+    return stats
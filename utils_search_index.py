@@ -0,0 +1,166 @@
+"""
+Índice de búsqueda en memoria de textos cortos (nombres).
+
+Lo usan el autocompletado de productos de cada local (utils_product_search) y la
+búsqueda global cuando la base de datos no es PostgreSQL (utils_global_search).
+No depende de la aplicación ni de la base de datos.
+
+Los nombres se normalizan sin acentos ni mayúsculas y se indexan por prefijos de
+cada palabra (para el autocompletado mientras se escribe) y por trigramas (para
+encontrar texto en mitad de una palabra o con pequeñas erratas).
+"""
+import heapq
+import time
+import unicodedata
+from collections import Counter, defaultdict
+
+# Longitud máxima de los prefijos indexados (las palabras más largas se buscan por trigramas)
+MAX_PREFIX_LENGTH = 12
+
+# Tamaño de los n-gramas
+NGRAM_SIZE = 3
+
+# Proporción mínima de trigramas de la búsqueda que debe tener un resultado
+MIN_NGRAM_SCORE = 0.6
+
+# Segundos entre comprobaciones de cambios hechos por otros procesos
+INDEX_REVALIDATE_SECONDS = 30
+
+# Resultados por defecto
+DEFAULT_SEARCH_LIMIT = 10
+
+
+def normalize_search_text(text):
+    """Minúsculas, sin acentos y con cualquier signo convertido en espacio."""
+    if not text:
+        return ''
+    decomposed = unicodedata.normalize('NFKD', str(text).lower())
+    chars = []
+    for char in decomposed:
+        if unicodedata.combining(char):
+            continue
+        chars.append(char if char.isalnum() else ' ')
+    return ' '.join(''.join(chars).split())
+
+
+def _ngrams(text):
+    padded = f" {text} "
+    return {padded[i:i + NGRAM_SIZE] for i in range(len(padded) - NGRAM_SIZE + 1)}
+
+
+class NgramSearchIndex:
+    """
+    Índice en memoria de textos cortos (nombres) por prefijos de palabra y trigramas.
+
+    Cada entrada puede llevar un grupo (p. ej. la empresa) para restringir la
+    búsqueda a los grupos a los que tiene acceso el usuario.
+    """
+
+    def __init__(self, entries, stamp=None):
+        """
+        Args:
+            entries: Iterable de (id, texto) o (id, texto, grupo)
+            stamp: Marca de versión de los datos indexados
+        """
+        self.stamp = stamp
+        self.checked_at = time.monotonic()
+        self.ids = []
+        self.names = []
+        self.groups = []
+        self.normalized = []
+        self.prefixes = defaultdict(set)
+        self.ngrams = defaultdict(set)
+
+        for position, entry in enumerate(sorted(entries, key=lambda e: (e[1] or '').lower())):
+            normalized = normalize_search_text(entry[1])
+            self.ids.append(entry[0])
+            self.names.append(entry[1])
+            self.groups.append(entry[2] if len(entry) > 2 else None)
+            self.normalized.append(normalized)
+            for word in normalized.split():
+                for length in range(1, min(len(word), MAX_PREFIX_LENGTH) + 1):
+                    self.prefixes[word[:length]].add(position)
+            for gram in _ngrams(normalized):
+                self.ngrams[gram].add(position)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def _prefix_candidates(self, words):
+        candidates = None
+        # Las palabras más largas suelen tener menos coincidencias: se intersecan primero
+        for word in sorted(words, key=len, reverse=True):
+            if len(word) <= MAX_PREFIX_LENGTH:
+                matches = self.prefixes.get(word, set())
+            else:
+                # Palabra más larga que los prefijos indexados: filtrar por el prefijo máximo
+                matches = {position for position in self.prefixes.get(word[:MAX_PREFIX_LENGTH], set())
+                           if any(w.startswith(word) for w in self.normalized[position].split())}
+            candidates = set(matches) if candidates is None else candidates & matches
+            if not candidates:
+                return set()
+        return candidates or set()
+
+    def _ngram_scores(self, normalized_query):
+        grams = _ngrams(normalized_query)
+        minimum = max(1, int(len(grams) * MIN_NGRAM_SCORE + 0.5))
+        postings = sorted((self.ngrams.get(gram, set()) for gram in grams), key=len)
+        # Una entrada con al menos `minimum` trigramas tiene alguno de los len - minimum + 1 menos
+        # frecuentes: solo esas son candidatas y en los trigramas frecuentes se cuentan por intersección
+        rare = len(postings) - minimum + 1
+        counts = Counter()
+        for positions in postings[:rare]:
+            counts.update(positions)
+        for positions in postings[rare:]:
+            counts.update(positions.intersection(counts))
+        return {position: count / len(grams) for position, count in counts.items() if count >= minimum}
+
+    def search(self, query, limit=DEFAULT_SEARCH_LIMIT, groups=None):
+        """
+        Busca por nombre.
+
+        Primero se buscan las entradas en las que cada palabra de la búsqueda es el
+        inicio de alguna palabra del nombre; si no hay suficientes, se completan con
+        las más parecidas por trigramas.
+
+        Args:
+            query: Texto buscado
+            limit: Número máximo de resultados
+            groups: Grupos permitidos (None para todos)
+
+        Returns:
+            list: [(id, nombre)] ordenados por relevancia
+        """
+        normalized_query = normalize_search_text(query)
+        if groups is not None:
+            groups = set(groups)
+            if not groups:
+                return []
+        allowed = (lambda position: True) if groups is None else (lambda position: self.groups[position] in groups)
+
+        if not normalized_query:
+            positions = (position for position in range(len(self.ids)) if allowed(position))
+            return [(self.ids[i], self.names[i]) for _, i in zip(range(limit), positions)]
+
+        words = normalized_query.split()
+        ranked = []
+        prefix_matches = self._prefix_candidates(words)
+        for position in prefix_matches:
+            if not allowed(position):
+                continue
+            normalized = self.normalized[position]
+            if normalized == normalized_query:
+                rank = 0
+            elif normalized.startswith(normalized_query):
+                rank = 1
+            else:
+                rank = 2
+            ranked.append((rank, 0.0, position))
+
+        if len(ranked) < limit:
+            for position, score in self._ngram_scores(normalized_query).items():
+                if position not in prefix_matches and allowed(position):
+                    ranked.append((3, -score, position))
+
+        # Las posiciones siguen el orden alfabético, así que desempatan por nombre
+        return [(self.ids[position], self.names[position]) for _, _, position in heapq.nsmallest(limit, ranked)]
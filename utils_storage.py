@@ -0,0 +1,405 @@
+"""
+Almacenamiento de archivos subidos por contenido.
+
+Los archivos se guardan bajo uploads/store/ con su hash SHA-256 como nombre, en
+subcarpetas por los dos primeros pares de caracteres (store/ab/cd/abcd...). El
+hash se calcula mientras se copia el archivo a un temporal de la misma carpeta,
+sin leerlo entero en memoria, y el temporal se mueve a su ruta definitiva con un
+rename atómico; si el contenido ya existía, el temporal se descarta. Así, el
+mismo recibo enviado dos veces ocupa el espacio de uno.
+
+La tabla stored_files lleva la cuenta de referencias de cada archivo. Al liberar
+la última referencia se elimina la fila y, al confirmar la transacción, el
+archivo. Para que una subida simultánea del mismo contenido no se quede sin
+archivo, el borrado reserva el hash en stored_files mientras elimina el archivo
+(las subidas de ese hash esperan) y la subida comprueba que el archivo sigue ahí
+después de sumar su referencia, reponiéndolo si hace falta.
+
+Las rutas que se guardan en los modelos son relativas a UPLOAD_FOLDER
+(store/ab/cd/<hash>); las rutas anteriores (absolutas o relativas a otras
+carpetas) se siguen resolviendo y sirviendo hasta que se migran con
+migrate_uploads_to_storage.py.
+
+Las descargas admiten peticiones condicionales y Range, y se guardan en la caché
+privada del navegador: un año si la URL lleva la versión del contenido
+(storage_version) y, si no, revalidando con el ETag.
+"""
+import hashlib
+import mimetypes
+import os
+import tempfile
+import time
+from datetime import datetime
+
+from flask import current_app, request, send_file
+from sqlalchemy import event
+
+from app import db
+from models_storage import StoredFile
+from utils_db import upsert_insert
+
+# Subcarpeta de uploads/ del almacén por contenido
+STORAGE_FOLDER = 'store'
+
+# Tamaño de los bloques que se leen al copiar y calcular el hash
+HASH_CHUNK_SIZE = 64 * 1024
+
+# Caché del navegador para las descargas cuya URL identifica el contenido (un año)
+DOWNLOAD_MAX_AGE = 365 * 24 * 3600
+
+# Caracteres del hash que se usan como versión en las URL
+VERSION_LENGTH = 16
+
+# Hashes por consulta al comprobar qué archivos siguen en stored_files
+HASH_LOOKUP_BATCH = 500
+
+
+def storage_relative_path(sha256):
+    """Ruta de un archivo del almacén relativa a UPLOAD_FOLDER."""
+    return os.path.join(STORAGE_FOLDER, sha256[:2], sha256[2:4], sha256)
+
+
+def is_stored_path(path):
+    """Indica si una ruta guardada en un modelo pertenece al almacén por contenido."""
+    return bool(path) and path.startswith(STORAGE_FOLDER + os.sep) and len(os.path.basename(path)) == 64
+
+
+def stored_sha256(path):
+    """Hash de un archivo del almacén a partir de su ruta (o None)."""
+    return os.path.basename(path) if is_stored_path(path) else None
+
+
+def resolve_upload_path(path, upload_folder=None):
+    """Ruta absoluta de un archivo subido (acepta rutas absolutas anteriores al almacén)."""
+    if not path:
+        return None
+    if os.path.isabs(path):
+        return path
+    return os.path.join(upload_folder or current_app.config['UPLOAD_FOLDER'], path)
+
+
+def _copy_and_hash(stream, destination):
+    """Copia un flujo en un archivo abierto calculando su SHA-256. Devuelve (hash, bytes)."""
+    digest = hashlib.sha256()
+    size = 0
+    while True:
+        chunk = stream.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+        destination.write(chunk)
+        size += len(chunk)
+    return digest.hexdigest(), size
+
+
+def _add_reference(sha256, size, content_type):
+    """Suma una referencia al archivo (creando su fila si es nuevo)."""
+    insert = upsert_insert()
+    if insert is not None:
+        # Una sola sentencia: dos subidas simultáneas del mismo contenido no chocan con la restricción única
+        table = StoredFile.__table__
+        stmt = insert(table).values(sha256=sha256, size=size, content_type=content_type,
+                                    ref_count=1, created_at=datetime.utcnow())
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['sha256'],
+            set_={'ref_count': table.c.ref_count + 1,
+                  'content_type': db.func.coalesce(table.c.content_type, stmt.excluded.content_type)}
+        )
+        db.session.execute(stmt)
+        stored = db.session.execute(
+            db.select(StoredFile).where(StoredFile.sha256 == sha256).execution_options(populate_existing=True)
+        ).scalar_one()
+    else:
+        stored = StoredFile.query.filter_by(sha256=sha256).with_for_update().first()
+        if stored is None:
+            stored = StoredFile(sha256=sha256, size=size, content_type=content_type, ref_count=0)
+            db.session.add(stored)
+        stored.ref_count = (stored.ref_count or 0) + 1
+        if content_type and not stored.content_type:
+            stored.content_type = content_type
+    # Si se libera y se vuelve a añadir en la misma transacción, el archivo no se elimina
+    db.session.info.get('storage_delete', set()).discard(sha256)
+    return stored
+
+
+def store_stream(stream, content_type=None, upload_folder=None):
+    """
+    Guarda el contenido de un flujo binario en el almacén y suma una referencia.
+
+    No confirma la transacción.
+
+    Returns:
+        StoredFile
+    """
+    upload_folder = upload_folder or current_app.config['UPLOAD_FOLDER']
+    store_dir = os.path.join(upload_folder, STORAGE_FOLDER)
+    os.makedirs(store_dir, exist_ok=True)
+
+    # El temporal se crea en el propio almacén para que el rename sea atómico
+    fd, tmp_path = tempfile.mkstemp(prefix='.upload-', suffix='.tmp', dir=store_dir)
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            sha256, size = _copy_and_hash(stream, tmp)
+
+        stored = _add_reference(sha256, size, content_type)
+
+        # Con la referencia sumada ya no se puede borrar el archivo; se comprueba
+        # después por si lo eliminó la liberación de la última referencia anterior
+        final_path = os.path.join(upload_folder, storage_relative_path(sha256))
+        if os.path.exists(final_path):
+            # Contenido repetido: se reutiliza el archivo existente
+            os.remove(tmp_path)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, final_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return stored
+
+
+def store_upload(file_storage, upload_folder=None):
+    """Guarda un archivo subido (FileStorage de Werkzeug) en el almacén. Devuelve StoredFile."""
+    content_type = getattr(file_storage, 'mimetype', None) or mimetypes.guess_type(file_storage.filename or '')[0]
+    return store_stream(file_storage.stream, content_type=content_type, upload_folder=upload_folder)
+
+
+def store_local_file(path, content_type=None, move=False, upload_folder=None):
+    """
+    Guarda en el almacén un archivo que ya está en disco. Devuelve StoredFile.
+
+    Con move=True se elimina el original al terminar (como si se hubiera movido).
+    """
+    content_type = content_type or mimetypes.guess_type(path)[0]
+    with open(path, 'rb') as source:
+        stored = store_stream(source, content_type=content_type, upload_folder=upload_folder)
+    if move:
+        os.remove(path)
+    return stored
+
+
+def release_stored_file(path):
+    """
+    Resta una referencia a un archivo del almacén.
+
+    Con la última referencia se elimina la fila y, al confirmar la transacción,
+    el archivo. Las rutas que no son del almacén se ignoran (devuelve False).
+    """
+    sha256 = stored_sha256(path)
+    if sha256 is None:
+        return False
+    stored = StoredFile.query.filter_by(sha256=sha256).with_for_update().first()
+    if stored is None:
+        return True
+    stored.ref_count = (stored.ref_count or 0) - 1
+    if stored.ref_count <= 0:
+        db.session.delete(stored)
+        db.session.info.setdefault('storage_delete', set()).add(sha256)
+        db.session.info['storage_upload_folder'] = current_app.config['UPLOAD_FOLDER']
+    return True
+
+
+def release_upload(path):
+    """
+    Libera un archivo subido: resta una referencia si es del almacén y, si es una
+    ruta anterior al almacén, elimina el archivo directamente.
+    """
+    if not path:
+        return
+    if not release_stored_file(path):
+        full_path = resolve_upload_path(path)
+        if os.path.exists(full_path):
+            os.remove(full_path)
+
+
+def storage_version(path):
+    """
+    Versión corta del contenido de un archivo para las URL (parámetro v).
+
+    Con ella la URL identifica el contenido y la respuesta puede guardarse en la
+    caché del navegador sin revalidar. Para las rutas anteriores al almacén se usa
+    la propia ruta, que cambia con cada subida.
+    """
+    if not path:
+        return None
+    sha256 = stored_sha256(path)
+    if sha256 is None:
+        return hashlib.sha256(path.encode('utf-8')).hexdigest()[:VERSION_LENGTH]
+    return sha256[:VERSION_LENGTH]
+
+
+def _set_cache_headers(response, immutable):
+    """Caché privada: larga si la URL identifica el contenido, si no revalidando con el ETag."""
+    response.cache_control.public = False
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.headers.pop('Expires', None)
+    if immutable:
+        response.cache_control.max_age = DOWNLOAD_MAX_AGE
+        response.cache_control.immutable = True
+    else:
+        response.cache_control.max_age = 0
+        response.cache_control.must_revalidate = True
+    return response
+
+
+def send_stored_file(path, mimetype=None, as_attachment=False, download_name=None, immutable=None):
+    """
+    Envía un archivo subido.
+
+    Las respuestas llevan ETag (el hash para los archivos del almacén; tamaño y
+    fecha para los anteriores) y Last-Modified, responden 304 a las peticiones
+    condicionales, admiten peticiones Range (206) y se guardan solo en la caché
+    privada del navegador. Si immutable es verdadero (por defecto, si la URL
+    lleva v=storage_version(path)) la caché dura DOWNLOAD_MAX_AGE sin revalidar.
+
+    Si está configurado STORAGE_ACCEL_REDIRECT (prefijo de una location interna de
+    nginx que apunta a UPLOAD_FOLDER), la respuesta solo lleva la cabecera
+    X-Accel-Redirect y nginx sirve el archivo (también los rangos).
+    """
+    sha256 = stored_sha256(path)
+    if immutable is None:
+        immutable = request.args.get('v') == storage_version(path)
+
+    # Revalidación de un archivo del almacén: el hash basta, sin consultar ni abrir nada
+    if sha256 and sha256 in request.if_none_match:
+        response = current_app.response_class(status=304)
+        response.set_etag(sha256)
+        return _set_cache_headers(response, immutable)
+
+    full_path = resolve_upload_path(path)
+    if mimetype is None and sha256:
+        # Los archivos del almacén no tienen extensión: el tipo se guardó al subirlos
+        mimetype = db.session.execute(
+            db.select(StoredFile.content_type).where(StoredFile.sha256 == sha256)
+        ).scalar()
+    mimetype = mimetype or mimetypes.guess_type(download_name or path)[0] or 'application/octet-stream'
+
+    accel_prefix = current_app.config.get('STORAGE_ACCEL_REDIRECT')
+    upload_folder = current_app.config['UPLOAD_FOLDER']
+    if accel_prefix and os.path.abspath(full_path).startswith(os.path.abspath(upload_folder) + os.sep):
+        response = current_app.response_class(mimetype=mimetype)
+        relative = os.path.relpath(full_path, upload_folder).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = accel_prefix.rstrip('/') + '/' + relative
+        if as_attachment or download_name:
+            response.headers.set('Content-Disposition', 'attachment' if as_attachment else 'inline',
+                                 filename=download_name or os.path.basename(path))
+        if sha256:
+            response.set_etag(sha256)
+        return _set_cache_headers(response, immutable)
+
+    response = send_file(
+        full_path,
+        mimetype=mimetype,
+        as_attachment=as_attachment,
+        download_name=download_name,
+        conditional=True,
+        etag=sha256 if sha256 else True,
+        max_age=None
+    )
+    return _set_cache_headers(response, immutable)
+
+
+def remove_unreferenced_files(upload_folder, grace_seconds=3600, dry_run=False):
+    """
+    Elimina los archivos del almacén que no tienen fila en stored_files.
+
+    Quedan, por ejemplo, cuando falla la transacción que los referenciaba. Los
+    archivos más recientes que grace_seconds se respetan (subidas en curso).
+
+    Returns:
+        dict: archivos revisados, eliminados y errores
+    """
+    store_dir = os.path.join(upload_folder, STORAGE_FOLDER)
+    stats = {'files': 0, 'removed': 0, 'errors': 0}
+
+    candidates = {}
+    limit = time.time() - grace_seconds
+    for root, _, filenames in os.walk(store_dir):
+        for filename in filenames:
+            if len(filename) != 64:
+                continue
+            path = os.path.join(root, filename)
+            stats['files'] += 1
+            try:
+                if os.stat(path).st_mtime < limit:
+                    candidates[filename] = path
+            except OSError:
+                continue
+
+    table = StoredFile.__table__
+    hashes = list(candidates)
+    for start in range(0, len(hashes), HASH_LOOKUP_BATCH):
+        batch = hashes[start:start + HASH_LOOKUP_BATCH]
+        for sha256 in db.session.execute(db.select(table.c.sha256).where(table.c.sha256.in_(batch))).scalars():
+            candidates.pop(sha256, None)
+
+    stats['removed'] = len(candidates)
+    if dry_run:
+        return stats
+    for path in candidates.values():
+        try:
+            os.remove(path)
+        except OSError:
+            stats['removed'] -= 1
+            stats['errors'] += 1
+    return stats
+
+
+# Eliminación de los archivos sin referencias al confirmar la transacción
+
+def _delete_unreferenced(connection, sha256, upload_folder):
+    """
+    Elimina el archivo de un hash si sigue sin fila en stored_files.
+
+    Se reserva el hash con una fila provisional mientras se elimina el archivo:
+    una subida simultánea del mismo contenido espera a que termine (y luego repone
+    el archivo) o, si ya había sumado su referencia, el archivo se conserva.
+    """
+    table = StoredFile.__table__
+    insert = upsert_insert(connection)
+    with connection.begin():
+        if insert is not None:
+            claimed = connection.execute(
+                insert(table).values(sha256=sha256, size=0, ref_count=0, created_at=datetime.utcnow())
+                .on_conflict_do_nothing(index_elements=['sha256'])
+            ).rowcount
+        else:
+            claimed = connection.execute(
+                db.select(table.c.id).where(table.c.sha256 == sha256)
+            ).first() is None
+        if not claimed:
+            # Otra transacción ha vuelto a subir el mismo contenido
+            return
+        try:
+            os.remove(os.path.join(upload_folder, storage_relative_path(sha256)))
+        except OSError:
+            pass
+        if insert is not None:
+            connection.execute(db.delete(table).where(table.c.sha256 == sha256, table.c.ref_count == 0))
+
+
+def _delete_after_commit(session):
+    pending = session.info.pop('storage_delete', None)
+    upload_folder = session.info.pop('storage_upload_folder', None)
+    if not pending or not upload_folder:
+        return
+    with db.engine.connect() as connection:
+        for sha256 in pending:
+            try:
+                _delete_unreferenced(connection, sha256, upload_folder)
+            except Exception as e:
+                # El archivo queda para remove_unreferenced_files
+                current_app.logger.error(f"Error al eliminar el archivo {sha256} del almacén: {str(e)}")
+
+
+def _discard_after_rollback(session):
+    session.info.pop('storage_delete', None)
+    session.info.pop('storage_upload_folder', None)
+
+
+event.listen(db.session, 'after_commit', _delete_after_commit)
+event.listen(db.session, 'after_rollback', _discard_after_rollback)
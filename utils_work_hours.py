@@ -171,6 +171,11 @@ def update_company_work_hours(company_id, check_in_time, hours_worked):
         # Actualizar acumulados
         comp_hours.weekly_hours += hours_worked
         comp_hours.monthly_hours += hours_worked
+        db.session.flush()
+        
+        # Actualizar el coste de personal de los resúmenes de arqueos de caja
+        from utils_cash_register import update_staff_cost_summaries
+        update_staff_cost_summaries(company_id, check_in_time.date())
         
         # No hacemos commit aquí, se hace en la función llamadora
         return True